@@ -24,6 +24,7 @@
 # *
 # **************************************************************************
 
+import os, tempfile
 import pwem
 from os.path import join, exists
 from .constants import *
@@ -45,12 +46,20 @@ class Plugin(pwem.Plugin):
         """ Return and write a variable in the config file.
         """
         cls._defineEmVar(P2RANK_DIC['home'], P2RANK_DIC['name'] + '-' + P2RANK_DIC['version'])
+        cls._defineVar(WORKER_DIR_VAR, join(tempfile.gettempdir(), 'p2rank-worker-{}'.format(os.getuid())))
+        cls._defineVar(WORKER_IDLE_VAR, WORKER_IDLE_TIMEOUT)
+        # Per-user cache outside the Scipion installation, which may be shared or read-only
+        cls._defineVar(CACHE_DIR_VAR, join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                           'scipion-p2rank'))
+        cls._defineVar(CACHE_SIZE_VAR, CACHE_SIZE)
+        cls._defineVar(CATALOG_VAR, '')
 
     @classmethod
     def defineBinaries(cls, env):
         installationCmd = 'wget %s -O %s && ' % (cls._getP2RankDownloadUrl(), cls._getP2RankTar())
         installationCmd += 'tar -xf %s --strip-components 1 && ' % cls._getP2RankTar()
         installationCmd += 'rm %s && ' % cls._getP2RankTar()
+        installationCmd += '(%s ; true) && ' % cls._getCDSTrainingCmd()
 
         # Creating validation file
         P2RANK_INSTALLED = '%s_installed' % P2RANK_DIC['name']
@@ -64,15 +73,87 @@ class Plugin(pwem.Plugin):
                        default=True)
 
     @classmethod
-    def runP2Rank(cls, protocol, program, args, cwd=None):
-        """ Run P2Rank command from a given protocol. """
-        protocol.runJob(join(cls.getVar(P2RANK_DIC['home']), 'prank {}'.format(program)), args, cwd=cwd)
+    def runP2Rank(cls, protocol, program, args, cwd=None, useWorker=False, javaOptions=None):
+        """ Run P2Rank command from a given protocol.
+        If useWorker, the command is submitted to the persistent P2Rank worker, falling back to a
+        one-shot execution if the worker is not available.
+        javaOptions (e.g. heap and GC) are passed to the JVM through JDK_JAVA_OPTIONS. A running worker keeps the
+        options it was started with. """
+        if useWorker:
+            from .worker import P2RankWorkerError
+            try:
+                exitCode = cls.getWorker(javaOptions).submit(program, args)
+            except P2RankWorkerError as e:
+                protocol.info('P2Rank worker not available ({}), running P2Rank in one-shot mode'.format(e))
+            else:
+                if exitCode != 0:
+                    raise Exception('P2Rank worker command "{}" failed with exit code {}'.format(program, exitCode))
+                return
 
-    @classmethod  #  Test that
-    def getEnviron(cls):
-        pass
+        protocol.runJob(join(cls.getVar(P2RANK_DIC['home']), 'prank {}'.format(program)), args, cwd=cwd,
+                        env=cls.getEnviron(javaOptions))
+
+    @classmethod
+    def getWorker(cls, javaOptions=None):
+        """ Returns the client of the persistent P2Rank worker of this installation """
+        from .worker import P2RankWorkerClient
+        return P2RankWorkerClient(cls.getVar(P2RANK_DIC['home']), cls.getVar(WORKER_DIR_VAR),
+                                  idleTimeout=cls.getVar(WORKER_IDLE_VAR), javaOptions=javaOptions,
+                                  environ=cls.getEnviron())
+
+    @classmethod
+    def getCache(cls):
+        """ Returns the shared cache of P2Rank predictions """
+        from .cache import P2RankCache
+        return P2RankCache(cls.getVar(CACHE_DIR_VAR), cls.getVar(CACHE_SIZE_VAR))
+
+    @classmethod
+    def getCatalog(cls, protocol=None):
+        """ Returns the catalog of P2Rank predictions set in P2RANK_CATALOG or, if not set, the one of the project
+        of the protocol """
+        from .catalog import P2RankCatalog
+        catalogFile = cls.getVar(CATALOG_VAR)
+        if not catalogFile:
+            # The working directories of the protocols are in the Runs directory of the project
+            projectDir = os.path.dirname(os.path.dirname(os.path.abspath(protocol.getWorkingDir())))
+            catalogFile = join(projectDir, CATALOG_FILE)
+        return P2RankCatalog(catalogFile)
+
+    @classmethod
+    def getEnviron(cls, javaOptions=None):
+        """ Returns the environment to run P2Rank, with the javaOptions added to the JDK_JAVA_OPTIONS read by
+        the java launcher (they take precedence over the options already defined there).
+        The class-data sharing archive of the installation is used if it exists """
+        environ = dict(os.environ)
+        javaOptions = cls.getCDSOptions() + list(javaOptions or [])
+        if javaOptions:
+            prevOptions = environ.get(JAVA_OPTIONS_VAR, '')
+            environ[JAVA_OPTIONS_VAR] = ' '.join([prevOptions] + list(javaOptions)).strip()
+        return environ
+
+    @classmethod
+    def getCDSArchive(cls):
+        """ Returns the class-data sharing archive dumped at the installation, or None if there is none """
+        archive = join(cls.getVar(P2RANK_DIC['home']), CDS_ARCHIVE)
+        return archive if exists(archive) else None
+
+    @classmethod
+    def getCDSOptions(cls):
+        """ Returns the java options loading the P2Rank classes from the class-data sharing archive.
+        With -Xshare:auto, the JVM silently loads the classes from the jars if the archive cannot be used
+        (e.g. after a java update) """
+        archive = cls.getCDSArchive()
+        return ['-XX:SharedArchiveFile={}'.format(archive), '-Xshare:auto'] if archive else []
 
     # ---------------------------------- Utils functions  -----------------------
+    @classmethod
+    def _getCDSTrainingCmd(cls):
+        """ Command dumping the classes loaded by a prediction on a structure of the P2Rank release into the
+        class-data sharing archive (java >= 13). Its failure does not affect the installation """
+        return '{}=-XX:ArchiveClassesAtExit={} ./prank predict -f {} -o cds_training -threads 1 > ' \
+               'cds_training.log 2>&1 ; rm -rf cds_training'.format(JAVA_OPTIONS_VAR, CDS_ARCHIVE,
+                                                                   CDS_TRAINING_STRUCTURE)
+
     @classmethod
     def _getP2RankDownloadUrl(cls):
         return "\'https://github.com/rdk/p2rank/releases/download/{}/p2rank_{}.tar.gz\'".\
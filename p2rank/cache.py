@@ -0,0 +1,283 @@
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content-addressed cache of P2Rank predictions, shared between projects.
+Entries are keyed by the hash of the input structure, the P2Rank version and the arguments affecting the
+prediction, and the least recently used ones are evicted when the cache exceeds its size. The total size of the
+entries is recorded in an index file, so the entries are only listed when an eviction is due.
+"""
+import os, json, stat, time, fcntl, shutil, hashlib, tempfile
+
+from .constants import P2RANK_RUN_ARGS
+
+# Cached output files: cache name -> P2Rank output path, formatted with the structure file name
+CACHED_FILES = {'predictions.csv': '{}_predictions.csv',
+                'residues.csv': '{}_residues.csv',
+                'scene.pml': 'visualizations/{}.pml',
+                'points.pdb.gz': 'visualizations/data/{}_points.pdb.gz'}
+META_FILE = 'meta.json'
+SIZE_FILE = '.size'
+# Fraction of the maximum size the cache is left at when evicting, so a full cache is not listed on every store
+EVICT_TARGET = 0.9
+# Outputs needed to consider a P2Rank prediction complete
+REQUIRED_FILES = ['predictions.csv', 'points.pdb.gz']
+MARKERS_DIR = '.completed'
+
+
+def makePrivateDir(dirPath):
+    '''Creates the directory dirPath only accessible by the user. Raises PermissionError if it already exists but
+    other user owns it or others can access it, since they could have planted its contents. Returns dirPath'''
+    os.makedirs(dirPath, mode=0o700, exist_ok=True)
+    dirStat = os.stat(dirPath)
+    if dirStat.st_uid != os.getuid() or stat.S_IMODE(dirStat.st_mode) & 0o077:
+        raise PermissionError('The directory {} must be owned and only accessible by the user'.format(dirPath))
+    return dirPath
+
+
+def getFileHash(fileName, blockSize=1 << 20):
+    fileHash = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+def getPredictionKey(structFile, version, args):
+    '''Returns the key identifying the P2Rank prediction of a structure file with a P2Rank version and
+    the arguments that modify the result (input, output and threads arguments are ignored)'''
+    effArgs, skipNext = [], False
+    for arg in map(str, args):
+        if skipNext:
+            skipNext = False
+        elif arg in P2RANK_RUN_ARGS:
+            skipNext = True
+        else:
+            effArgs.append(arg)
+
+    key = hashlib.sha256()
+    key.update(getFileHash(structFile).encode())
+    key.update(str(version).encode())
+    key.update('\0'.join(effArgs).encode())
+    return key.hexdigest()
+
+
+def _getMarkerFile(outDir, structName):
+    return os.path.join(outDir, MARKERS_DIR, structName + '.json')
+
+
+def _getOutputFiles(structName, cacheNames=CACHED_FILES):
+    return [CACHED_FILES[cacheName].format(structName) for cacheName in cacheNames]
+
+
+def markPredictionComplete(key, outDir, structName):
+    '''Writes the completion marker of the P2Rank outputs of the structure named structName found in outDir,
+    with the prediction key (see getPredictionKey) and the sizes of the outputs.
+    Returns whether it was marked (False if the required outputs are missing)'''
+    if not all(os.path.exists(os.path.join(outDir, outFile))
+               for outFile in _getOutputFiles(structName, REQUIRED_FILES)):
+        return False
+
+    files = {outFile: os.path.getsize(os.path.join(outDir, outFile)) for outFile in _getOutputFiles(structName)
+             if os.path.exists(os.path.join(outDir, outFile))}
+    markerFile = _getMarkerFile(outDir, structName)
+    os.makedirs(os.path.dirname(markerFile), exist_ok=True)
+    tmpFile = '{}.{}.tmp'.format(markerFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+        json.dump({'key': key, 'files': files, 'completed': time.time()}, f)
+    os.replace(tmpFile, markerFile)
+    return True
+
+
+def isPredictionComplete(key, outDir, structName):
+    '''Returns whether outDir holds the complete P2Rank outputs of the structure named structName for the
+    prediction key: marked as complete with that key and with the outputs unchanged since then'''
+    try:
+        with open(_getMarkerFile(outDir, structName)) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if marker.get('key') != key:
+        return False
+    for outFile, size in marker['files'].items():
+        outFile = os.path.join(outDir, outFile)
+        if not os.path.exists(outFile) or os.path.getsize(outFile) != size:
+            return False
+    return True
+
+
+class P2RankCache:
+    """ Shared directory of P2Rank outputs with size-bounded LRU eviction """
+    def __init__(self, cacheDir, maxSize):
+        '''maxSize: maximum size of the cache in MB'''
+        self.cacheDir = cacheDir
+        self.maxSize = int(float(maxSize) * 1024 ** 2)
+        self.lockFile = os.path.join(cacheDir, '.lock')
+        self.sizeFile = os.path.join(cacheDir, SIZE_FILE)
+
+    def _getEntryDir(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key, outDir, structName, structFile=None):
+        '''Restores the cached P2Rank outputs for the structure named structName into outDir.
+        If structFile is given, it is copied as the structure used by the P2Rank visualization.
+        The entry is read under a shared lock, so it is not evicted meanwhile, and the copies are checked against
+        the sizes recorded when it was stored. Returns whether the entry was found and restored'''
+        entryDir = self._getEntryDir(key)
+        if not os.path.exists(os.path.join(entryDir, META_FILE)):
+            return False
+
+        with self._lock(shared=True):
+            meta = self._readMeta(entryDir)
+            if meta is None:
+                return False
+            for cacheName, size in meta['files'].items():
+                cacheFile = os.path.join(entryDir, cacheName)
+                outFile = os.path.join(outDir, CACHED_FILES[cacheName].format(structName))
+                os.makedirs(os.path.dirname(outFile), exist_ok=True)
+                if cacheName == 'scene.pml':
+                    # The visualization script refers to the structure by the name it had when it was cached
+                    with open(cacheFile, 'rb') as f:
+                        scene = f.read()
+                    if len(scene) != size:
+                        return False
+                    with open(outFile, 'wb') as f:
+                        f.write(scene.replace(meta['structName'].encode(), structName.encode()))
+                else:
+                    shutil.copy(cacheFile, outFile)
+                    if os.path.getsize(outFile) != size:
+                        return False
+
+            if structFile is not None:
+                dataDir = os.path.join(outDir, 'visualizations', 'data')
+                os.makedirs(dataDir, exist_ok=True)
+                shutil.copy(structFile, os.path.join(dataDir, structName))
+
+            os.utime(entryDir)  # Mark as recently used
+        return True
+
+    def store(self, key, outDir, structName):
+        '''Stores the P2Rank outputs of the structure named structName found in outDir'''
+        entryDir = self._getEntryDir(key)
+        if self._readMeta(entryDir) is not None:
+            return
+
+        os.makedirs(os.path.dirname(entryDir), exist_ok=True)
+        tmpDir = tempfile.mkdtemp(dir=os.path.dirname(entryDir), prefix='.tmp_')
+        files = {}
+        for cacheName, outName in CACHED_FILES.items():
+            outFile = os.path.join(outDir, outName.format(structName))
+            if os.path.exists(outFile):
+                shutil.copy(outFile, os.path.join(tmpDir, cacheName))
+                files[cacheName] = os.path.getsize(os.path.join(tmpDir, cacheName))
+        with open(os.path.join(tmpDir, META_FILE), 'w') as f:
+            json.dump({'structName': structName, 'size': sum(files.values()), 'files': files,
+                       'created': time.time()}, f)
+
+        with self._lock():
+            if self._readMeta(entryDir) is not None:
+                shutil.rmtree(tmpDir)
+                return
+            # Incomplete entries are replaced
+            shutil.rmtree(entryDir, ignore_errors=True)
+            os.rename(tmpDir, entryDir)
+
+            totalSize = self._readTotalSize()
+            if totalSize is None or totalSize + sum(files.values()) > self.maxSize:
+                self._evict()
+            else:
+                self._writeTotalSize(totalSize + sum(files.values()))
+
+    def _readMeta(self, entryDir):
+        '''Returns the metadata of the entry, or None if it does not exist or misses any required output'''
+        try:
+            with open(os.path.join(entryDir, META_FILE)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        files = meta.get('files', {})
+        return meta if all(cacheName in files for cacheName in REQUIRED_FILES) else None
+
+    def _lock(self, shared=False):
+        '''Exclusive lock to add and evict entries, or shared one to read them'''
+        os.makedirs(self.cacheDir, exist_ok=True)
+        return _FileLock(self.lockFile, shared)
+
+    def _readTotalSize(self):
+        '''Returns the total size of the entries recorded in the index, or None if there is no valid index'''
+        try:
+            with open(self.sizeFile) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _writeTotalSize(self, totalSize):
+        tmpFile = '{}.{}.tmp'.format(self.sizeFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            f.write(str(totalSize))
+        os.replace(tmpFile, self.sizeFile)
+
+    def _evict(self):
+        '''Removes the least recently used entries until the cache fits in EVICT_TARGET of its maximum size,
+        recording the size left in the index'''
+        entries, totalSize = [], 0
+        for prefix in os.listdir(self.cacheDir):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            if not os.path.isdir(prefixDir):
+                continue
+            for key in os.listdir(prefixDir):
+                entryDir = os.path.join(prefixDir, key)
+                try:
+                    with open(os.path.join(entryDir, META_FILE)) as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(entryDir), size, entryDir))
+                except (OSError, ValueError, KeyError):
+                    continue
+                totalSize += size
+
+        if totalSize > self.maxSize:
+            for _, size, entryDir in sorted(entries):
+                if totalSize <= self.maxSize * EVICT_TARGET:
+                    break
+                shutil.rmtree(entryDir, ignore_errors=True)
+                totalSize -= size
+        self._writeTotalSize(totalSize)
+
+
+class _FileLock:
+    def __init__(self, lockFile, shared=False):
+        self.lockFile = lockFile
+        self.shared = shared
+
+    def __enter__(self):
+        self._f = open(self.lockFile, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
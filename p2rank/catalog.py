@@ -0,0 +1,166 @@
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Catalog of the P2Rank predictions of a project (or of several ones, P2RANK_CATALOG) in a single indexed SQLite
+database. The output step of the protocol adds the pockets and per-residue predictions of each structure, so the
+pockets of all the runs can be selected by their properties or residues without reading the run files.
+"""
+import os, time, sqlite3
+from contextlib import closing
+
+SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS structures (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, hash TEXT NOT NULL, structure_file TEXT, run TEXT NOT NULL,
+    protocol_id INTEGER, created REAL);
+CREATE TABLE IF NOT EXISTS pockets (
+    id INTEGER PRIMARY KEY, structure INTEGER NOT NULL REFERENCES structures(id) ON DELETE CASCADE,
+    rank INTEGER NOT NULL, score REAL, probability REAL, center_x REAL, center_y REAL, center_z REAL,
+    volume REAL, surface_area REAL, buriedness REAL, pocket_file TEXT, points_store TEXT, props_file TEXT);
+CREATE TABLE IF NOT EXISTS residues (
+    structure INTEGER NOT NULL REFERENCES structures(id) ON DELETE CASCADE, chain TEXT, residue TEXT,
+    residue_name TEXT, pocket INTEGER, score REAL, probability REAL);
+CREATE UNIQUE INDEX IF NOT EXISTS structures_run ON structures(run, name);
+CREATE INDEX IF NOT EXISTS structures_hash ON structures(hash);
+CREATE INDEX IF NOT EXISTS pockets_structure ON pockets(structure, rank);
+CREATE INDEX IF NOT EXISTS pockets_probability ON pockets(probability);
+CREATE INDEX IF NOT EXISTS pockets_score ON pockets(score);
+CREATE INDEX IF NOT EXISTS residues_residue ON residues(chain, residue, probability);
+CREATE INDEX IF NOT EXISTS residues_pocket ON residues(structure, pocket);
+'''
+
+POCKET_FIELDS = ['rank', 'score', 'probability', 'center_x', 'center_y', 'center_z', 'volume', 'surface_area',
+                 'buriedness', 'pocket_file', 'points_store', 'props_file']
+RESIDUE_FIELDS = ['chain', 'residue', 'residue_name', 'pocket', 'score', 'probability']
+
+
+class P2RankCatalog:
+    """ Indexed store of the pockets and residue predictions of the structures processed by P2Rank runs.
+    The structures are identified by their run and name, and their files by their content hash """
+    def __init__(self, dbFile, timeout=60):
+        '''timeout: seconds waiting for the catalog locked by other protocols'''
+        self.dbFile = dbFile
+        self.timeout = timeout
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.dbFile)), exist_ok=True)
+        conn = sqlite3.connect(self.dbFile, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(SCHEMA)
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    def addStructure(self, run, name, structHash, structFile, pockets, residues, protocolId=None):
+        '''Adds the predictions of a structure, replacing those added before by the same run.
+        pockets: dictionaries with the POCKET_FIELDS. residues: dictionaries with the RESIDUE_FIELDS, pocket being
+        the rank of the pocket of the residue (0 if none)'''
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM structures WHERE run = ? AND name = ?', (run, name))
+            structId = conn.execute('INSERT INTO structures (name, hash, structure_file, run, protocol_id, created) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)',
+                                    (name, structHash, structFile, run, protocolId, time.time())).lastrowid
+            conn.executemany('INSERT INTO pockets (structure, {}) VALUES (?{})'.
+                             format(', '.join(POCKET_FIELDS), ', ?' * len(POCKET_FIELDS)),
+                             [[structId] + [pocket.get(field) for field in POCKET_FIELDS] for pocket in pockets])
+            conn.executemany('INSERT INTO residues (structure, {}) VALUES (?{})'.
+                             format(', '.join(RESIDUE_FIELDS), ', ?' * len(RESIDUE_FIELDS)),
+                             [[structId] + [res.get(field) for field in RESIDUE_FIELDS] for res in residues])
+        return structId
+
+    def removeRun(self, run):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM structures WHERE run = ?', (run,))
+
+    def removeMissingRuns(self):
+        '''Removes the predictions of the runs whose directory no longer exists (deleted protocols).
+        Returns the runs removed'''
+        with closing(self._connect()) as conn:
+            runs = [row[0] for row in conn.execute('SELECT DISTINCT run FROM structures')]
+        missing = [run for run in runs if not os.path.exists(run)]
+        for run in missing:
+            self.removeRun(run)
+        return missing
+
+    def queryPockets(self, minScore=None, minProbability=None, maxRank=None, residues=None, residueName=None,
+                     minResidueProbability=None, structHash=None, run=None, limit=None):
+        '''Returns the pockets matching all the filters given, with the name, hash, file and run of their
+        structures, sorted by probability and score.
+        residues: list of (chain, residue label) lining the pocket, any of them. residueName and
+        minResidueProbability also filter by the residues lining the pocket'''
+        conds, args = [], []
+        for cond, value in [('p.score >= ?', minScore), ('p.probability >= ?', minProbability),
+                            ('p.rank <= ?', maxRank), ('s.hash = ?', structHash), ('s.run = ?', run)]:
+            if value is not None:
+                conds.append(cond)
+                args.append(value)
+
+        if residues or residueName or minResidueProbability is not None:
+            resConds = ['r.structure = p.structure', 'r.pocket = p.rank']
+            if residues:
+                resConds.append('({})'.format(' OR '.join(['(r.chain = ? AND r.residue = ?)'] * len(residues))))
+                args += [str(value) for res in residues for value in res]
+            if residueName:
+                resConds.append('r.residue_name = ?')
+                args.append(residueName)
+            if minResidueProbability is not None:
+                resConds.append('r.probability >= ?')
+                args.append(minResidueProbability)
+            conds.append('EXISTS (SELECT 1 FROM residues r WHERE {})'.format(' AND '.join(resConds)))
+
+        sql = 'SELECT s.name, s.hash, s.structure_file, s.run, {} FROM pockets p JOIN structures s ' \
+              'ON s.id = p.structure'.format(', '.join('p.' + field for field in POCKET_FIELDS))
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY p.probability DESC, p.score DESC'
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def queryResidues(self, chain=None, residue=None, minProbability=None, inPocket=False):
+        '''Returns the residue predictions matching the filters, with the name and hash of their structures'''
+        conds, args = [], []
+        for cond, value in [('r.chain = ?', chain), ('r.residue = ?', residue),
+                            ('r.probability >= ?', minProbability)]:
+            if value is not None:
+                conds.append(cond)
+                args.append(value)
+        if inPocket:
+            conds.append('r.pocket > 0')
+
+        sql = 'SELECT s.name, s.hash, s.run, {} FROM residues r JOIN structures s ON s.id = r.structure'.\
+            format(', '.join('r.' + field for field in RESIDUE_FIELDS))
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def getCounts(self):
+        '''Returns the number of runs, structures and pockets in the catalog'''
+        with closing(self._connect()) as conn:
+            return dict(conn.execute('SELECT COUNT(DISTINCT run) AS runs, COUNT(*) AS structures, '
+                                     '(SELECT COUNT(*) FROM pockets) AS pockets FROM structures').fetchone())
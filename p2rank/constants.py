@@ -27,3 +27,57 @@
 
 
 
+# P2Rank java classpath (relative to the P2Rank home)
+P2RANK_CLASSPATH = ['bin/p2rank.jar', 'bin/lib/*']
+
+# Persistent P2Rank worker
+WORKER_DIR_VAR = 'P2RANK_WORKER_DIR'
+WORKER_IDLE_VAR = 'P2RANK_WORKER_IDLE'
+WORKER_IDLE_TIMEOUT = 600  # seconds without jobs before the worker shuts down
+WORKER_START_TIMEOUT = 120  # seconds waiting for a new worker to listen
+WORKER_CONNECT_TIMEOUT = 10  # seconds to connect to the worker
+WORKER_QUEUE_TIMEOUT = 1800  # seconds waiting for the worker to finish the commands it received before
+WORKER_READ_TIMEOUT = 1800  # seconds without output from a command before the worker is considered hung
+WORKER_STATUS_PREFIX = '__P2RANK_WORKER_EXIT__'
+WORKER_READY_PREFIX = '__P2RANK_WORKER_READY__'
+
+# Prediction cache
+CACHE_DIR_VAR = 'P2RANK_CACHE'
+CACHE_SIZE_VAR = 'P2RANK_CACHE_SIZE'
+CACHE_SIZE = 2048  # MB
+
+# Catalog of predictions. If P2RANK_CATALOG is not set, each project has its own catalog
+CATALOG_VAR = 'P2RANK_CATALOG'
+CATALOG_FILE = 'p2rank_catalog.sqlite'
+# Arguments that do not modify the P2Rank results, ignored when building the cache keys
+P2RANK_RUN_ARGS = ['-f', '-o', '-threads']
+
+# Storage of the pocket points
+POINTS_PDB, POINTS_STORE = 0, 1
+POINTS_STORAGE = ['PDB files', 'Compact store']
+
+# Structure formats read directly by P2Rank, without conversion (optionally gzipped)
+DIRECT_INPUT_EXTENSIONS = ['.pdb', '.ent', '.cif', '.mmcif']
+
+# Decimation of the pocket points in the viewer
+DECIMATION_NONE, DECIMATION_VOXEL, DECIMATION_HULL = 0, 1, 2
+DECIMATION_METHODS = ['None', 'Voxel grid', 'Centroid and hull']
+
+# JVM resources planning
+JAVA_OPTIONS_VAR = 'JDK_JAVA_OPTIONS'
+# Application class-data sharing archive of P2Rank, dumped at installation by a training prediction
+CDS_ARCHIVE = 'p2rank.jsa'
+CDS_TRAINING_STRUCTURE = 'test_data/1fbl.pdb'
+JVM_GC_AUTO, JVM_GC_G1, JVM_GC_PARALLEL, JVM_GC_SERIAL = 0, 1, 2, 3
+JVM_GCS = ['Auto', 'G1', 'Parallel', 'Serial']
+JVM_GC_OPTIONS = {JVM_GC_G1: '-XX:+UseG1GC', JVM_GC_PARALLEL: '-XX:+UseParallelGC', JVM_GC_SERIAL: '-XX:+UseSerialGC'}
+JVM_BASE_HEAP = 1024  # MB needed by P2Rank and its models
+JVM_HEAP_PER_ATOM = 0.025  # MB of heap for each atom of a structure processed at once
+JVM_MIN_HEAP = 512  # MB
+JVM_MAX_MEMORY_FRACTION = 0.8  # of the available host memory
+
+# Pocket descriptors
+VOLUME_HULL, VOLUME_GRID = 0, 1
+VOLUME_METHODS = ['Convex hull', 'Union of spheres grid']
+POCKET_POINT_RADIUS = 1.6  # A, P2Rank solvent probe radius, the pocket points being probe centers
+BURIEDNESS_RADIUS = 8.0  # A
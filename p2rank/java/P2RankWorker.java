@@ -0,0 +1,256 @@
+/* **************************************************************************
+ *
+ * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+ *
+ * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+ * 02111-1307  USA
+ *
+ *  All comments concerning this program package may be sent to the
+ *  e-mail address 'scipion@cnb.csic.es'
+ *
+ ************************************************************************** */
+
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.Field;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.lang.reflect.Modifier;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.nio.file.attribute.PosixFilePermissions;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
+import java.util.ArrayList;
+import java.util.LinkedHashMap;
+import java.util.LinkedHashSet;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+
+/**
+ * Persistent P2Rank worker. Keeps the JVM, the P2Rank classes and its loaded models resident and runs the
+ * prank commands received through a local socket, so consecutive predictions do not pay the start-up cost.
+ *
+ * Usage: java -cp <p2rank classpath> P2RankWorker.java <portFile> <idleSeconds>
+ *
+ * The worker serves a connection at a time and, when it takes one, sends a ready line. The client then sends the
+ * token of the worker and one command (program and arguments), one per line, ended by an empty line, so the
+ * clients waiting in the queue have not sent any command yet and can give up without leaving one behind. The command output is sent back and the connection is closed after a last status line with
+ * the exit code. The port, the random token and the process id are written to portFile, only readable by the
+ * user, and the connections without the token are closed without running anything.
+ * P2Rank keeps its parameters in a singleton and each command only overrides the ones it is given, so they are
+ * restored to their initial values before every command. The worker does not start if they cannot be restored.
+ */
+public class P2RankWorker {
+
+    static final String MAIN_CLASS = "cz.siret.prank.program.Main";
+    static final String PARAMS_CLASS = "cz.siret.prank.program.params.Params";
+    static final String STATUS_PREFIX = "__P2RANK_WORKER_EXIT__";
+    static final String READY_PREFIX = "__P2RANK_WORKER_READY__";
+    static final int REQUEST_TIMEOUT = 30000;  // ms to receive the command once connected
+
+    static class ExitTrappedException extends SecurityException {
+        final int status;
+
+        ExitTrappedException(int status) {
+            super("System.exit(" + status + ") trapped by P2Rank worker");
+            this.status = status;
+        }
+    }
+
+    /** Values of the fields of the P2Rank parameters singleton, taken before running any command */
+    static class ParamsSnapshot {
+        final Object params;
+        final Map<Field, Object> values = new LinkedHashMap<>();
+
+        ParamsSnapshot() throws ReflectiveOperationException {
+            Class<?> paramsClass = Class.forName(PARAMS_CLASS);
+            params = getInstance(paramsClass);
+            for (Class<?> c = paramsClass; c != null && c != Object.class; c = c.getSuperclass()) {
+                for (Field field : c.getDeclaredFields()) {
+                    if (Modifier.isStatic(field.getModifiers())) {
+                        continue;
+                    }
+                    field.setAccessible(true);
+                    values.put(field, copy(field.get(params)));
+                }
+            }
+        }
+
+        static Object getInstance(Class<?> paramsClass) throws ReflectiveOperationException {
+            for (String name : new String[]{"getInst", "getINSTANCE"}) {
+                try {
+                    return paramsClass.getMethod(name).invoke(null);
+                } catch (NoSuchMethodException e) {
+                    // Next accessor
+                }
+            }
+            Field field = paramsClass.getDeclaredField("INSTANCE");
+            field.setAccessible(true);
+            return field.get(null);
+        }
+
+        /** Copy of the mutable collections, so the changes made by a command do not reach the snapshot */
+        static Object copy(Object value) {
+            if (value instanceof List) {
+                return new ArrayList<>((List<?>) value);
+            } else if (value instanceof Set) {
+                return new LinkedHashSet<>((Set<?>) value);
+            } else if (value instanceof Map) {
+                return new LinkedHashMap<>((Map<?, ?>) value);
+            }
+            return value;
+        }
+
+        void restore() throws ReflectiveOperationException {
+            for (Map.Entry<Field, Object> entry : values.entrySet()) {
+                entry.getKey().set(params, copy(entry.getValue()));
+            }
+        }
+    }
+
+    @SuppressWarnings("removal")
+    static void installExitGuard() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitTrappedException(status);
+                }
+
+                @Override
+                public void checkPermission(java.security.Permission perm) {
+                }
+
+                @Override
+                public void checkPermission(java.security.Permission perm, Object context) {
+                }
+            });
+        } catch (UnsupportedOperationException | SecurityException e) {
+            System.err.println("P2Rank worker: exit guard not available, a System.exit in P2Rank will stop the worker");
+        }
+    }
+
+    static int runCommand(Method prankMain, ParamsSnapshot params, String[] args, OutputStream out) {
+        PrintStream stdout = System.out, stderr = System.err;
+        PrintStream jobOut = new PrintStream(out, true, StandardCharsets.UTF_8);
+        System.setOut(jobOut);
+        System.setErr(jobOut);
+        try {
+            params.restore();
+            prankMain.invoke(null, (Object) args);
+            return 0;
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (cause instanceof ExitTrappedException) {
+                return ((ExitTrappedException) cause).status;
+            }
+            cause.printStackTrace(jobOut);
+            return 1;
+        } catch (Exception e) {
+            e.printStackTrace(jobOut);
+            return 1;
+        } finally {
+            jobOut.flush();
+            System.setOut(stdout);
+            System.setErr(stderr);
+        }
+    }
+
+    static String newToken() {
+        byte[] bytes = new byte[32];
+        new SecureRandom().nextBytes(bytes);
+        StringBuilder token = new StringBuilder();
+        for (byte b : bytes) {
+            token.append(String.format("%02x", b));
+        }
+        return token.toString();
+    }
+
+    static void writePortFile(Path portFile, int port, String token) throws Exception {
+        Path tmpFile = portFile.resolveSibling(portFile.getFileName() + ".tmp");
+        Files.deleteIfExists(tmpFile);
+        Files.createFile(tmpFile, PosixFilePermissions.asFileAttribute(PosixFilePermissions.fromString("rw-------")));
+        String address = port + " " + token + " " + ProcessHandle.current().pid();
+        Files.write(tmpFile, address.getBytes(StandardCharsets.UTF_8));
+        Files.move(tmpFile, portFile, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+    }
+
+    static void serve(Socket client, Method prankMain, ParamsSnapshot params, String token) {
+        try (Socket socket = client) {
+            socket.setSoTimeout(REQUEST_TIMEOUT);
+            OutputStream out = socket.getOutputStream();
+            out.write((READY_PREFIX + "\n").getBytes(StandardCharsets.UTF_8));
+            out.flush();
+            BufferedReader in = new BufferedReader(new InputStreamReader(socket.getInputStream(), StandardCharsets.UTF_8));
+            String received = in.readLine();
+            if (received == null || !MessageDigest.isEqual(received.getBytes(StandardCharsets.UTF_8),
+                                                            token.getBytes(StandardCharsets.UTF_8))) {
+                System.err.println("P2Rank worker: connection without a valid token rejected");
+                return;
+            }
+            List<String> command = new ArrayList<>();
+            String line;
+            while ((line = in.readLine()) != null && !line.isEmpty()) {
+                command.add(line);
+            }
+            socket.setSoTimeout(0);
+            int status = runCommand(prankMain, params, command.toArray(new String[0]), out);
+            out.write(("\n" + STATUS_PREFIX + " " + status + "\n").getBytes(StandardCharsets.UTF_8));
+            out.flush();
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
+    }
+
+    public static void main(String[] argv) throws Exception {
+        Path portFile = Paths.get(argv[0]);
+        int idleSeconds = Integer.parseInt(argv[1]);
+        Method prankMain = Class.forName(MAIN_CLASS).getMethod("main", String[].class);
+        ParamsSnapshot params = new ParamsSnapshot();
+        String token = newToken();
+        installExitGuard();
+
+        try (ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress())) {
+            server.setSoTimeout(idleSeconds * 1000);
+            writePortFile(portFile, server.getLocalPort(), token);
+
+            while (true) {
+                Socket client;
+                try {
+                    client = server.accept();
+                } catch (SocketTimeoutException e) {
+                    break;  // idle shutdown
+                }
+                serve(client, prankMain, params, token);
+            }
+        } finally {
+            Files.deleteIfExists(portFile);
+        }
+        Runtime.getRuntime().halt(0);
+    }
+}
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, time, fcntl, resource
+from contextlib import contextmanager
+
+# Metrics added up when a phase is measured several times (e.g. once per structure)
+SUM_METRICS = ['wallTime', 'cpuTime', 'childrenCpuTime', 'readBytes', 'writtenBytes', 'calls']
+# Metrics keeping their maximum value
+MAX_METRICS = ['peakRSSMB', 'childrenMaxRSSMB']
+
+
+def _readProcIO():
+    '''Returns the bytes read and written by this process (Linux only, zeros elsewhere)'''
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io.get('rchar', 0), io.get('wchar', 0)
+
+
+def _getResources():
+    selfUsage, childUsage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    readBytes, writtenBytes = _readProcIO()
+    return {'wall': time.perf_counter(), 'cpu': selfUsage.ru_utime + selfUsage.ru_stime,
+            'childrenCpu': childUsage.ru_utime + childUsage.ru_stime,
+            # ru_maxrss in KB (Linux)
+            'peakRSS': selfUsage.ru_maxrss / 1024, 'childrenMaxRSS': childUsage.ru_maxrss / 1024,
+            'read': readBytes, 'written': writtenBytes}
+
+
+class PhaseMetrics:
+    """ Measures the phases of a protocol run (wall and CPU time, peak RSS, bytes read and written and the items
+    processed) and saves them in a json file, merged with the phases measured by other steps.
+    The CPU time and bytes are those of the protocol process (children CPU time apart), so phases measured at
+    the same time in parallel steps overlap.
+    The memory values are not limited to the phase: peakRSSMB is the peak of the protocol process since it
+    started and childrenMaxRSSMB the peak of the largest subprocess it waited for until the end of the phase,
+    which may have run in an earlier phase """
+    def __init__(self, metricsFile):
+        self.metricsFile = metricsFile
+
+    @contextmanager
+    def phase(self, name, **counts):
+        '''Measures the code in the context as the phase name. The yielded dictionary can be filled with the
+        number of items processed, which are added to the phase metrics.
+        A phase that raises an exception is also measured, counted in its failures'''
+        start, failed = _getResources(), True
+        try:
+            yield counts
+            failed = False
+        finally:
+            end = _getResources()
+            metrics = {'wallTime': end['wall'] - start['wall'], 'cpuTime': end['cpu'] - start['cpu'],
+                       'childrenCpuTime': end['childrenCpu'] - start['childrenCpu'],
+                       'readBytes': end['read'] - start['read'], 'writtenBytes': end['written'] - start['written'],
+                       'peakRSSMB': end['peakRSS'], 'childrenMaxRSSMB': end['childrenMaxRSS'], 'calls': 1}
+            metrics.update(counts)
+            if failed:
+                metrics['failures'] = 1
+            self.add(name, metrics)
+
+    def add(self, name, metrics):
+        '''Merges the metrics of a phase into the metrics file, under a lock'''
+        with open(self.metricsFile + '.lock', 'w') as fLock:
+            fcntl.flock(fLock, fcntl.LOCK_EX)
+            allMetrics = self.load()
+            phaseMetrics = allMetrics.setdefault(name, {})
+            for key, value in metrics.items():
+                if key in MAX_METRICS:
+                    phaseMetrics[key] = max(phaseMetrics.get(key, 0), value)
+                elif key in phaseMetrics and isinstance(value, (int, float)):
+                    phaseMetrics[key] += value
+                else:
+                    phaseMetrics[key] = value
+            tmpFile = '{}.{}.tmp'.format(self.metricsFile, os.getpid())
+            with open(tmpFile, 'w') as f:
+                json.dump(allMetrics, f, indent=2)
+            os.replace(tmpFile, self.metricsFile)
+
+    def load(self):
+        '''Returns the metrics saved: {phase: metrics}'''
+        if not os.path.exists(self.metricsFile):
+            return {}
+        with open(self.metricsFile) as f:
+            return json.load(f)
+
+    def clear(self):
+        if os.path.exists(self.metricsFile):
+            os.remove(self.metricsFile)
+
+    def getSummary(self):
+        '''Returns a line for each phase measured'''
+        lines = []
+        for name, metrics in self.load().items():
+            line = '{}: {:.2f} s wall, {:.2f} s CPU'.format(name, metrics['wallTime'],
+                                                            metrics['cpuTime'] + metrics['childrenCpuTime'])
+            if metrics.get('childrenCpuTime'):
+                line += ' ({:.2f} s in subprocesses, largest subprocess so far {:.0f} MB)'.format(
+                    metrics['childrenCpuTime'], metrics['childrenMaxRSSMB'])
+            line += ', {:.1f} MB read, {:.1f} MB written'.format(metrics['readBytes'] / 2 ** 20,
+                                                                 metrics['writtenBytes'] / 2 ** 20)
+            items = ['{} {}'.format(value, key) for key, value in metrics.items()
+                     if key not in SUM_METRICS + MAX_METRICS]
+            if items:
+                line += ', ' + ', '.join(items)
+            lines.append(line)
+        return lines
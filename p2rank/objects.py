@@ -27,3 +27,106 @@
 
 
 
+import os, json
+
+from pyworkflow.object import String, Integer, Float
+from pwchem.objects import StructROI
+
+
+class P2RankStructROI(StructROI):
+    """ Structural ROI predicted by P2Rank. Its points can be kept in the pocket store of the protocol
+    (a single file with the points of all the pockets) instead of its own pdb file, which is then
+    written only when it is requested """
+    def __init__(self, filename=None, proteinFile=None, extraFile=None, pClass='P2Rank',
+                 pointsStore=None, storeId=None, **kwargs):
+        self._pointsStore = String(pointsStore)
+        self._storeId = Integer(storeId)
+        self._probability = Float(kwargs.get('probability', None))
+        self._sasPoints = Integer(kwargs.get('sasPoints', None))
+        self._surfAtoms = Integer(kwargs.get('surfAtoms', None))
+        self._residueScores = String(kwargs.get('residueScores', None))
+        self._surfaceArea = Float(kwargs.get('surfaceArea', None))
+        self._buriedness = Float(kwargs.get('buriedness', None))
+        super().__init__(filename, proteinFile, extraFile, pClass, **kwargs)
+
+    def _setValue(self, attrName, value, attrClass=Float):
+        if hasattr(self, attrName):
+            getattr(self, attrName).set(value)
+        else:
+            setattr(self, attrName, attrClass(value))
+
+    def getProbability(self):
+        return self._probability.get()
+
+    def getResidueScores(self):
+        '''Returns the P2Rank predictions of the residues of the pocket as {chain_residue: [score, probability]}'''
+        return json.loads(self._residueScores.get()) if self._residueScores.get() else {}
+
+    def setP2RankProperties(self, props):
+        '''Sets the pocket properties from its P2Rank predictions (utils.P2RankPredictions.getPocket)'''
+        self._setValue('_score', props['score'])
+        self._probability.set(props.get('probability', None))
+        self._sasPoints.set(props.get('sas_points', None))
+        self._setValue('_nPoints', props.get('sas_points', None), Integer)
+        self._surfAtoms.set(props.get('surf_atoms', None))
+        if props.get('residue_ids'):
+            self._setValue('_contactResidues', '-'.join(props['residue_ids']), String)
+        if props.get('surf_atom_ids'):
+            self._setValue('_contactAtoms', '-'.join(props['surf_atom_ids']), String)
+        if props.get('residues'):
+            self._residueScores.set(json.dumps({'{}_{}'.format(res['chain'], res['residue_label']):
+                                                [res.get('score'), res.get('probability')]
+                                                for res in props['residues']}))
+
+    def getSurfaceArea(self):
+        return self._surfaceArea.get()
+
+    def getBuriedness(self):
+        '''Returns the mean number of protein atoms around the points of the pocket (utils.computePocketsDescriptors)'''
+        return self._buriedness.get()
+
+    def setDescriptors(self, descriptors):
+        '''Sets the volume, surface area and buriedness computed for all the pockets of a structure at once
+        (utils.computePocketsDescriptors)'''
+        self.setVolume(descriptors['volume'])
+        self._surfaceArea.set(descriptors['surfaceArea'])
+        self._buriedness.set(descriptors['buriedness'])
+
+    def getPocketVolume(self):
+        '''Returns the volume set by the protocol, computing it only for the pockets without it'''
+        volume = getattr(self, '_volume', None)
+        if volume is not None and volume.get() is not None:
+            return volume.get()
+        return super().getPocketVolume()
+
+    # ---------------------------- Pocket store ---------------------------------
+    def hasPointsStore(self):
+        return self._pointsStore.get() is not None
+
+    def getPointsStore(self):
+        from .utils import loadPocketStore
+        return loadPocketStore(self._pointsStore.get())
+
+    def getP2RankPoints(self):
+        return self.getPointsStore().getPocketPoints(self._storeId.get())
+
+    def getFileName(self):
+        '''Returns the pdb file of the ROI, writing it from the pocket store if it does not exist yet'''
+        fileName = super().getFileName()
+        if fileName and self.hasPointsStore() and not os.path.exists(fileName):
+            self.writePocketFile(fileName)
+        return fileName
+
+    def writePocketFile(self, fileName):
+        from .utils import formatPocketPoints
+        os.makedirs(os.path.dirname(os.path.abspath(fileName)), exist_ok=True)
+        tmpFile = '{}.{}.tmp'.format(fileName, os.getpid())
+        with open(tmpFile, 'w') as f:
+            f.write(formatPocketPoints(self.getP2RankPoints(), self._storeId.get()))
+        os.replace(tmpFile, fileName)
+        return fileName
+
+    def getPointsCoords(self):
+        if self.hasPointsStore():
+            return self.getP2RankPoints().coords.tolist()
+        return super().getPointsCoords()
@@ -5,4 +5,6 @@
 # **************************************************************************
 
 from .protocol_p2rank import P2RankFindPockets
+from .protocol_p2rank_rescore import P2RankRescorePockets
+from .protocol_p2rank_catalog import P2RankCatalogQuery
 
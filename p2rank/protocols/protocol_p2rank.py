@@ -30,19 +30,61 @@
 This protocol is used to perform a pocket search on a protein structure using the P2Rank software
 
 """
-import os, gzip, shutil
+import os, json, shutil
 
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
-from pyworkflow.object import String
+from pyworkflow.object import String, Integer
 from pwem.protocols import EMProtocol
-import pwem.convert as emconv
-from pwem.convert.atom_struct import toPdb
 
-from pwchem.objects import SetOfStructROIs, PredictStructROIsOutput, StructROI
-from pwchem.utils import writePDBLine, splitPDBLine, runOpenBabel
+from pwchem.objects import PredictStructROIsOutput
 
-from p2rank import Plugin
+from p2rank import Plugin, P2RANK_DIC
+from p2rank.constants import POINTS_PDB, POINTS_STORE, POINTS_STORAGE, DIRECT_INPUT_EXTENSIONS, JVM_GC_AUTO, \
+  JVM_GCS, VOLUME_HULL, VOLUME_GRID, VOLUME_METHODS, CACHE_DIR_VAR
+
+
+def computeStructurePockets(task):
+    '''Parses the P2Rank outputs of a structure, writes the files of its pockets and its protein with the pockets
+    as HETATM and computes the pockets descriptors, so the structures can be processed in worker processes.
+    task: dictionary made by P2RankFindPockets._getStructureTask.
+    Returns the P2Rank predictions, the ids of the output pockets, their files {pocketId: pocketFile}, the pocket
+    store file (None if the points are only in the pocket files) and their descriptors {pocketId: descriptors}'''
+    from p2rank.utils import parseP2RankPoints, groupPointsByPocket, selectPoints, writePocketStore, \
+      writePocketFiles, getPocketFile, writeHetatmFile, isCIFFile, P2RankPredictions, readStructureAtoms, \
+      computePocketsDescriptors
+    from p2rank.metrics import PhaseMetrics
+    inputFile, metrics = task['inputFile'], PhaseMetrics(task['metricsFile'])
+    with metrics.phase('resultsParsing') as counts:
+        predictions = P2RankPredictions(task['propsFile'], task['residuesFile'])
+        pocketIds = predictions.filterPockets(*task['filters'])
+
+        # Points parsed once, used for the pocket files or store and the HETATM file
+        points = parseP2RankPoints(task['pointsFile'])
+        pocketsPoints = {pocketId: selectPoints(points, idxs) for pocketId, idxs in
+                         groupPointsByPocket(points).items() if pocketId in pocketIds}
+        counts.update(points=len(points.coords), pockets=len(pocketIds))
+
+    with metrics.phase('pocketFiles'):
+        if task['storeFile']:
+            # Points kept in a single pocket store. The pdb files of the pockets are written when requested
+            storeFile = writePocketStore(task['storeFile'], pocketsPoints)
+            pocketFiles = {pocketId: getPocketFile(task['pocketsDir'], pocketId) for pocketId in pocketsPoints}
+        else:
+            storeFile, pocketFiles = None, writePocketFiles(task['pocketsDir'], pocketsPoints, task['pointsFile'])
+    pocketIds = [pocketId for pocketId in pocketIds if pocketId in pocketFiles]
+
+    # Volume, surface area and buriedness of all the pockets at once, from the parsed points
+    with metrics.phase('pocketDescriptors', pockets=len(pocketsPoints)):
+        proteinCoords = readStructureAtoms(inputFile)[4]
+        descriptors = computePocketsDescriptors(pocketsPoints, proteinCoords, task['volumeMethod'],
+                                                task['gridSpacing'])
+
+    with metrics.phase('hetatmFile'):
+        # The pockets are added to the protein atoms only for PDB proteins
+        writeHetatmFile(task['hetatmFile'], None if isCIFFile(inputFile) else inputFile,
+                        ((pocketId, pocketsPoints[pocketId]) for pocketId in pocketIds))
+    return predictions, pocketIds, pocketFiles, storeFile, descriptors
 
 
 class P2RankFindPockets(EMProtocol):
@@ -55,153 +97,926 @@ class P2RankFindPockets(EMProtocol):
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
         self.stepsExecutionMode = params.STEPS_PARALLEL
+        self.cacheHits, self.cacheMisses = Integer(), Integer()
+        self.inputMetadata = String()
+        self._parsedMetadata = (None, {})
+        self._inputNames = (None, [])
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         """ """
         form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('useBatch', params.BooleanParam, default=False,
+                      label='Predict on a set of structures: ',
+                      help='Predict the pockets of a whole set of atom structures with a single P2Rank execution. '
+                           'A P2Rank dataset file is written with all the structures and the threads are spread '
+                           'over them, avoiding a Java start-up and model loading per structure.\n'
+                           'One output set of structural ROIs is generated for each input structure.')
         form.addParam('inputAtomStruct', params.PointerParam,
                        pointerClass='AtomStruct', allowsNull=False,
-                       label="Input atom structure",
+                       label="Input atom structure", condition='not useBatch',
                        help='Select the atom structure to be fitted in the volume')
+        form.addParam('inputAtomStructs', params.PointerParam,
+                      pointerClass='SetOfAtomStructs', allowsNull=False,
+                      label="Input atom structures: ", condition='useBatch',
+                      help='Select the set of atom structures to search pockets on')
+        form.addParam('ensembleMode', params.BooleanParam, default=False, condition='not useBatch',
+                      label='Predict on each model: ',
+                      help='Treat the input structure as an ensemble (e.g. multi-model NMR or MD snapshots): each '
+                           'model is written as a frame and all of them are predicted with a single P2Rank '
+                           'execution. One output set of structural ROIs is generated for each frame.')
+        form.addParam('directInput', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                      label='Read structures directly: ',
+                      help='Pass the PDB and mmCIF files (also gzipped) to P2Rank as they are, linked instead of '
+                           'converted or copied to PDB. This skips the conversion and lifts the PDB format limits '
+                           '(62 chains and 99,999 atoms), so very large assemblies can be processed.\n'
+                           'Other formats are still converted to PDB.')
+
+        group = form.addGroup('Pocket tracking', condition='useBatch or ensembleMode')
+        group.addParam('trackPockets', params.BooleanParam, default=True, label='Track pockets across structures: ',
+                       help='Link the pockets of consecutive structures (frames) by the overlap of their residues. '
+                            'The links are written in pocketTracking.csv and the persistence and P2Rank score and '
+                            'probability statistics of each track in pocketTracks.csv')
+        group.addParam('trackingOverlap', params.FloatParam, default=0.3, condition='trackPockets',
+                       expertLevel=params.LEVEL_ADVANCED, label='Minimum residues overlap: ',
+                       help='Minimum overlap (Jaccard index, 0-1) between the residues of two pockets to link them')
+        group.addParam('trackingMaxGap', params.IntParam, default=0, condition='trackPockets',
+                       expertLevel=params.LEVEL_ADVANCED, label='Maximum gap (frames): ',
+                       help='Number of consecutive structures (frames) a pocket can be missing from and still be '
+                            'linked to its track when it appears again. Longer gaps start a new track')
+
+        group = form.addGroup('Pocket filtering')
+        group.addParam('maxPockets', params.IntParam, default=0, label='Maximum number of pockets: ',
+                       help='Keep only the best ranked pockets predicted for each structure (0 keeps all of them). '
+                            'The pockets are filtered before building them, so the discarded ones do not cost any '
+                            'processing nor space in the output.')
+        group.addParam('minScore', params.FloatParam, default=0.0, label='Minimum P2Rank score: ',
+                       help='Keep only the pockets with a P2Rank score over this value')
+        group.addParam('minProbability', params.FloatParam, default=0.0, label='Minimum P2Rank probability: ',
+                       help='Keep only the pockets with a P2Rank ligandability probability over this value (0-1)')
+
+        group = form.addGroup('Output')
+        group.addParam('headless', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Skip P2Rank visualizations: ',
+                       help='Do not let P2Rank copy the structures and generate the visualization proteins, keeping '
+                            'only the pocket points it writes. The PyMOL scene of the P2Rank viewer is generated from '
+                            'the stored results the first time it is requested. Recommended for screening.')
+        group.addParam('pointsStorage', params.EnumParam, default=POINTS_PDB, choices=POINTS_STORAGE,
+                       expertLevel=params.LEVEL_ADVANCED, label='Pocket points storage: ',
+                       help='How the points of the predicted pockets are stored.\n'
+                            '"PDB files": a pdb file is written for each pocket.\n'
+                            '"Compact store": the points of all the pockets are kept in a single file and the pdb '
+                            'file of each pocket is only written when it is requested. Recommended for structures '
+                            'yielding many pockets.')
+        group.addParam('volumeMethod', params.EnumParam, default=VOLUME_HULL, choices=VOLUME_METHODS,
+                       expertLevel=params.LEVEL_ADVANCED, label='Pocket volume method: ',
+                       help='How the volume and surface area of the pockets are computed from their points.\n'
+                            '"Convex hull": volume and area of the convex hull of the points. The pockets with too '
+                            'few or coplanar points get those of the union of spheres.\n'
+                            '"Union of spheres grid": volume and area of the union of the spheres of the P2Rank '
+                            'probe radius centered on the points, measured on a grid.\n'
+                            'The buriedness of the pockets (mean number of protein atoms closer than 8 A to their '
+                            'points) is also stored.')
+        group.addParam('gridSpacing', params.FloatParam, default=0.5, condition='volumeMethod==%d' % VOLUME_GRID,
+                       expertLevel=params.LEVEL_ADVANCED, label='Volume grid spacing (A): ',
+                       help='Spacing of the grid measuring the union of spheres. Smaller spacings are more '
+                            'accurate and slower')
+        group.addParam('mergeOutputs', params.BooleanParam, default=False, condition='useBatch or ensembleMode',
+                       label='Single output set: ',
+                       help='Gather the pockets of all the structures in a single output set of structural ROIs, '
+                            'instead of one set for each structure')
+
+        group = form.addGroup('Execution')
+        group.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Use prediction cache: ',
+                       help='Reuse the P2Rank results of a previous prediction on the same structure, with the same '
+                            'P2Rank version and parameters, from the shared P2Rank cache (P2RANK_CACHE). '
+                            'New predictions are stored in it.')
+        group.addParam('useWorker', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Use persistent P2Rank worker: ',
+                       help='Submit the prediction to a long-lived local P2Rank process that keeps Java and the '
+                            'P2Rank models loaded between runs, removing the start-up time of each execution. '
+                            'The worker is started when needed and stops after some idle time. If it cannot be '
+                            'used, P2Rank is executed normally. Sharded and distributed predictions, which run in '
+                            'parallel steps, do not use it.')
+        group.addParam('useCatalog', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Add to the predictions catalog: ',
+                       help='Add the output pockets and the residue predictions to the catalog of P2Rank '
+                            'predictions of the project (or the one set in P2RANK_CATALOG), where the pockets of '
+                            'all the runs can be selected with the "catalog query" protocol')
+        group.addParam('autoThreads', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Adapt P2Rank threads: ',
+                       help='Use at most the threads of the protocol, reduced to the number of structures, the '
+                            'available cores and the structures that fit at once in the available memory. '
+                            'If No, P2Rank uses exactly the threads of the protocol.')
+        group.addParam('jvmHeap', params.IntParam, default=0, expertLevel=params.LEVEL_ADVANCED,
+                       label='Java heap size (MB): ',
+                       help='Maximum heap of the P2Rank Java process (-Xmx). If 0, it is planned from the atoms of '
+                            'the structures processed at once, limited by the available memory. The chosen values '
+                            'are written in the run log.')
+        group.addParam('jvmGC', params.EnumParam, default=JVM_GC_AUTO, choices=JVM_GCS,
+                       expertLevel=params.LEVEL_ADVANCED, label='Java garbage collector: ',
+                       help='Garbage collector of the P2Rank Java process. "Auto" uses the Serial collector for '
+                            'small single threaded runs and G1 otherwise.')
+
+        group = form.addGroup('Distribution', condition='useBatch or ensembleMode')
+        group.addParam('distributed', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Distribute in partitions: ',
+                       help='Split the structures into partitions predicted by independent P2Rank executions, each '
+                            'in its own step. When the protocol is launched to a queue with "Use queue for steps", '
+                            'each partition is submitted as a queue job, so they spread over the cluster nodes; '
+                            'otherwise they run as parallel local processes. The failed structures are retried '
+                            'and the results of the partitions are merged for the outputs.\n'
+                            'The persistent P2Rank worker is not used by the partitions.')
+        group.addParam('structsPerPartition', params.IntParam, default=50, condition='distributed',
+                       expertLevel=params.LEVEL_ADVANCED, label='Structures per partition: ',
+                       help='Number of structures predicted by each P2Rank execution')
+        group.addParam('partitionRetries', params.IntParam, default=2, condition='distributed',
+                       expertLevel=params.LEVEL_ADVANCED, label='Retries of a partition: ',
+                       help='Times the structures of a partition without a complete prediction are submitted '
+                            'again. The structures still failing after the retries are left out of the outputs and '
+                            'listed in the summary.')
+
+        group = form.addGroup('Sharding', condition='not useBatch and not ensembleMode')
+        group.addParam('useSharding', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label='Predict by chain shards: ',
+                       help='Split very large assemblies into groups of chains predicted in parallel by independent '
+                            'P2Rank executions, bounding the memory of each of them. The pockets of the shards are '
+                            'merged into a single ranking, keeping once those predicted in several shards.')
+        group.addParam('chainsPerShard', params.IntParam, default=8, condition='useSharding',
+                       expertLevel=params.LEVEL_ADVANCED, label='Chains per shard: ',
+                       help='Number of chains in the core of each shard')
+        group.addParam('shardMargin', params.FloatParam, default=10.0, condition='useSharding',
+                       expertLevel=params.LEVEL_ADVANCED, label='Shard contact margin (A): ',
+                       help='The residues of other chains closer than this distance to the core chains of a shard '
+                            'are included in it, so the pockets at the interfaces between shards are preserved')
         form.addParallelSection(threads=4, mpi=1)
 
-    def _getP2RankArgs(self):
-      args = ['-f', os.path.abspath(self.pdbFile)]
-      args += ['-o', os.path.abspath(self._getExtraPath())]
-      args += ['-threads', self.numberOfThreads.get()]
+    def _getP2RankArgs(self, threads=None, dsFile=None, outDir=None):
+      if self._isMultiStructure():
+          args = [os.path.abspath(dsFile or self._getDatasetFile())]
+      else:
+          args = ['-f', os.path.abspath(self._getInputFile())]
+      args += ['-o', os.path.abspath(outDir or self._getExtraPath())]
+      args += ['-threads', threads or self.numberOfThreads.get()]
+      args += self._getP2RankParamArgs() + self._getP2RankVisArgs()
 
       return args
 
+    def _getP2RankParamArgs(self):
+      '''Returns the P2Rank arguments that modify the prediction results'''
+      return []
+
+    def _getP2RankVisArgs(self, headless=None):
+      '''Returns the P2Rank arguments for the visualizations output. The pocket points are always needed'''
+      headless = self.headless.get() if headless is None else headless
+      return ['-vis_copy_proteins', 0, '-vis_generate_proteins', 0] if headless else []
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         # Insert processing steps
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('P2RankStep')
-        self._insertFunctionStep('createOutputStep')
+        cStep = self._insertFunctionStep('convertInputStep')
+        if self._useSharding():
+            sStep = self._insertFunctionStep('splitShardsStep', prerequisites=[cStep])
+            pSteps = [self._insertFunctionStep('P2RankShardStep', shardId, prerequisites=[sStep])
+                      for shardId in range(self._getNumberOfShards())]
+            pStep = self._insertFunctionStep('mergeShardsStep', prerequisites=pSteps)
+        elif self._useDistribution():
+            pSteps = [self._insertFunctionStep('P2RankPartitionStep', partitionId, prerequisites=[cStep])
+                      for partitionId in range(len(self._getPartitions()))]
+            pStep = self._insertFunctionStep('mergePartitionsStep', prerequisites=pSteps)
+        else:
+            pStep = self._insertFunctionStep('P2RankStep', prerequisites=[cStep])
+        self._insertFunctionStep('createOutputStep', prerequisites=[pStep])
 
     def convertInputStep(self):
-      self.pdbFile = self._convertInputPDB()
+      from ..utils import linkFile
+      metrics = self._getMetrics()
+      metrics.clear()
+      with metrics.phase('conversion') as counts:
+          if self._isEnsemble():
+              counts['frames'] = len(self._getInputNames())
+              return self._convertEnsemble()
+
+          metadata = {}
+          for inpStruct, name in zip(self._getInputStructs(), self._getInputNames()):
+              if self._isDirectInput(inpStruct):
+                  inputFile = linkFile(inpStruct.getFileName(), self._getDirectInputFile(inpStruct, name))
+              else:
+                  inputFile = self._convertInputPDB(inpStruct, self._getPDBFile(name))
+              metadata[name] = dict(self._scanInputStruct(inpStruct), inputFile=os.path.abspath(inputFile))
+          counts.update(structures=len(metadata), atoms=sum(scan['atoms'] for scan in metadata.values()))
+      self.inputMetadata.set(json.dumps(metadata))
+      self._store(self.inputMetadata)
 
     def P2RankStep(self):
-        Plugin.runP2Rank(self, 'predict', args=self._getP2RankArgs(), cwd=self._getExtraPath())
+        cacheHits, cacheMisses, _ = self._predictStructures(self._getInputNames(), self._getExtraPath(),
+                                                            self._getDatasetFile(), useWorker=self.useWorker.get())
+        if self.useCache:
+            self.cacheHits.set(cacheHits)
+            self.cacheMisses.set(cacheMisses)
+            self._store(self.cacheHits, self.cacheMisses)
+
+    def P2RankPartitionStep(self, partitionId):
+        '''Predicts a partition of the structures in its own directory, retrying those without a complete
+        prediction, and writes the status of the partition'''
+        names, outDir = self._getPartitions()[partitionId], self._getPartitionDir(partitionId)
+        os.makedirs(outDir, exist_ok=True)
+        # A queued partition has the resources of its job, local ones share those of the protocol
+        nParallel = 1 if self.useQueueForSteps() else min(len(self._getPartitions()), self.numberOfThreads.get())
+        status = {'structures': names, 'attempts': 0, 'errors': [], 'cacheHits': 0, 'cacheMisses': 0}
+        pending = names
+        while pending and status['attempts'] <= self.partitionRetries.get():
+            status['attempts'] += 1
+            try:
+                cacheHits, cacheMisses, pending = self._predictStructures(
+                    pending, outDir, os.path.join(outDir, 'partition.ds'), useWorker=False,
+                    maxThreads=max(1, self.numberOfThreads.get() // nParallel), memoryShare=1 / nParallel)
+                status['cacheHits'] += cacheHits
+                status['cacheMisses'] += cacheMisses
+            except Exception as e:
+                # The completed predictions are kept by the next attempt
+                status['errors'].append(str(e))
+            if pending:
+                self.info('Partition {}, attempt {}: {} structures without a complete prediction'.
+                          format(partitionId + 1, status['attempts'], len(pending)))
+        status['failed'] = pending
+
+        with open(self._getPartitionStatusFile(partitionId), 'w') as f:
+            json.dump(status, f, indent=2)
+
+    def mergePartitionsStep(self):
+        '''Moves the predictions of the partitions to the protocol outputs directory, where they are read as
+        those of a single P2Rank execution, and gathers the status of the partitions'''
+        from ..cache import markPredictionComplete
+        statuses, failed = {}, []
+        with self._getMetrics().phase('partitionsMerge', partitions=len(self._getPartitions())):
+            for partitionId in range(len(self._getPartitions())):
+                with open(self._getPartitionStatusFile(partitionId)) as f:
+                    status = json.load(f)
+                statuses[partitionId + 1] = status
+                failed += status['failed']
+
+                outDir = self._getPartitionDir(partitionId)
+                for name in status['structures']:
+                    if name not in status['failed']:
+                        structName = self.getPdbInputStructName(name)
+                        self._movePredictionOutputs(outDir, self._getExtraPath(), structName)
+                        markPredictionComplete(self._getCacheKey(name), self._getExtraPath(), structName)
+
+        with open(self._getPartitionsStatusFile(), 'w') as f:
+            json.dump(statuses, f, indent=2)
+        if failed:
+            self.info('{} structures failed in all the attempts and are left out of the outputs: {}'.
+                      format(len(failed), ', '.join(failed)))
+        if self.useCache:
+            self.cacheHits.set(sum(status['cacheHits'] for status in statuses.values()))
+            self.cacheMisses.set(sum(status['cacheMisses'] for status in statuses.values()))
+            self._store(self.cacheHits, self.cacheMisses)
+
+    def _predictStructures(self, names, outDir, dsFile, useWorker=False, maxThreads=None, memoryShare=1.0):
+        '''Predicts the structures with P2Rank in outDir, reusing the complete predictions already there and
+        those in the cache. Returns the cache hits and misses and the structures without a complete prediction'''
+        from ..cache import isPredictionComplete, markPredictionComplete
+        metrics = self._getMetrics()
+        with metrics.phase('resumeCheck') as counts:
+            # Predictions completed by a previous execution of the step on the same inputs are kept
+            keys = {name: self._getCacheKey(name) for name in names}
+            names = [name for name in names if not isPredictionComplete(keys[name], outDir,
+                                                                         self.getPdbInputStructName(name))]
+            counts['reused'] = len(keys) - len(names)
+        if len(names) < len(keys):
+            self.info('{} P2Rank predictions reused from a previous execution'.format(len(keys) - len(names)))
+
+        cacheHits = 0
+        if self.useCache and names:
+            with metrics.phase('cacheLookup'):
+                cache, misses = Plugin.getCache(), []
+                for name in names:
+                    structName = self.getPdbInputStructName(name)
+                    try:
+                        hit = cache.fetch(keys[name], outDir, structName, self._getInputFile(name))
+                    except (OSError, ValueError) as e:
+                        # The cache is an optimization: its failures never stop the prediction
+                        self.warning('P2Rank cache lookup of {} failed, counted as a miss: {}'.format(name, e))
+                        hit = False
+                    if hit:
+                        markPredictionComplete(keys[name], outDir, structName)
+                    else:
+                        misses.append(name)
+            cacheHits, names = len(names) - len(misses), misses
+
+        incomplete = []
+        if names:
+            if self._isMultiStructure():
+                self._writeDatasetFile([self._getInputFile(name) for name in names], dsFile)
+            resources = self._planResources([self.getInputMetadata(name)['atoms'] for name in names],
+                                            maxThreads=maxThreads, memoryShare=memoryShare)
+            # Java start-up and model loading are measured within the prediction
+            with metrics.phase('prediction', structures=len(names)):
+                Plugin.runP2Rank(self, 'predict', args=self._getP2RankArgs(resources['threads'], dsFile, outDir),
+                                 cwd=outDir, useWorker=useWorker, javaOptions=resources['javaOptions'])
+
+            incomplete = [name for name in names if not markPredictionComplete(keys[name], outDir,
+                                                                                self.getPdbInputStructName(name))]
+            if self.useCache:
+                with metrics.phase('cacheStore'):
+                    for name in names:
+                        if name not in incomplete:
+                            try:
+                                cache.store(keys[name], outDir, self.getPdbInputStructName(name))
+                            except OSError as e:
+                                self.warning('P2Rank prediction of {} not stored in the cache: {}'.format(name, e))
+        return cacheHits, len(names), incomplete
+
+    def splitShardsStep(self):
+      '''Splits the input structure into groups of chains, each with the residues of the rest of chains in
+      contact with them'''
+      from ..utils import readStructureAtoms, getShardMask, writeStructureShard, getStructureExtension
+      inputFile = self._getInputFile()
+      header, lines, chains, residues, coords = readStructureAtoms(inputFile)
+      chainIds = list(dict.fromkeys(chains))
+      ext = getStructureExtension(inputFile).replace('.gz', '')
+
+      shards, nShards = [], self._getNumberOfShards()
+      shardSize = -(-len(chainIds) // nShards)
+      os.makedirs(self._getShardsDir(), exist_ok=True)
+      for shardId in range(nShards):
+          coreChains = chainIds[shardId * shardSize:(shardId + 1) * shardSize]
+          if not coreChains:
+              # Less chains in the P2Rank input than in the original structure (e.g. merged in the conversion)
+              shards.append({'file': None, 'chains': []})
+              continue
+          shardFile = os.path.join(self._getShardsDir(), 'shard_{}{}'.format(shardId + 1, ext))
+          mask = getShardMask(chains, residues, coords, coreChains, self.shardMargin.get())
+          writeStructureShard(shardFile, header, lines, mask)
+          shards.append({'file': os.path.abspath(shardFile), 'chains': coreChains, 'atoms': int(mask.sum())})
+
+      with open(self._getShardsFile(), 'w') as f:
+          json.dump(shards, f)
+
+    def P2RankShardStep(self, shardId):
+      from ..cache import getPredictionKey, isPredictionComplete, markPredictionComplete
+      shard = self._getShards()[shardId]
+      if not shard['chains']:
+          return
+      outDir, shardName = self._getShardOutputDir(shardId), os.path.basename(shard['file'])
+      key = getPredictionKey(shard['file'], P2RANK_DIC['version'], self._getP2RankParamArgs())
+      if isPredictionComplete(key, outDir, shardName):
+          self.info('P2Rank prediction of shard {} reused from a previous execution'.format(shardId + 1))
+          return
+      # The shards run in parallel, sharing the threads and memory
+      nShards = self._getNumberOfShards()
+      resources = self._planResources([shard['atoms']], maxThreads=max(1, self.numberOfThreads.get() // nShards),
+                                      memoryShare=1 / min(nShards, self.numberOfThreads.get()))
+      os.makedirs(outDir, exist_ok=True)
+      # Only the points of the shards are used, the scene of the merged prediction is generated on demand
+      args = ['-f', shard['file'], '-o', outDir, '-threads', resources['threads']] + self._getP2RankParamArgs() + \
+             self._getP2RankVisArgs(headless=True)
+      # The parallel shards run their own P2Rank, with their planned resources: the worker serves a command at a time
+      with self._getMetrics().phase('prediction', shards=1):
+          Plugin.runP2Rank(self, 'predict', args=args, cwd=outDir, useWorker=False,
+                           javaOptions=resources['javaOptions'])
+      markPredictionComplete(key, outDir, shardName)
+
+    def mergeShardsStep(self):
+      '''Merges the predictions of the shards into the P2Rank output files of the whole structure'''
+      from ..utils import P2RankPredictions, parseP2RankPoints, mergeShardPredictions, writeP2RankPredictions, \
+        writeP2RankResidues, writeP2RankPoints
+      shardsPreds = []
+      for shardId, shard in enumerate(self._getShards()):
+          if not shard['chains']:
+              continue
+          outDir, shardName = self._getShardOutputDir(shardId), os.path.basename(shard['file'])
+          predictions = P2RankPredictions(os.path.join(outDir, shardName + '_predictions.csv'),
+                                          os.path.join(outDir, shardName + '_residues.csv'))
+          points = parseP2RankPoints(os.path.join(outDir, 'visualizations/data/{}_points.pdb.gz'.format(shardName)))
+          shardsPreds.append((shard['chains'], predictions, points))
+
+      with self._getMetrics().phase('shardsMerge', shards=len(shardsPreds)):
+          pockets, residues, points = mergeShardPredictions(shardsPreds)
+      writeP2RankPredictions(self.getPropertiesFile(), self.getPdbInputStructName(), pockets)
+      writeP2RankResidues(self.getResiduesFile(), residues)
+      os.makedirs(os.path.dirname(self.getPointsFile()), exist_ok=True)
+      writeP2RankPoints(self.getPointsFile(), points)
 
     def createOutputStep(self):
-        inpStruct = self.inputAtomStruct.get()
-        outASPath = os.path.relpath(self._getPDBFile())
-        pocketFiles = self._divideOutputPockets()
-
-        outPockets = SetOfStructROIs(filename=self._getExtraPath('StructROIs.sqlite'))
-        for pFile in pocketFiles:
-            pock = StructROI(pFile, outASPath, self.getPropertiesFile(), pClass='P2Rank')
-            if len(pock.getPointsCoords()) > 2: #minimum size for building pocket. cannot calculate volume otherwise
-                pock.setVolume(pock.getPocketVolume())
+        # Structures failed in a distributed prediction are left out
+        failed = set(self._getFailedNames())
+        structs = [(i, inpStruct, name) for i, (inpStruct, name) in
+                   enumerate(zip(self._getInputStructs(), self._getInputNames())) if name not in failed]
+
+        if self._isMultiStructure() and self.mergeOutputs.get():
+            self._defineOutputPockets(self._possibleOutputs.outputStructROIs.name,
+                                      self._getExtraPath('StructROIs.sqlite'),
+                                      [(inpStruct, name) for _, inpStruct, name in structs])
+        else:
+            # The outputs are defined one by one, so only a set is held in memory
+            for i, inpStruct, name in structs:
+                if self._isMultiStructure():
+                    outName = '{}_{}'.format(self._possibleOutputs.outputStructROIs.name, i + 1)
+                    setFile = self._getExtraPath('StructROIs_{}.sqlite'.format(name))
+                else:
+                    outName = self._possibleOutputs.outputStructROIs.name
+                    setFile = self._getExtraPath('StructROIs.sqlite')
+                self._defineOutputPockets(outName, setFile, [(inpStruct, name)])
+
+        if self._isMultiStructure() and self.trackPockets.get():
+            names = [name for _, _, name in structs]
+            with self._getMetrics().phase('tracking', structures=len(names)):
+                self._trackPockets(names)
+
+    def _defineOutputPockets(self, outName, setFile, structs):
+        '''Defines the output outName with the pockets of the structures [(inpStruct, name)], unless it was
+        already defined by a previous execution of the step'''
+        if getattr(self, outName, None) is not None and os.path.exists(setFile):
+            return
+        outPockets = self._createOutputPockets(structs, setFile)
+        self._defineOutputs(**{outName: outPockets})
+        self._defineSourceRelation(self._getInputPointer(), outPockets)
+        outPockets.close()
+
+    def _trackPockets(self, names):
+        '''Links the pockets of the consecutive structures by their residues, reading the predictions of a
+        structure at a time'''
+        import csv
+        from ..utils import P2RankPredictions, PocketTracker
+        tracker = PocketTracker(self.trackingOverlap.get(), self.trackingMaxGap.get())
+        with open(self._getTrackingFile(), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'name', 'rank', 'track', 'overlap', 'score', 'probability'])
+            for frame, name in enumerate(names, 1):
+                predictions = P2RankPredictions(self.getPropertiesFile(name))
+                pockets = {rank: predictions.pockets[rank] for rank in
+                           predictions.filterPockets(self.maxPockets.get(), self.minScore.get(),
+                                                     self.minProbability.get())}
+                for rank, trackId, overlap in tracker.addFrame(pockets):
+                    writer.writerow([frame, name, rank, trackId, round(overlap, 4), pockets[rank]['score'],
+                                     pockets[rank].get('probability', '')])
+
+        summary = tracker.getTracksSummary()
+        with open(self._getTracksFile(), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()) if summary else ['track'])
+            writer.writeheader()
+            writer.writerows(summary)
+
+    def _createOutputPockets(self, structs, setFile):
+        '''Creates the output set with the pockets of the structures [(inpStruct, name)]. The pockets of several
+        structures are numbered along the set.
+        The outputs of the structures are processed in a pool of numberOfThreads processes (see
+        computeStructurePockets) and their pockets added to the set in the input order'''
+        import multiprocessing
+        from pwchem.objects import SetOfStructROIs
+        tasks = [self._getStructureTask(name) for _, name in structs]
+        nProcs = min(self.numberOfThreads.get(), len(tasks))
+        # Created before opening the output set, so the workers do not inherit its connection
+        pool = multiprocessing.Pool(nProcs) if nProcs > 1 else None
+        try:
+            results = pool.imap(computeStructurePockets, tasks) if pool else map(computeStructurePockets, tasks)
+            # A set left by an interrupted execution would be appended to
+            if os.path.exists(setFile):
+                os.remove(setFile)
+            outPockets, metrics = SetOfStructROIs(filename=setFile), self._getMetrics()
+            for (inpStruct, name), result in zip(structs, results):
+                pockets, predictions = self._buildStructurePockets(inpStruct, name, result)
+                if self.useCatalog.get():
+                    with metrics.phase('catalog', structures=1):
+                        self._addToCatalog(name, pockets, predictions)
+
+                with metrics.phase('sqliteWriting'):
+                    if len(structs) > 1:
+                        for pock in pockets:
+                            pock.setObjId(None)
+                    self._writeOutputPockets(outPockets, pockets)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        if len(structs) == 1:
+            outPockets.setProteinHetatmFile(os.path.relpath(tasks[0]['hetatmFile']))
+        return outPockets
+
+    def _getStructureTask(self, name):
+        '''Returns the files and parameters computeStructurePockets needs to process the outputs of a structure'''
+        return {'inputFile': self._getInputFile(name), 'propsFile': self.getPropertiesFile(name),
+                'residuesFile': self.getResiduesFile(name), 'pointsFile': self.getPointsFile(name),
+                'filters': (self.maxPockets.get(), self.minScore.get(), self.minProbability.get()),
+                'pocketsDir': self._getPocketsDir(name),
+                'storeFile': self._getPocketStoreFile(name) if self.pointsStorage.get() == POINTS_STORE else None,
+                'volumeMethod': self.volumeMethod.get(), 'gridSpacing': self.gridSpacing.get(),
+                'hetatmFile': self._getExtraPath('{}_out.pdb'.format(name)), 'metricsFile': self._getMetricsFile()}
+
+    def _buildStructurePockets(self, inpStruct, name, result):
+        '''Builds the pockets predicted for a structure from its outputs processed by computeStructurePockets.
+        Returns the pockets and the P2Rank predictions'''
+        predictions, pocketIds, pocketFiles, storeFile, descriptors = result
+        outASPath = os.path.relpath(self._getInputFile(name))
+        propsFile, storeFile = self.getPropertiesFile(name), storeFile and os.path.relpath(storeFile)
+        with self._getMetrics().phase('pocketsBuilding') as counts:
+            tasks = [(pocketFiles[pocketId], outASPath, propsFile, storeFile, pocketId,
+                      predictions.getPocket(pocketId), descriptors[pocketId]) for pocketId in pocketIds]
+            pockets = self._buildPockets(tasks)
+            for pock in pockets:
                 if str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
                     pock._maeFile = String(inpStruct.getFileName())
-                outPockets.append(pock)
+            counts['pockets'] = len(pockets)
+        return pockets, predictions
+
+    def _addToCatalog(self, name, pockets, predictions):
+        '''Adds the output pockets of a structure and its residue predictions to the catalog'''
+        from ..cache import getFileHash
+        inputFile = self._getInputFile(name)
+        catalogPockets = []
+        for pock in pockets:
+            rank, props = pock.getObjId(), predictions.pockets[pock.getObjId()]
+            storeFile = pock._pointsStore.get()
+            catalogPockets.append({'rank': rank, 'score': props['score'], 'probability': props.get('probability'),
+                                   'center_x': props.get('center_x'), 'center_y': props.get('center_y'),
+                                   'center_z': props.get('center_z'), 'volume': pock.getPocketVolume(),
+                                   'surface_area': pock.getSurfaceArea(), 'buriedness': pock.getBuriedness(),
+                                   'pocket_file': os.path.abspath(self._getPocketFile(name, rank)),
+                                   'points_store': os.path.abspath(storeFile) if storeFile else None,
+                                   'props_file': os.path.abspath(self.getPropertiesFile(name))})
+        residues = [{'chain': res.get('chain'), 'residue': res.get('residue_label'),
+                     'residue_name': res.get('residue_name'), 'pocket': rank, 'score': res.get('score'),
+                     'probability': res.get('probability')}
+                    for rank, rankResidues in predictions.residues.items() for res in rankResidues]
+        Plugin.getCatalog(self).addStructure(os.path.abspath(self.getWorkingDir()), name, getFileHash(inputFile),
+                                             os.path.abspath(inputFile), catalogPockets, residues,
+                                             protocolId=self.getObjId())
 
-        outPockets.buildPDBhetatmFile()
-        self._defineOutputs(**{self._possibleOutputs.outputStructROIs.name: outPockets})
+    def _writeOutputPockets(self, outPockets, pockets):
+        '''Inserts all the pockets in the output set, committing them in a single transaction'''
+        for pock in pockets:
+            outPockets.append(pock)
+        outPockets.write()
 
+    def _buildPockets(self, tasks):
+        '''Builds the pockets of the tasks, keeping their order.
+        tasks: (pocket file, protein file, predictions file, pocket store file or None, pocket id, pocket
+        properties, pocket descriptors (utils.computePocketsDescriptors))'''
+        from ..objects import P2RankStructROI
+        pockets = []
+        for pFile, proteinFile, propsFile, storeFile, pocketId, props, descriptors in tasks:
+            pock = P2RankStructROI(proteinFile=proteinFile, extraFile=propsFile, pointsStore=storeFile,
+                                   storeId=pocketId)
+            pock.setFileName(pFile)
+            pock.setObjId(pocketId)
+            pock.setP2RankProperties(props)
+            pock.setDescriptors(descriptors)
+            pockets.append(pock)
+        return pockets
 
     # --------------------------- Utils functions --------------------
-    def _getInputName(self):
-        return os.path.splitext(os.path.basename(self.inputAtomStruct.get().getFileName()))[0]
+    def _getInputPointer(self):
+        return self.inputAtomStructs if self.useBatch else self.inputAtomStruct
+
+    def _getInputStructs(self):
+        '''Returns the list of input atom structures, either the single one (once per frame in ensemble mode)
+        or a copy of each one in the input set'''
+        if self.useBatch:
+            return [inpStruct.clone() for inpStruct in self.inputAtomStructs.get()]
+        elif self._isEnsemble():
+            return [self.inputAtomStruct.get()] * self._getNumberOfFrames()
+        return [self.inputAtomStruct.get()]
+
+    def _getInputName(self, inpStruct=None):
+        inpStruct = self.inputAtomStruct.get() if inpStruct is None else inpStruct
+        baseName = os.path.basename(inpStruct.getFileName())
+        if baseName.endswith('.gz'):
+            baseName = baseName[:-3]
+        return os.path.splitext(baseName)[0]
+
+    def _getInputNames(self):
+        '''Returns a unique name for each input structure (or frame), which names its files in the P2Rank output'''
+        if self._isEnsemble():
+            return ['{}_frame_{}'.format(self._getInputName(), i + 1) for i in range(self._getNumberOfFrames())]
+        elif not self.useBatch:
+            return [self._getInputName()]
+
+        # Named once per input set, iterating its structures without copying them
+        inputSet = self.inputAtomStructs.get()
+        key = (inputSet.getFileName(), inputSet.getSize())
+        if self._inputNames[0] != key:
+            names, seen = [], set()
+            for inpStruct in inputSet:
+                name = self._getInputName(inpStruct)
+                if name in seen:
+                    name = '{}_{}'.format(name, inpStruct.getObjId())
+                names.append(name)
+                seen.add(name)
+            self._inputNames = (key, names)
+        return list(self._inputNames[1])
+
+    def _getPDBFile(self, name=None):
+        name = self._getInputName() if name is None else name
+        return os.path.abspath(self._getExtraPath(name + '.pdb'))
+
+    def _isDirectInput(self, inpStruct):
+        '''Whether the structure file is passed to P2Rank without conversion'''
+        from ..utils import getStructureExtension
+        ext = getStructureExtension(inpStruct.getFileName()).lower()
+        if ext.endswith('.gz'):
+            ext = ext[:-3]
+        return self.directInput.get() and ext in DIRECT_INPUT_EXTENSIONS and \
+               str(type(inpStruct).__name__) != 'SchrodingerAtomStruct'
+
+    def _getDirectInputFile(self, inpStruct, name):
+        from ..utils import getStructureExtension
+        return os.path.abspath(self._getExtraPath(name + getStructureExtension(inpStruct.getFileName())))
 
-    def _getPDBFile(self):
-        return os.path.abspath(self._getExtraPath(self._getInputName() + '.pdb'))
+    def _getInputFile(self, name=None):
+        '''Returns the structure file read by P2Rank: the converted pdb or, for direct inputs, the link to the
+        original file'''
+        name = self._getInputName() if name is None else name
+        metadata = self.getInputMetadata(name)
+        if metadata and 'inputFile' in metadata:
+            return metadata['inputFile']
+        return self._getPDBFile(name)
 
-    def _convertInputPDB(self):
-      inpStruct = self.inputAtomStruct.get()
-      name, ext = os.path.splitext(inpStruct.getFileName())
+    def _getCacheKey(self, name):
+        from ..cache import getPredictionKey
+        return getPredictionKey(self._getInputFile(name), P2RANK_DIC['version'], self._getP2RankParamArgs())
+
+    def _isEnsemble(self):
+        return not self.useBatch and self.ensembleMode.get()
+
+    def _isMultiStructure(self):
+        '''Whether several structures (or frames) are predicted, each with its own output'''
+        return self.useBatch or self._isEnsemble()
+
+    def _getNumberOfFrames(self):
+        return self._scanInputStruct(self.inputAtomStruct.get())['models']
+
+    def _convertEnsemble(self):
+        '''Writes each model of the input structure as a frame file, streaming them'''
+        from ..utils import splitModels, scanStructureFile
+        inpStruct, names = self.inputAtomStruct.get(), self._getInputNames()
+        if self._isDirectInput(inpStruct):
+            ensembleFile = inpStruct.getFileName()
+        else:
+            ensembleFile = self._convertInputPDB(inpStruct, self._getPDBFile())
+        frameFiles = splitModels(ensembleFile, self._getExtraPath('{}_frame'.format(self._getInputName())))
+        if len(frameFiles) != len(names):
+            raise Exception('The number of models read from {} ({}) differs from the expected ({})'.
+                            format(ensembleFile, len(frameFiles), len(names)))
+
+        metadata = {name: dict(scanStructureFile(frameFile), inputFile=os.path.abspath(frameFile))
+                    for name, frameFile in zip(names, frameFiles)}
+        self.inputMetadata.set(json.dumps(metadata))
+        self._store(self.inputMetadata)
+
+    def _getTrackingFile(self):
+        return self._getExtraPath('pocketTracking.csv')
+
+    def _getTracksFile(self):
+        return self._getExtraPath('pocketTracks.csv')
+
+    def _useDistribution(self):
+        return self._isMultiStructure() and self.distributed.get()
+
+    def _getPartitions(self):
+        '''Returns the names of the structures of each partition of a distributed prediction'''
+        names, size = self._getInputNames(), max(1, self.structsPerPartition.get())
+        return [names[i:i + size] for i in range(0, len(names), size)]
+
+    def _getPartitionsDir(self):
+        return self._getExtraPath('partitions')
+
+    def _getPartitionDir(self, partitionId):
+        return os.path.join(self._getPartitionsDir(), 'partition_{}'.format(partitionId + 1))
+
+    def _getPartitionStatusFile(self, partitionId):
+        return os.path.join(self._getPartitionDir(partitionId), 'status.json')
+
+    def _getPartitionsStatusFile(self):
+        return os.path.join(self._getPartitionsDir(), 'status.json')
+
+    def _getFailedNames(self):
+        '''Returns the structures without a prediction after the retries of a distributed prediction'''
+        if not self._useDistribution() or not os.path.exists(self._getPartitionsStatusFile()):
+            return []
+        with open(self._getPartitionsStatusFile()) as f:
+            return [name for status in json.load(f).values() for name in status['failed']]
+
+    def _movePredictionOutputs(self, srcDir, dstDir, structName):
+        '''Moves the P2Rank outputs of the structure named structName from srcDir to dstDir'''
+        import glob
+        for pattern in ['{}_*', 'visualizations/{}*', 'visualizations/data/{}*']:
+            for srcFile in glob.glob(os.path.join(srcDir, pattern.format(glob.escape(structName)))):
+                dstFile = os.path.join(dstDir, os.path.relpath(srcFile, srcDir))
+                os.makedirs(os.path.dirname(dstFile), exist_ok=True)
+                os.replace(srcFile, dstFile)
+
+    def _useSharding(self):
+        return not self._isMultiStructure() and self.useSharding.get()
+
+    def _getNumberOfShards(self):
+        '''Number of shards of the input structure, from its number of chains'''
+        nChains = self._scanInputStruct(self.inputAtomStruct.get())['chains']
+        return max(1, -(-nChains // max(1, self.chainsPerShard.get())))
+
+    def _getShardsDir(self):
+        return self._getExtraPath('shards')
+
+    def _getShardsFile(self):
+        return os.path.join(self._getShardsDir(), 'shards.json')
+
+    def _getShards(self):
+        '''Returns the shards written by splitShardsStep: [{'file': shardFile, 'chains': core chains}]'''
+        with open(self._getShardsFile()) as f:
+            return json.load(f)
+
+    def _getShardOutputDir(self, shardId):
+        return os.path.join(self._getShardsDir(), 'shard_{}_output'.format(shardId + 1))
+
+    def _planResources(self, structsAtoms, maxThreads=None, memoryShare=1.0):
+      '''Plans the JVM heap, garbage collector and threads of a P2Rank execution on structures with those
+      numbers of atoms and writes them in the run log. memoryShare: fraction of the available memory for it'''
+      from ..utils import planP2RankResources, getHostResources
+      nCores, availableMB = getHostResources()
+      if availableMB:
+          availableMB = int(availableMB * memoryShare)
+      resources = planP2RankResources(structsAtoms, maxThreads or self.numberOfThreads.get(),
+                                      heapMB=self.jvmHeap.get(), gc=self.jvmGC.get(),
+                                      autoThreads=self.autoThreads.get(), host=(nCores, availableMB))
+      self.info('P2Rank resources: {} threads, {} MB heap, {} GC ({} structures, {} atoms in the largest one; '
+                '{} cores, {} MB of memory available)'.
+                format(resources['threads'], resources['heapMB'], JVM_GCS[resources['gc']], len(structsAtoms),
+                       max(structsAtoms, default=0), nCores, availableMB if availableMB else 'unknown'))
+      return resources
+
+    def _getMetrics(self):
+        from ..metrics import PhaseMetrics
+        return PhaseMetrics(self._getMetricsFile())
+
+    def _getMetricsFile(self):
+        return self._getExtraPath('p2rank_metrics.json')
+
+    def _getDatasetFile(self):
+        return self._getExtraPath('inputStructures.ds')
+
+    def _writeDatasetFile(self, pdbFiles, dsFile=None):
+        '''Writes a P2Rank dataset file listing the structure files (relative to the dataset file)'''
+        dsFile = dsFile or self._getDatasetFile()
+        with open(dsFile, 'w') as f:
+            for pdbFile in pdbFiles:
+                f.write(os.path.relpath(pdbFile, os.path.dirname(os.path.abspath(dsFile))) + '\n')
+        return dsFile
+
+    def _convertInputPDB(self, inpStruct=None, pdbFile=None):
+      inpStruct = self.inputAtomStruct.get() if inpStruct is None else inpStruct
+      pdbFile = self._getPDBFile(self._getInputName(inpStruct)) if pdbFile is None else pdbFile
+      inpFile = inpStruct.getFileName()
+      if inpFile.endswith('.gz'):
+          from ..utils import gunzipFile
+          inpFile = gunzipFile(inpFile, self._getTmpPath(os.path.basename(inpFile)[:-3]))
+      name, ext = os.path.splitext(inpFile)
       if ext == '.cif':
-          cifFile = inpStruct.getFileName()
-          toPdb(cifFile, self._getPDBFile())
+          from pwem.convert.atom_struct import toPdb
+          toPdb(inpFile, pdbFile)
 
       elif str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
-          inpStruct.convert2PDB(outPDB=self._getPDBFile())
+          # Reusing the conversion done during the validation
+          shutil.copy(self._getSchrodingerPDB(inpStruct), pdbFile)
 
       elif ext == '.pdbqt':
-          pdbFile = os.path.abspath(self._getPDBFile())
-          args = ' -ipdbqt {} -opdb -O {}'.format(os.path.abspath(inpStruct.getFileName()), pdbFile)
+          pdbFile = os.path.abspath(pdbFile)
+          args = ' -ipdbqt {} -opdb -O {}'.format(os.path.abspath(inpFile), pdbFile)
+          from pwchem.utils import runOpenBabel
           runOpenBabel(protocol=self, args=args, cwd=self._getExtraPath())
 
       else:
-          shutil.copy(inpStruct.getFileName(), self._getPDBFile())
-      return self._getPDBFile()
-
-    def getPdbInputStructName(self):
-      return self._getPDBFile().split('/')[-1]
-
-    def getPropertiesFile(self):
-        return self._getExtraPath(self.getPdbInputStructName()+'_predictions.csv')
-
-    def _divideOutputPockets(self):
-      '''Creates individiual pocket files'''
-      gzfile = self._getExtraPath('visualizations/data/{}_points.pdb.gz'.format(
-        self.getPdbInputStructName()))
-      pocketDic = self.getPocketDic(gzfile)
-
-      os.mkdir(self._getExtraPath('pocketFiles'))
-      pFiles = []
-      for pocketK in sorted(pocketDic):
-          pFile = self._getExtraPath('pocketFiles/pocketFile_{}.pdb'.format(pocketK))
-          with open(pFile, 'w') as f:
-              f.write(self.formatPocketStr(pocketDic[pocketK], pocketK))
-          pFiles.append(pFile)
-      return pFiles
-
-    def formatPocketStr(self, pocketLines, pocketK):
-      outStr=''
-      for i, pLine in enumerate(pocketLines):
-          pLine = self.splitP2RankPDBLine(pLine)
-          replacements = ['HETATM', str(i+1), 'APOL', 'STP', 'C', str(pocketK), *pLine[6:], '', 'Ve']
-          pdbLine = writePDBLine(replacements)
-          outStr += pdbLine
-      return outStr
-
-    def getPocketDic(self, pointsFile):
-      dic={}
-      with gzip.open(pointsFile) as f:
-        for line in f:
-          line = line.decode('utf-8')
-          splittedLine = self.splitP2RankPDBLine(line)
-          pocketId = int(splittedLine[5])
-          if pocketId != 0:
-            if pocketId in dic:
-              dic[pocketId] += [line]
-            else:
-              dic[pocketId] = [line]
-      return dic
-
-    def _countNumberOfChains(self, inpFile):
-      structureHandler = emconv.AtomicStructHandler()
-      structureHandler.read(inpFile)
-      structureHandler.getStructure()
-      listOfChains, listOfResidues = structureHandler.getModelsChains()
-      return len(listOfChains)
-
-    def _countNumberOfAtoms(self, inpFile):
-      with open(inpFile) as f:
-        fileStr = f.read()
-      return fileStr.count('ATOM')
-
-    def splitP2RankPDBLine(self, line):
-        '''Split lines taking into account the multiple exceptions found in P2Rank pdbs'''
-        lenElem = len(line.split())
-        if lenElem == 11:
-            return line.split()
-        else:
-            lenLine = len(line.strip())
-            #This happens when there are more than 9999 points (atom number collides with HETAM)
-            if lenLine != 66:
-                # This happens when the pocket number is higher than 99 (coordinates and later are displaced right)
-                line = line[:28] + line[29:]
-            return splitPDBLine(line)
+          shutil.copy(inpFile, pdbFile)
+      return pdbFile
+
+    def getPdbInputStructName(self, name=None):
+      return os.path.basename(self._getInputFile(name))
+
+    def getPropertiesFile(self, name=None):
+        return self._getExtraPath(self.getPdbInputStructName(name)+'_predictions.csv')
+
+    def getResiduesFile(self, name=None):
+        return self._getExtraPath(self.getPdbInputStructName(name)+'_residues.csv')
+
+    def getPointsFile(self, name=None):
+        return self._getExtraPath('visualizations/data/{}_points.pdb.gz'.format(self.getPdbInputStructName(name)))
+
+    def getPymolSceneFile(self, name=None):
+      '''Returns the PyMOL scene of the predictions: the one written by P2Rank or, if it is not available (headless
+      runs, merged shards), one generated from the stored results the first time it is requested'''
+      from ..utils import P2RankPredictions, writeP2RankPml
+      structName = self.getPdbInputStructName(name)
+      pmlFile = self._getExtraPath('visualizations', structName + '.pml')
+      if not self.headless.get() and not self._useSharding() and os.path.exists(pmlFile):
+          return os.path.abspath(pmlFile)
+
+      pmlFile = self._getExtraPath('visualizations', structName + '_scene.pml')
+      if not os.path.exists(pmlFile):
+          predictions = P2RankPredictions(self.getPropertiesFile(name))
+          writeP2RankPml(pmlFile, self._getInputFile(name), self.getPointsFile(name), predictions)
+      return os.path.abspath(pmlFile)
+
+    def getPymolLODSceneFile(self, name=None, topPockets=0, decimation=0, voxelSize=2.0, chunkSize=0):
+      '''Returns a light PyMOL scene of the predictions: only the best topPockets pockets (all if 0), their
+      points decimated and loaded by chunks of chunkSize pockets (see utils.writeP2RankLODPml)'''
+      from ..utils import P2RankPredictions, parseP2RankPoints, writeP2RankLODPml
+      structName = self.getPdbInputStructName(name)
+      lodDir = self._getExtraPath('visualizations', 'lod')
+      os.makedirs(lodDir, exist_ok=True)
+      pmlFile = os.path.join(lodDir, '{}_top{}_dec{}_{}_chunk{}.pml'.
+                             format(structName, topPockets, decimation, voxelSize, chunkSize))
+
+      predictions = P2RankPredictions(self.getPropertiesFile(name))
+      pocketIds = predictions.filterPockets(maxPockets=topPockets)
+      writeP2RankLODPml(pmlFile, self._getInputFile(name), parseP2RankPoints(self.getPointsFile(name)),
+                        predictions, pocketIds, decimation, voxelSize, chunkSize)
+      return os.path.abspath(pmlFile)
+
+    def _getPocketsDir(self, name=None):
+        if self._isMultiStructure():
+            return self._getExtraPath('pocketFiles', name)
+        return self._getExtraPath('pocketFiles')
+
+    def _getPocketFile(self, name, pocketId):
+        from ..utils import getPocketFile
+        return getPocketFile(self._getPocketsDir(name), pocketId)
+
+    def _getPocketStoreFile(self, name=None):
+        if self._isMultiStructure():
+            return self._getExtraPath('pocketPoints_{}.npz'.format(name))
+        return self._getExtraPath('pocketPoints.npz')
+
+    def _divideOutputPockets(self, name=None, pocketDic=None, pointsFile=None):
+      '''Creates individiual pocket files from {pocketId: P2RankPoints} (read from the P2Rank points file if not
+      given). Returns a dictionary {pocketId: pocketFile}.
+      The pocket files written after the points file by a previous call are kept, so it can be re-executed'''
+      from ..utils import parseP2RankPoints, groupPointsByPocket, selectPoints, writePocketFiles
+      if pocketDic is None:
+          pointsFile = self.getPointsFile(name)
+          points = parseP2RankPoints(pointsFile)
+          pocketDic = {pocketId: selectPoints(points, idxs) for pocketId, idxs in groupPointsByPocket(points).items()}
+      return writePocketFiles(self._getPocketsDir(name), pocketDic, pointsFile)
+
+    def _getScanDir(self):
+      '''Directory shared by the validation and the execution to keep the structure scans and conversions.
+      It is private to the user, inside the cache directory, as its files are trusted'''
+      from ..cache import makePrivateDir
+      return makePrivateDir(os.path.join(Plugin.getVar(CACHE_DIR_VAR), 'scans-{}'.format(os.getuid())))
+
+    def _getSchrodingerPDB(self, inpStruct):
+      '''Returns the pdb conversion of a Schrodinger structure, converting it only if it was not yet'''
+      from ..utils import getStructureKey
+      pdbFile = os.path.join(self._getScanDir(), getStructureKey(inpStruct.getFileName()) + '.pdb')
+      if not os.path.exists(pdbFile):
+          tmpFile = '{}.{}.pdb'.format(pdbFile[:-4], os.getpid())
+          inpStruct.convert2PDB(outPDB=tmpFile)
+          os.replace(tmpFile, pdbFile)
+      return pdbFile
+
+    def _scanInputStruct(self, inpStruct):
+      '''Returns the chain, residue and atom counts of an input structure, scanned in a single pass'''
+      from ..utils import scanStructureFile
+      inpFile = os.path.abspath(inpStruct.getFileName())
+      if str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
+          inpFile = self._getSchrodingerPDB(inpStruct)
+      return scanStructureFile(inpFile, self._getScanDir())
+
+    def getInputMetadata(self, name=None):
+      '''Returns the scan of the input structures made when converting them: {name: counts}, or the counts
+      of the structure with that name. It is parsed once per value, indexed by name'''
+      value = self.inputMetadata.get()
+      if self._parsedMetadata[0] != value:
+          self._parsedMetadata = (value, json.loads(value) if value else {})
+      metadata = self._parsedMetadata[1]
+      return metadata if name is None else metadata.get(name)
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
+        if self.useCache and self.cacheHits.get() is not None:
+            summary.append('P2Rank prediction cache: {} hits, {} misses'.
+                           format(self.cacheHits.get(), self.cacheMisses.get()))
+        metadata = self.getInputMetadata()
+        if len(metadata) > 10:
+            summary.append('{} input structures, {} atoms in total'.
+                           format(len(metadata), sum(scan['atoms'] for scan in metadata.values())))
+        else:
+            for name, scan in metadata.items():
+                summary.append('{}: {} chains, {} residues, {} atoms'.
+                               format(name, scan['chains'], scan['residues'], scan['atoms']))
+        if self._useDistribution() and os.path.exists(self._getPartitionsStatusFile()):
+            failed = self._getFailedNames()
+            summary.append('Distributed in {} partitions, {} failed structures{}'.
+                           format(len(self._getPartitions()), len(failed),
+                                  ': ' + ', '.join(failed) if failed else ''))
+        if os.path.exists(self._getMetricsFile()):
+            summary.append('Time and resources by phase (details in {}):'.format(self._getMetricsFile()))
+            summary += ['  ' + line for line in self._getMetrics().getSummary()]
+        if self._isMultiStructure() and self.trackPockets.get() and os.path.exists(self._getTracksFile()):
+            with open(self._getTracksFile()) as f:
+                nTracks = max(0, sum(1 for _ in f) - 1)
+            summary.append('{} pocket tracks across the structures, see {}'.format(nTracks, self._getTracksFile()))
         return summary
 
     def _methods(self):
@@ -211,21 +1026,49 @@ class P2RankFindPockets(EMProtocol):
     def validate(self):
         """ Try to find errors on define params. """
         errors = []
-        inpStruct = self.inputAtomStruct.get()
-        inpFile = os.path.abspath(inpStruct.getFileName())
+        if not self._getInputPointer().hasValue():
+            return ['An input atom structure must be selected']
+        try:
+            self._getScanDir()
+        except PermissionError as e:
+            return [str(e)]
+
+        for inpStruct in self._getInputStructs():
+            errors += self._validateInputStruct(inpStruct)
+
+        if self._useDistribution() and self.structsPerPartition.get() < 1:
+            errors.append('The number of structures per partition must be at least 1')
+        if self._useDistribution() and self.partitionRetries.get() < 0:
+            errors.append('The number of retries of a partition must be positive')
+        if self._isMultiStructure() and self.trackPockets and self.trackingMaxGap.get() < 0:
+            errors.append('The maximum tracking gap must be positive, or 0 to link only consecutive frames')
+        if self._useSharding() and self.chainsPerShard.get() < 1:
+            errors.append('The number of chains per shard must be at least 1')
+        if self.jvmHeap.get() < 0:
+            errors.append('The Java heap size must be positive, or 0 to plan it automatically')
+        if self.gridSpacing.get() <= 0:
+            errors.append('The volume grid spacing must be positive')
+        if self.maxPockets.get() < 0:
+            errors.append('The maximum number of pockets must be positive, or 0 to keep all of them')
+        if not 0 <= self.minProbability.get() <= 1:
+            errors.append('The minimum P2Rank probability must be between 0 and 1')
+        return errors
 
+    def _validateInputStruct(self, inpStruct):
+        errors = []
+        inpFile = os.path.abspath(inpStruct.getFileName())
         if str(type(inpStruct).__name__) == 'SchrodingerAtomStruct':
-            inpFile = inpStruct.convert2PDB()
+            inpFile = self._getSchrodingerPDB(inpStruct)
 
-        if not 'pdb' in inpFile:
-            nChains, nAtoms = self._countNumberOfChains(inpFile), self._countNumberOfAtoms(inpFile)
-            if nChains > 62:
+        if not 'pdb' in inpFile and not self._isDirectInput(inpStruct):
+            scan = self._scanInputStruct(inpStruct)
+            if scan['chains'] > 62:
               errors.append('The atom structure file {} is too big for converting to pdb, '
-                            'which is needed for running imodfit. Number of chains ({}) > 62'
-                            .format(inpFile.split('/')[-1], nChains))
-            elif nAtoms > 99999:
+                            'which is needed for running P2Rank. Number of chains ({}) > 62'
+                            .format(inpFile.split('/')[-1], scan['chains']))
+            elif scan['atoms'] > 99999:
               errors.append('The atom structure file {} is too big for converting to pdb, '
-                            'which is needed for running imodfit. Number of atoms ({}) > 99999'.
-                            format(inpFile.split('/')[-1], nAtoms))
+                            'which is needed for running P2Rank. Number of atoms ({}) > 99999'.
+                            format(inpFile.split('/')[-1], scan['atoms']))
 
         return errors
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+
+"""
+This protocol is used to select the pockets of the P2Rank runs stored in the catalog of predictions
+
+"""
+import os, csv
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from p2rank import Plugin
+
+
+class P2RankCatalogQuery(EMProtocol):
+    """
+    Selects the pockets predicted by the P2Rank runs of the project (or of all the projects sharing the catalog set
+    in P2RANK_CATALOG) by their P2Rank score and probability and the residues lining them, from the catalog of
+    predictions fed by the "find pockets" protocol, without reading the files of the runs.
+    """
+    _label = 'Catalog query'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ """
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('catalogFile', params.PathParam, default='', label='Catalog file: ',
+                      help='Catalog of P2Rank predictions to query. If empty, the one set in P2RANK_CATALOG or, '
+                           'if not set, the catalog of this project')
+
+        group = form.addGroup('Pocket filters')
+        group.addParam('minProbability', params.FloatParam, default=0.5, label='Minimum P2Rank probability: ',
+                       help='Select the pockets with a P2Rank ligandability probability over this value (0-1)')
+        group.addParam('minScore', params.FloatParam, default=0.0, label='Minimum P2Rank score: ',
+                       help='Select the pockets with a P2Rank score over this value')
+        group.addParam('maxRank', params.IntParam, default=0, label='Maximum pocket rank: ',
+                       help='Select only the best ranked pockets of each structure (0 does not filter by rank)')
+
+        group = form.addGroup('Residue filters')
+        group.addParam('residues', params.StringParam, default='', label='Lining residues: ',
+                       help='Select the pockets lined by any of these residues, as chain_residue separated by '
+                            'commas (e.g. A_45, A_112)')
+        group.addParam('residueName', params.StringParam, default='', expertLevel=params.LEVEL_ADVANCED,
+                       label='Lining residue name: ',
+                       help='Select the pockets lined by residues of this type (e.g. HIS)')
+        group.addParam('minResidueProbability', params.FloatParam, default=0.0, expertLevel=params.LEVEL_ADVANCED,
+                       label='Minimum residue probability: ',
+                       help='The lining residues must have a P2Rank probability over this value')
+
+        form.addParam('maxResults', params.IntParam, default=0, expertLevel=params.LEVEL_ADVANCED,
+                      label='Maximum number of pockets: ',
+                      help='Keep only the most probable pockets selected (0 keeps all of them)')
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('queryStep')
+        self._insertFunctionStep('createOutputStep')
+
+    def queryStep(self):
+        '''Writes the pockets selected from the catalog in a csv file'''
+        from ..catalog import POCKET_FIELDS
+        catalog = self._getCatalog()
+        removed = catalog.removeMissingRuns()
+        if removed:
+            self.info('Predictions of deleted runs removed from the catalog: {}'.format(', '.join(removed)))
+
+        rows = catalog.queryPockets(minScore=self.minScore.get(), minProbability=self.minProbability.get(),
+                                    maxRank=self.maxRank.get() or None, residues=self._getResidueFilters(),
+                                    residueName=self.residueName.get() or None,
+                                    minResidueProbability=self.minResidueProbability.get() or None,
+                                    limit=self.maxResults.get())
+        with open(self._getResultsFile(), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['name', 'hash', 'structure_file', 'run'] + POCKET_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def createOutputStep(self):
+        from pwchem.objects import SetOfStructROIs
+        from ..objects import P2RankStructROI
+        outPockets = SetOfStructROIs(filename=self._getPath('StructROIs.sqlite'))
+        skipped = 0
+        for row in self._readResults():
+            pocketFile, storeFile = row['pocket_file'], row['points_store'] or None
+            if not os.path.exists(storeFile or pocketFile):
+                skipped += 1
+                continue
+            pock = P2RankStructROI(proteinFile=row['structure_file'], extraFile=row['props_file'],
+                                   pointsStore=storeFile, storeId=int(row['rank']))
+            pock.setFileName(pocketFile)
+            pock.setP2RankProperties({'score': float(row['score']),
+                                      'probability': float(row['probability']) if row['probability'] else None})
+            pock.setDescriptors({key: float(row[field]) if row[field] else None for key, field in
+                                 [('volume', 'volume'), ('surfaceArea', 'surface_area'), ('buriedness', 'buriedness')]})
+            outPockets.append(pock)
+        if skipped:
+            self.info('{} pockets skipped, their files no longer exist'.format(skipped))
+
+        self._defineOutputs(outputStructROIs=outPockets)
+
+    # --------------------------- Utils functions --------------------
+    def _getCatalog(self):
+        if self.catalogFile.get():
+            from ..catalog import P2RankCatalog
+            return P2RankCatalog(self.catalogFile.get())
+        return Plugin.getCatalog(self)
+
+    def _getResidueFilters(self):
+        '''Returns the residues of the filter as [(chain, residue label)]'''
+        residues = [res.strip() for res in self.residues.get().split(',') if res.strip()]
+        return [tuple(res.split('_', 1)) for res in residues]
+
+    def _getResultsFile(self):
+        return self._getExtraPath('catalogQuery.csv')
+
+    def _readResults(self):
+        if not os.path.exists(self._getResultsFile()):
+            return []
+        with open(self._getResultsFile()) as f:
+            return list(csv.DictReader(f))
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        rows = self._readResults()
+        if rows:
+            summary.append('{} pockets selected from {} structures of {} runs (see {})'.
+                           format(len(rows), len({(row['run'], row['name']) for row in rows}),
+                                  len({row['run'] for row in rows}), self._getResultsFile()))
+        return summary
+
+    def _methods(self):
+        methods = []
+        return methods
+
+    def validate(self):
+        errors = []
+        if self.catalogFile.get() and not os.path.exists(self.catalogFile.get()):
+            errors.append('The catalog file {} does not exist'.format(self.catalogFile.get()))
+        if any(len(res) != 2 for res in self._getResidueFilters()):
+            errors.append('The lining residues must be given as chain_residue (e.g. A_45)')
+        if not 0 <= self.minProbability.get() <= 1:
+            errors.append('The minimum P2Rank probability must be between 0 and 1')
+        return errors
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+"""
+This protocol is used to rescore the pockets found by other methods using the P2Rank software
+
+"""
+import os, json, shutil
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pyworkflow.object import Float
+from pwem.protocols import EMProtocol
+
+from p2rank import Plugin
+
+
+class P2RankRescorePockets(EMProtocol):
+    """
+    Rescores the pockets of sets of structural ROIs predicted by other methods (e.g. fpocket) with the P2Rank model.
+    All the sets are rescored with a single P2Rank execution, much cheaper than a new prediction.
+    """
+    _label = 'Rescore pockets'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ """
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputStructROIsSets', params.MultiPointerParam, pointerClass='SetOfStructROIs',
+                      allowsNull=False, label='Input sets of structural ROIs: ',
+                      help='Sets of pockets to rescore with P2Rank. One output set is generated for each of them')
+        form.addParam('replaceScore', params.BooleanParam, default=True, label='Replace pocket scores: ',
+                      help='Set the P2Rank score as the score of the output pockets. The P2Rank score and '
+                           'probability are stored in any case in their own attributes (_p2rankScore, '
+                           '_p2rankProbability). The pockets without points are not rescored: they keep their '
+                           'score and their P2Rank attributes are empty')
+        form.addParam('contactDistance', params.FloatParam, default=4.0, expertLevel=params.LEVEL_ADVANCED,
+                      label='Pocket contact distance (A): ',
+                      help='Protein atoms closer than this distance to the pocket points are exported as the '
+                           'atoms lining the pocket')
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('exportPocketsStep')
+        self._insertFunctionStep('rescoreStep')
+        self._insertFunctionStep('createOutputStep')
+
+    def exportPocketsStep(self):
+        '''Exports each input set as a fpocket prediction of its protein and writes the P2Rank dataset file
+        listing them'''
+        import numpy as np
+        from ..utils import writeFPocketPrediction
+        exportDir = self._getExportDir()
+        os.makedirs(exportDir, exist_ok=True)
+        dsLines, centers = ['PARAM.PREDICTION_METHOD=fpocket', 'HEADER: prediction protein'], {}
+        for i, inSet in enumerate(self._getInputSets()):
+            name = self._getSetName(i)
+            proteinFile = self._exportProtein(inSet, name)
+            pocketsCoords = [pock.getPointsCoords() for pock in inSet]
+            predFile = writeFPocketPrediction(exportDir, name, proteinFile, pocketsCoords,
+                                              self.contactDistance.get())
+            # Pockets without points have no center and are not rescored
+            centers[name] = [np.mean(coords, axis=0).tolist() if len(coords) else None for coords in pocketsCoords]
+            dsLines.append('{}  {}'.format(os.path.relpath(predFile, exportDir),
+                                           os.path.relpath(proteinFile, exportDir)))
+
+        with open(self._getDatasetFile(), 'w') as f:
+            f.write('\n'.join(dsLines) + '\n')
+        with open(self._getCentersFile(), 'w') as f:
+            json.dump(centers, f)
+
+    def rescoreStep(self):
+        args = [os.path.abspath(self._getDatasetFile()), '-o', os.path.abspath(self._getRescoreDir()),
+                '-threads', self.numberOfThreads.get()]
+        Plugin.runP2Rank(self, 'rescore', args=args, cwd=self._getExtraPath())
+
+    def createOutputStep(self):
+        from pwchem.objects import SetOfStructROIs
+        from ..utils import P2RankPredictions, mapRescoredPockets
+        with open(self._getCentersFile()) as f:
+            centers = json.load(f)
+
+        inSets = self._getInputSets()
+        for i, inSet in enumerate(inSets):
+            name = self._getSetName(i)
+            rescored = mapRescoredPockets(P2RankPredictions(self._getRescoredFile(name)), centers[name])
+
+            outSet = SetOfStructROIs(filename=self._getExtraPath('StructROIs_{}.sqlite'.format(name)))
+            outSet.copyInfo(inSet)
+            for pocketId, pock in enumerate(inSet, 1):
+                # The pockets not rescored (without points or not found in the P2Rank output) keep their score
+                # and get no P2Rank score
+                newPock, props = pock.clone(), rescored.get(pocketId, {})
+                newPock._p2rankScore = Float(props.get('score'))
+                newPock._p2rankProbability = Float(props.get('probability'))
+                if self.replaceScore.get() and props:
+                    newPock._score = Float(props['score'])
+                outSet.append(newPock)
+
+            outName = 'outputStructROIs' if len(inSets) == 1 else 'outputStructROIs_{}'.format(i + 1)
+            self._defineOutputs(**{outName: outSet})
+            self._defineSourceRelation(self.inputStructROIsSets[i], outSet)
+
+    # --------------------------- Utils functions --------------------
+    def _getInputSets(self):
+        return [pointer.get() for pointer in self.inputStructROIsSets]
+
+    def _getSetName(self, i):
+        '''Unique name of the exported prediction of the i-th input set'''
+        return 'set{}'.format(i + 1)
+
+    def _exportProtein(self, inSet, name):
+        '''Writes the protein of a set of pockets as a pdb named after the set, so P2Rank names each output by it'''
+        from pwem.convert.atom_struct import toPdb
+        proteinFile = os.path.abspath(inSet.getProteinFile())
+        outFile = os.path.join(self._getExportDir(), '{}_protein.pdb'.format(name))
+        if os.path.splitext(proteinFile)[1] == '.cif':
+            toPdb(proteinFile, outFile)
+        else:
+            shutil.copy(proteinFile, outFile)
+        return outFile
+
+    def _getExportDir(self):
+        return self._getExtraPath('exportedPockets')
+
+    def _getRescoreDir(self):
+        return self._getExtraPath('rescore')
+
+    def _getDatasetFile(self):
+        return os.path.join(self._getExportDir(), 'rescore.ds')
+
+    def _getCentersFile(self):
+        return os.path.join(self._getExportDir(), 'pocketCenters.json')
+
+    def _getRescoredFile(self, name):
+        '''Returns the csv of the pockets of the exported set name rescored by P2Rank. It is named after the label
+        of the dataset item (its protein or prediction file) with the _rescored.csv suffix, or _predictions.csv in
+        the P2Rank versions before 2.4'''
+        candidates = [os.path.join(self._getRescoreDir(), label + suffix)
+                      for suffix in ['_rescored.csv', '_predictions.csv']
+                      for label in ['{}_protein.pdb'.format(name), '{}_out.pdb'.format(name)]]
+        for rescoredFile in candidates:
+            if os.path.exists(rescoredFile):
+                return rescoredFile
+        raise Exception('P2Rank rescore output of {} not found. Expected any of: {}'.
+                        format(name, ', '.join(map(os.path.basename, candidates))))
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        return summary
+
+    def _methods(self):
+        methods = []
+        return methods
+
+    def validate(self):
+        errors = []
+        for i, inSet in enumerate(self._getInputSets()):
+            if inSet is None or inSet.getSize() == 0:
+                errors.append('The input set of structural ROIs {} is empty'.format(i + 1))
+        return errors
@@ -0,0 +1,376 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, sys, gzip, json, time, random, shutil, tempfile, subprocess, tracemalloc, unittest
+
+from pyworkflow.tests import BaseTest, setupTestProject
+from pwem.protocols import ProtImportPdb
+
+from .. import Plugin, P2RANK_DIC
+from ..protocols import P2RankFindPockets
+from ..constants import VOLUME_HULL, VOLUME_GRID, CDS_TRAINING_STRUCTURE, JAVA_OPTIONS_VAR
+from ..utils import parseP2RankPoints, groupPointsByPocket, selectPoints, formatPocketPoints, \
+    computePocketsDescriptors
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+STUB_DIR = os.path.join(os.path.dirname(__file__), 'stub')
+# Plugin modules loaded on first use, which must never be imported with the plugin registration
+LAZY_MODULES = ['p2rank.utils', 'p2rank.cache', 'p2rank.worker', 'p2rank.metrics', 'p2rank.catalog']
+# Scipion packages extended by the plugin, and maximum number of modules the plugin registration may import on top
+# of them: its own protocols and viewers and a few standard ones. Loading the numerical, conversion or chemistry
+# stacks (numpy, scipy, pwem.convert, pwchem.utils) when those packages do not adds hundreds
+BASE_MODULES = ['pyworkflow.protocol', 'pyworkflow.object', 'pwem.protocols', 'pwchem.objects', 'pwchem.viewers']
+IMPORT_MODULES_BUDGET = 20
+# The measures are only reported, unless P2RANK_BENCH_CHECK=1 makes the benchmarks fail when they exceed their
+# baselines by a factor (P2RANK_BENCH_TOLERANCE), as timings depend on the machine and its load. With
+# P2RANK_BENCH_UPDATE=1 the measures are saved as the new baselines instead
+TOLERANCE = float(os.environ.get('P2RANK_BENCH_TOLERANCE', 3.0))
+CHECK_BASELINES = os.environ.get('P2RANK_BENCH_CHECK', '0') == '1'
+UPDATE_BASELINES = os.environ.get('P2RANK_BENCH_UPDATE', '0') == '1'
+
+
+def writeSyntheticPointsFile(pointsFile, nPoints, nPockets, seed=0):
+    '''Writes a gzipped points file in the P2Rank format. Over 9999 points the atom number merges with the
+    record name and pockets over 99 displace the coordinates one column right, as in P2Rank outputs'''
+    rand = random.Random(seed)
+    lines = []
+    for i in range(nPoints):
+        pocketId = rand.randint(0, nPockets)
+        x, y, z = (rand.uniform(-99, 99) for _ in range(3))
+        line = 'HETATM{:5d} H    STP A{:4d}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.3f}'.\
+            format(i + 1, pocketId, x, y, z, 0.5, rand.random())
+        if pocketId > 99:
+            line = line[:28] + ' ' + line[28:]
+        lines.append(line + '\n')
+
+    with gzip.open(pointsFile, 'wt') as f:
+        f.write(''.join(lines))
+    return pointsFile
+
+
+def writeSyntheticProtein(pdbFile, nResidues, nChains=4, seed=0):
+    '''Writes a pdb with nResidues CA-only residues along a random walk, split in nChains chains'''
+    rand = random.Random(seed)
+    x = y = z = 0.0
+    with open(pdbFile, 'w') as f:
+        for i in range(nResidues):
+            x, y, z = (coord + rand.uniform(-2.2, 2.2) for coord in (x, y, z))
+            chain = 'ABCDEFGHIJ'[i * nChains // nResidues]
+            f.write('ATOM  {:5d}  CA  ALA {}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C\n'.
+                    format(i + 1, chain, i % 9999 + 1, x, y, z))
+        f.write('END\n')
+    return pdbFile
+
+
+def legacySplitP2RankPDBLine(line):
+    '''Split lines taking into account the multiple exceptions found in P2Rank pdbs'''
+    lenElem = len(line.split())
+    if lenElem == 11:
+        return line.split()
+    else:
+        lenLine = len(line.strip())
+        #This happens when there are more than 9999 points (atom number collides with HETAM)
+        if lenLine != 66:
+            # This happens when the pocket number is higher than 99 (coordinates and later are displaced right)
+            line = line[:28] + line[29:]
+        from pwchem.utils import splitPDBLine
+        return splitPDBLine(line)
+
+
+def legacyGetPocketDic(pointsFile):
+    '''Line by line parsing of the points file previously used by P2RankFindPockets'''
+    dic = {}
+    with gzip.open(pointsFile) as f:
+        for line in f:
+            line = line.decode('utf-8')
+            splittedLine = legacySplitP2RankPDBLine(line)
+            pocketId = int(splittedLine[5])
+            if pocketId != 0:
+                if pocketId in dic:
+                    dic[pocketId] += [line]
+                else:
+                    dic[pocketId] = [line]
+    return dic
+
+
+def getPocketDic(pointsFile):
+    '''Returns a dictionary {pocketId: P2RankPoints} with the points of each pocket in the P2Rank points file'''
+    points = parseP2RankPoints(pointsFile)
+    return {pocketId: selectPoints(points, idxs) for pocketId, idxs in groupPointsByPocket(points).items()}
+
+
+def getImportTimes(modules):
+    '''Imports the modules in a new interpreter with -X importtime.
+    Returns the cumulative import time (s) of each module imported and the names of all of them'''
+    code = 'import sys, {}; print(" ".join(sys.modules))'.format(', '.join(modules))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    # import time: self [us] | cumulative | imported package
+    for line in proc.stderr.splitlines():
+        fields = line.split(':', 1)[-1].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 10 ** 6
+    return times, set(proc.stdout.split())
+
+
+class BenchmarkMixin:
+    """ Measures the time and peak Python memory of the benchmarks and compares them with the stored baselines """
+    measures = {}
+
+    @classmethod
+    def loadBaselines(cls):
+        with open(BASELINES_FILE) as f:
+            return json.load(f)
+
+    @classmethod
+    def saveMeasures(cls):
+        if UPDATE_BASELINES and cls.measures:
+            baselines = cls.loadBaselines()
+            baselines.update(cls.measures)
+            with open(BASELINES_FILE, 'w') as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+
+    def checkMeasure(self, name, seconds, memoryMB=None):
+        measure = {'time': round(seconds, 3)}
+        if memoryMB is not None:
+            measure['memoryMB'] = round(memoryMB, 1)
+        baseline = self.loadBaselines().get(name)
+        print('Benchmark {}: {} (baseline {})'.format(name, measure, baseline))
+        self.measures[name] = measure
+        if UPDATE_BASELINES or not CHECK_BASELINES or not baseline:
+            return
+
+        self.assertLessEqual(seconds, baseline['time'] * TOLERANCE,
+                             'Benchmark {} is slower than its baseline ({} s)'.format(name, baseline['time']))
+        if memoryMB is not None and 'memoryMB' in baseline:
+            self.assertLessEqual(memoryMB, baseline['memoryMB'] * TOLERANCE,
+                                 'Benchmark {} uses more memory than its baseline ({} MB)'.
+                                 format(name, baseline['memoryMB']))
+
+    def runBenchmark(self, name, func, *args):
+        '''Runs func(*args) measuring it as the benchmark name. Returns its result'''
+        tracemalloc.start()
+        try:
+            t0 = time.perf_counter()
+            result = func(*args)
+            seconds = time.perf_counter() - t0
+            peakMB = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+        self.checkMeasure(name, seconds, peakMB)
+        return result
+
+
+class TestPointsParsingBenchmark(BenchmarkMixin, unittest.TestCase):
+    nPoints, nPockets = 90000, 150
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.pointsFile = writeSyntheticPointsFile(os.path.join(cls.tmpDir, 'synth.pdb_points.pdb.gz'),
+                                                  cls.nPoints, cls.nPockets)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+        cls.saveMeasures()
+
+    def testPointsParsing(self):
+        legacyDic = self.runBenchmark('legacyPointsParsing', legacyGetPocketDic, self.pointsFile)
+        points = self.runBenchmark('pointsParsing', parseP2RankPoints, self.pointsFile)
+        pocketIdxs = groupPointsByPocket(points)
+
+        self.assertEqual(sorted(legacyDic), sorted(pocketIdxs))
+        for pocketId, lines in legacyDic.items():
+            legacyCoords = [[float(v) for v in legacySplitP2RankPDBLine(line)[6:9]]
+                            for line in lines]
+            self.assertEqual(legacyCoords, points.coords[pocketIdxs[pocketId]].tolist())
+
+
+class TestPostprocessingBenchmark(BenchmarkMixin, unittest.TestCase):
+    """ Benchmarks of the protocol functions processing the P2Rank points, without running P2Rank """
+    nPoints, nPockets = 90000, 150
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.pointsFile = writeSyntheticPointsFile(os.path.join(cls.tmpDir, 'synth.pdb_points.pdb.gz'),
+                                                  cls.nPoints, cls.nPockets)
+        cls.prot = P2RankFindPockets(workingDir=cls.tmpDir)
+        os.makedirs(cls.prot._getExtraPath(), exist_ok=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+        cls.saveMeasures()
+
+    def testSplitLines(self):
+        with gzip.open(self.pointsFile, 'rt') as f:
+            lines = f.readlines()
+        splitted = self.runBenchmark('splitP2RankPDBLine', lambda: [legacySplitP2RankPDBLine(line)
+                                                                    for line in lines])
+        self.assertEqual(len(splitted), self.nPoints)
+
+    def testGetPocketDic(self):
+        pocketDic = self.runBenchmark('getPocketDic', getPocketDic, self.pointsFile)
+        self.assertEqual(len(pocketDic), self.nPockets)
+
+    def testFormatPocketStr(self):
+        pocketDic = getPocketDic(self.pointsFile)
+        pocketStrs = self.runBenchmark('formatPocketStr', lambda: [formatPocketPoints(points, pocketK)
+                                                                   for pocketK, points in pocketDic.items()])
+        self.assertEqual(len(pocketStrs), self.nPockets)
+
+    def testDivideOutputPockets(self):
+        pocketDic = getPocketDic(self.pointsFile)
+        pocketFiles = self.runBenchmark('divideOutputPockets', self.prot._divideOutputPockets, 'synth', pocketDic)
+        self.assertEqual(len(pocketFiles), self.nPockets)
+        self.assertTrue(all(os.path.exists(pFile) for pFile in pocketFiles.values()))
+
+    def testPocketsDescriptors(self):
+        pocketDic = getPocketDic(self.pointsFile)
+        proteinCoords = parseP2RankPoints(self.pointsFile).coords
+        for method, name in [(VOLUME_HULL, 'hullDescriptors'), (VOLUME_GRID, 'gridDescriptors')]:
+            descriptors = self.runBenchmark(name, computePocketsDescriptors, pocketDic, proteinCoords, method)
+            self.assertEqual(sorted(descriptors), sorted(pocketDic))
+            self.assertTrue(all(desc['volume'] > 0 and desc['surfaceArea'] > 0 and desc['buriedness'] > 0
+                                for desc in descriptors.values()))
+
+
+class TestOutputStepBenchmark(BenchmarkMixin, BaseTest):
+    """ Benchmark of the output generation of the protocol on the results of the stub P2Rank (tests/stub/prank) """
+    nResidues, nPoints, nPockets = 5000, 20000, 120
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.pdbFile = writeSyntheticProtein(os.path.join(cls.tmpDir, 'synthProtein.pdb'), cls.nResidues)
+
+        # Read by the protocols when they run, in their own processes
+        cls.stubEnv = {P2RANK_DIC['home']: STUB_DIR, 'P2RANK_STUB_POINTS': str(cls.nPoints),
+                       'P2RANK_STUB_POCKETS': str(cls.nPockets)}
+        cls.oldEnv = {key: os.environ.get(key) for key in cls.stubEnv}
+        os.environ.update(cls.stubEnv)
+
+        protImportPDB = cls.newProtocol(ProtImportPdb, inputPdbData=1, pdbFile=cls.pdbFile)
+        cls.launchProtocol(protImportPDB)
+        cls.protImportPDB = protImportPDB
+
+    @classmethod
+    def tearDownClass(cls):
+        for key, value in cls.oldEnv.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(cls.tmpDir)
+        cls.saveMeasures()
+
+    def testCreateOutputStep(self):
+        protP2Rank = self.newProtocol(P2RankFindPockets, inputAtomStruct=self.protImportPDB.outputPdb,
+                                      useCache=False, numberOfThreads=1)
+        self.launchProtocol(protP2Rank)
+        self.assertIsNotNone(getattr(protP2Rank, 'outputStructROIs', None))
+
+        # Time of the output phases, measured by the protocol (p2rank_metrics.json)
+        with open(protP2Rank._getMetricsFile()) as f:
+            metrics = json.load(f)
+        outputPhases = ['resultsParsing', 'pocketFiles', 'pocketDescriptors', 'pocketsBuilding', 'sqliteWriting',
+                        'hetatmFile']
+        self.checkMeasure('createOutputStep', sum(metrics[phase]['wallTime'] for phase in outputPhases))
+
+
+class TestImportTimeBenchmark(BenchmarkMixin, unittest.TestCase):
+    """ Import time of the plugin registration (Plugin class, protocols and viewers), paid by every Scipion
+    start-up. The chemistry, conversion and numerical stacks must be loaded only when used """
+    def testImportTime(self):
+        times, modules = getImportTimes(['p2rank', 'p2rank.protocols', 'p2rank.viewers'])
+        self.checkMeasure('importPlugin', times['p2rank'])
+        self.checkMeasure('importProtocols', times['p2rank.protocols'])
+        self.checkMeasure('importViewers', times['p2rank.viewers'])
+
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules, 'Module {} imported with the plugin'.format(module))
+
+        _, baseModules = getImportTimes(BASE_MODULES)
+        pluginModules = sorted(modules - baseModules)
+        print('Benchmark importModules: {} modules over the Scipion packages (budget {})'.
+              format(len(pluginModules), IMPORT_MODULES_BUDGET))
+        self.assertLessEqual(len(pluginModules), IMPORT_MODULES_BUDGET,
+                             'Modules imported with the plugin over its budget: {}'.format(', '.join(pluginModules)))
+
+
+class TestStartupBenchmark(BenchmarkMixin, unittest.TestCase):
+    """ Start-up of P2Rank predictions on a small structure, loading the classes from the jars (cold) and from the
+    class-data sharing archive dumped at the installation. Needs P2Rank installed """
+    nRuns = 3
+    # Factor over the cold start-up allowed to the archived one, as both are close on small structures
+    timeMargin = 1.2
+
+    @classmethod
+    def setUpClass(cls):
+        cls.home = Plugin.getVar(P2RANK_DIC['home'])
+        cls.structFile = os.path.join(cls.home, CDS_TRAINING_STRUCTURE)
+        if not os.path.exists(os.path.join(cls.home, 'prank')) or not os.path.exists(cls.structFile):
+            raise unittest.SkipTest('P2Rank is not installed')
+        if Plugin.getCDSArchive() is None:
+            raise unittest.SkipTest('The P2Rank installation has no class-data sharing archive')
+        cls.tmpDir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+        cls.saveMeasures()
+
+    def runPrediction(self, environ):
+        '''Returns the best time of nRuns predictions of the training structure'''
+        times = []
+        for _ in range(self.nRuns):
+            t0 = time.perf_counter()
+            subprocess.run([os.path.join(self.home, 'prank'), 'predict', '-f', self.structFile, '-o', self.tmpDir,
+                            '-threads', '1'], cwd=self.home, env=environ, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    def testStartup(self):
+        # The archive is passed to the JVM of every P2Rank execution
+        archiveOption = '-XX:SharedArchiveFile={}'.format(Plugin.getCDSArchive())
+        self.assertGreater(os.path.getsize(Plugin.getCDSArchive()), 0)
+        self.assertIn(archiveOption, Plugin.getEnviron()[JAVA_OPTIONS_VAR].split())
+
+        environ = dict(os.environ)
+        environ.pop(JAVA_OPTIONS_VAR, None)
+        coldTime = self.runPrediction(environ)
+        archivedTime = self.runPrediction(Plugin.getEnviron())
+        self.checkMeasure('coldStartup', coldTime)
+        self.checkMeasure('archivedStartup', archivedTime)
+        print('Class-data sharing speed-up: {:.2f}x'.format(coldTime / archivedTime))
+        if CHECK_BASELINES:
+            self.assertLessEqual(archivedTime, coldTime * self.timeMargin)
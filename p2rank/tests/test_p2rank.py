@@ -24,9 +24,13 @@
 # *
 # **************************************************************************
 
+import os, json, shutil, tempfile
+
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 from pwem.protocols import ProtImportPdb, ProtSetFilter
-from ..protocols import P2RankFindPockets
+
+from .. import Plugin, P2RANK_DIC
+from ..protocols import P2RankFindPockets, P2RankRescorePockets, P2RankCatalogQuery
 
 class TestP2Rank(BaseTest):
     @classmethod
@@ -55,6 +59,25 @@ class TestP2Rank(BaseTest):
         self.assertIsNotNone(pdbOut)
         return protP2Rank
 
+    def _runP2RankRescore(self, p2RankProt):
+        protRescore = self.newProtocol(P2RankRescorePockets)
+        protRescore.inputStructROIsSets.set([p2RankProt.outputStructROIs])
+
+        self.launchProtocol(protRescore)
+        pocketsOut = getattr(protRescore, 'outputStructROIs', None)
+        self.assertIsNotNone(pocketsOut)
+        self.assertEqual(pocketsOut.getSize(), p2RankProt.outputStructROIs.getSize())
+        return protRescore
+
+    def _runCatalogQuery(self, p2RankProt):
+        protQuery = self.newProtocol(P2RankCatalogQuery, minProbability=0.0)
+
+        self.launchProtocol(protQuery)
+        pocketsOut = getattr(protQuery, 'outputStructROIs', None)
+        self.assertIsNotNone(pocketsOut)
+        self.assertGreaterEqual(pocketsOut.getSize(), p2RankProt.outputStructROIs.getSize())
+        return protQuery
+
     def _runFilterSites(self, p2RankProt):
         protFilter = self.newProtocol(
             ProtSetFilter,
@@ -70,8 +93,104 @@ class TestP2Rank(BaseTest):
     def testP2Rank(self):
         protP2Rank = self._runP2RankFind()
         self.assertIsNotNone(protP2Rank.outputStructROIs)
+        self._runP2RankRescore(protP2Rank)
+        self._runCatalogQuery(protP2Rank)
         # protFilter = self._runFilterSites(protP2Rank)
 
 
+class TestP2RankWorker(BaseTest):
+    """ Jobs run in the same persistent worker must not inherit the parameters of the previous ones """
+    @classmethod
+    def setUpClass(cls):
+        cls.ds = DataSet.getDataSet('model_building_tutorial')
+        cls.tmpDir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def testParamsNotCarriedOver(self):
+        from ..worker import P2RankWorkerClient
+        worker = P2RankWorkerClient(Plugin.getVar(P2RANK_DIC['home']), os.path.join(self.tmpDir, 'worker'),
+                                    idleTimeout=60, environ=Plugin.getEnviron())
+        pdbFile = self.ds.getFile('PDBx_mmCIF/5ni1.pdb')
+        with open(os.devnull, 'w') as devnull:
+            noVisDir, visDir = os.path.join(self.tmpDir, 'noVis'), os.path.join(self.tmpDir, 'vis')
+            self.assertEqual(worker.submit('predict', ['-f', pdbFile, '-o', noVisDir, '-visualizations', 0],
+                                           out=devnull), 0)
+            self.assertEqual(worker.submit('predict', ['-f', pdbFile, '-o', visDir], out=devnull), 0)
+
+        self.assertFalse(os.path.exists(os.path.join(noVisDir, 'visualizations')))
+        self.assertTrue(os.path.exists(os.path.join(visDir, 'visualizations')))
+
+
+class TestP2RankDistributed(BaseTest):
+    """ Distributed prediction of an ensemble with the stub P2Rank (tests/stub/prank), where a partition fails once """
+    nModels, nResidues = 4, 60
+    stubDir = os.path.join(os.path.dirname(__file__), 'stub')
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tmpDir = tempfile.mkdtemp()
+        # Read by the protocols when they run, in their own processes
+        cls.stubEnv = {P2RANK_DIC['home']: cls.stubDir, 'P2RANK_STUB_POCKETS': '5', 'P2RANK_STUB_POINTS': '300'}
+        cls.oldEnv = {key: os.environ.get(key) for key in list(cls.stubEnv) + ['P2RANK_STUB_FAIL_ONCE']}
+        os.environ.update(cls.stubEnv)
+
+        protImportPDB = cls.newProtocol(ProtImportPdb, inputPdbData=1, pdbFile=cls._writeEnsemble())
+        cls.launchProtocol(protImportPDB)
+        cls.protImportPDB = protImportPDB
+
+    @classmethod
+    def tearDownClass(cls):
+        for key, value in cls.oldEnv.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(cls.tmpDir)
+
+    @classmethod
+    def _writeEnsemble(cls):
+        pdbFile = os.path.join(cls.tmpDir, 'ensemble.pdb')
+        with open(pdbFile, 'w') as f:
+            for model in range(1, cls.nModels + 1):
+                f.write('MODEL     {:4d}\n'.format(model))
+                for i in range(cls.nResidues):
+                    f.write('ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C\n'.
+                            format(i + 1, i + 1, 3.8 * (i % 6) + 0.1 * model, 3.8 * (i // 6), 0.0))
+                f.write('ENDMDL\n')
+            f.write('END\n')
+        return pdbFile
+
+    def _runP2RankEnsemble(self, **kwargs):
+        protP2Rank = self.newProtocol(P2RankFindPockets, inputAtomStruct=self.protImportPDB.outputPdb,
+                                      ensembleMode=True, mergeOutputs=True, useCache=False, numberOfThreads=1,
+                                      **kwargs)
+        self.launchProtocol(protP2Rank)
+        self.assertIsNotNone(getattr(protP2Rank, 'outputStructROIs', None))
+        return protP2Rank
+
+    def testPartitionRetry(self):
+        # The third frame fails the first time, so the second partition needs a retry
+        os.environ['P2RANK_STUB_FAIL_ONCE'] = '_frame_3.pdb'
+        try:
+            protDistributed = self._runP2RankEnsemble(distributed=True, structsPerPartition=2, partitionRetries=1)
+        finally:
+            os.environ.pop('P2RANK_STUB_FAIL_ONCE')
+        protSingle = self._runP2RankEnsemble(distributed=False)
 
+        with open(protDistributed._getPartitionsStatusFile()) as f:
+            statuses = json.load(f)
+        self.assertEqual([statuses[str(i)]['attempts'] for i in (1, 2)], [1, 2])
+        self.assertEqual(len(statuses['2']['errors']), 1)
+        self.assertEqual(protDistributed._getFailedNames(), [])
 
+        # The merged outputs are those of a single P2Rank execution
+        for name in protSingle._getInputNames():
+            for getFile in [P2RankFindPockets.getPropertiesFile, P2RankFindPockets.getResiduesFile]:
+                with open(getFile(protDistributed, name)) as fDist, open(getFile(protSingle, name)) as fSingle:
+                    self.assertEqual(fDist.read(), fSingle.read())
+        self.assertEqual(sorted(pock._score.get() for pock in protDistributed.outputStructROIs),
+                         sorted(pock._score.get() for pock in protSingle.outputStructROIs))
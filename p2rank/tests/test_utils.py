@@ -0,0 +1,222 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+import numpy as np
+
+from ..utils import readStructureAtoms, getShardMask, writeStructureShard, splitModels, PocketTracker, \
+  P2RankPredictions, P2RankPoints, mergeShardPredictions, writeP2RankPredictions, writeP2RankResidues, \
+  writeFPocketPrediction, mapRescoredPockets
+
+STUB_PRANK = os.path.join(os.path.dirname(__file__), 'stub', 'prank')
+
+# mmCIF with categories before and after the _atom_site loop: only data_ and the loop_ of _atom_site make the header
+CIF_ATOM_FIELDS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_comp_id', 'label_asym_id',
+                   'label_seq_id', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'auth_seq_id', 'auth_asym_id',
+                   'pdbx_PDB_model_num']
+
+
+def writeCIFFile(cifFile, models):
+  '''Writes a mmCIF file with models: list of lists of (chain, residue number, x, y, z)'''
+  lines = ['data_TEST', '#', '_entry.id TEST', '#', 'loop_', '_struct_asym.id', '_struct_asym.entity_id',
+           'A 1', 'B 1', '#', 'loop_'] + ['_atom_site.' + field for field in CIF_ATOM_FIELDS]
+  atomId = 0
+  for modelNum, atoms in enumerate(models, 1):
+    for chain, resNum, x, y, z in atoms:
+      atomId += 1
+      lines.append("ATOM {} C CA ALA {} {} {:.3f} {:.3f} {:.3f} {} {} {}".
+                   format(atomId, chain, resNum, x, y, z, resNum, chain, modelNum))
+  lines += ['#', 'loop_', '_pdbx_poly_seq_scheme.asym_id', '_pdbx_poly_seq_scheme.seq_id', 'A 1', '#']
+  with open(cifFile, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return cifFile
+
+
+def makeAtoms(nChains=2, nResidues=5, shift=0.0):
+  return [(chr(ord('A') + c), r + 1, 4.0 * r + shift, 10.0 * c, 0.0)
+          for c in range(nChains) for r in range(nResidues)]
+
+
+class TestStructureShards(unittest.TestCase):
+  def setUp(self):
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def testCIFHeader(self):
+    cifFile = writeCIFFile(os.path.join(self.tmpDir, 'struct.cif'), [makeAtoms()])
+    header = readStructureAtoms(cifFile)[0]
+    self.assertEqual(header[:2], [b'data_TEST\n', b'loop_\n'])
+    self.assertEqual(header[2:], [('_atom_site.' + field + '\n').encode() for field in CIF_ATOM_FIELDS])
+
+  def testCIFShardParsedBack(self):
+    cifFile = writeCIFFile(os.path.join(self.tmpDir, 'struct.cif'), [makeAtoms(), makeAtoms(shift=1.0)])
+    header, lines, chains, residues, coords = readStructureAtoms(cifFile)
+    self.assertEqual(len(lines), 10)
+
+    mask = getShardMask(chains, residues, coords, ['A'], 0)
+    shardFile = writeStructureShard(os.path.join(self.tmpDir, 'shard.cif'), header, lines, mask)
+    shardHeader, shardLines, shardChains, _, shardCoords = readStructureAtoms(shardFile)
+    self.assertEqual(shardHeader, header)
+    self.assertEqual(shardLines, [line for line, selected in zip(lines, mask) if selected])
+    self.assertEqual(set(shardChains), {'A'})
+    np.testing.assert_allclose(shardCoords, coords[mask])
+
+  def writeShard(self, shardId, pockets, residues, pointsPockets):
+    '''Writes the P2Rank outputs of a shard. pockets: [(score, center x, residue ids)], residues:
+    [(residue id, pocket)], pointsPockets: pocket of each point. Returns its predictions and points'''
+    predFile, resFile = (os.path.join(self.tmpDir, 'shard{}_{}.csv'.format(shardId, suffix))
+                         for suffix in ['predictions', 'residues'])
+    writeP2RankPredictions(predFile, 'shard{}.pdb'.format(shardId),
+                           [{'rank': rank, 'score': score, 'probability': score / 10, 'center_x': x,
+                             'center_y': 0.0, 'center_z': 0.0, 'sas_points': 10, 'surf_atoms': 5, 'residue_ids': resIds,
+                             'surf_atom_ids': []}
+                            for rank, (score, x, resIds) in enumerate(pockets, 1)])
+    writeP2RankResidues(resFile, [{'chain': resId.split('_')[0], 'residue_label': resId.split('_')[1],
+                                   'residue_name': 'ALA', 'score': 1.0, 'zscore': 0.0, 'probability': 0.5,
+                                   'pocket': pocket} for resId, pocket in residues])
+    nPoints = len(pointsPockets)
+    points = P2RankPoints(np.arange(nPoints * 3, dtype=float).reshape(-1, 3) + 100 * shardId, np.ones(nPoints),
+                          np.full(nPoints, 0.5), np.array(pointsPockets))
+    return P2RankPredictions(predFile, resFile), points
+
+  def testMergeShardPredictions(self):
+    # Shard of chain A: the first pocket is at the interface, the third one has no residue of chain A
+    predsA, pointsA = self.writeShard(0, [(10.0, 0.0, ['A_1', 'A_2', 'B_5']), (4.0, 20.0, ['A_9']),
+                                          (2.0, 50.0, ['B_30'])],
+                                      [('A_1', 1), ('B_5', 1), ('A_9', 2), ('A_12', 0)], [1, 1, 2, 3])
+    # Shard of chain B: the first pocket duplicates the interface one of chain A, with a lower score
+    predsB, pointsB = self.writeShard(1, [(8.0, 1.0, ['B_5', 'B_6', 'A_1']), (6.0, -30.0, ['B_20'])],
+                                      [('B_5', 1), ('A_1', 1), ('B_20', 2), ('B_40', 0)], [1, 2, 2])
+    pockets, residues, points = mergeShardPredictions([(['A'], predsA, pointsA), (['B'], predsB, pointsB)])
+
+    # The duplicate is kept once with its best score, the pocket out of its core is discarded and the rest re-ranked
+    self.assertEqual([(props['rank'], props['score']) for props in pockets], [(1, 10.0), (2, 6.0), (3, 4.0)])
+    self.assertEqual([props['residue_ids'] for props in pockets], [['A_1', 'A_2', 'B_5'], ['B_20'], ['A_9']])
+
+    # Each residue is taken from the shard of its chain, with the rank of its merged pocket
+    self.assertEqual(sorted((res['chain'] + '_' + res['residue_label'], res['pocket']) for res in residues),
+                     [('A_1', 1), ('A_12', 0), ('A_9', 3), ('B_20', 2), ('B_40', 0), ('B_5', 1)])
+
+    # Points of the kept pockets, renumbered with their new ranks
+    self.assertEqual(points.pocketIds.tolist(), [1, 1, 2, 2, 3])
+    np.testing.assert_allclose(points.coords, np.concatenate([pointsA.coords[:2], pointsB.coords[1:],
+                                                              pointsA.coords[2:3]]))
+
+
+class TestEnsembles(unittest.TestCase):
+  def setUp(self):
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def testSplitCIFModels(self):
+    models = [makeAtoms(shift=shift) for shift in (0.0, 1.0, 2.0)]
+    cifFile = writeCIFFile(os.path.join(self.tmpDir, 'ensemble.cif'), models)
+    modelFiles = splitModels(cifFile, os.path.join(self.tmpDir, 'model'))
+    self.assertEqual([os.path.basename(modelFile) for modelFile in modelFiles],
+                     ['model_1.cif', 'model_2.cif', 'model_3.cif'])
+
+    header = readStructureAtoms(cifFile)[0]
+    for modelFile, atoms in zip(modelFiles, models):
+      modelHeader, lines, chains, _, coords = readStructureAtoms(modelFile)
+      self.assertEqual(modelHeader, header)
+      self.assertEqual(len(lines), len(atoms))
+      np.testing.assert_allclose(coords, [atom[2:] for atom in atoms], atol=1e-3)
+      with open(modelFile, 'rb') as f:
+        self.assertEqual(f.read().count(b'loop_'), 1)
+
+  def testTrackerRetiresTracks(self):
+    pocketA = {'score': 5.0, 'probability': 0.5, 'residue_ids': ['A_1', 'A_2', 'A_3']}
+    pocketB = {'score': 3.0, 'probability': 0.3, 'residue_ids': ['B_7', 'B_8']}
+    frames = [{1: pocketA}, {1: pocketB}, {1: pocketA, 2: pocketB}]
+
+    tracker = PocketTracker(minOverlap=0.5, maxGap=0)
+    links = [tracker.addFrame(frame) for frame in frames]
+    # Pocket A is missing from the second frame: its track is retired and it starts a new one
+    self.assertEqual([[trackId for _, trackId, _ in frameLinks] for frameLinks in links], [[1], [2], [3, 2]])
+    self.assertEqual(tracker.liveTracks, [1, 2])
+    self.assertNotIn('residues', tracker.tracks[0])
+
+    tracker = PocketTracker(minOverlap=0.5, maxGap=1)
+    links = [tracker.addFrame(frame) for frame in frames]
+    self.assertEqual([[trackId for _, trackId, _ in frameLinks] for frameLinks in links], [[1], [2], [1, 2]])
+    summary = tracker.getTracksSummary()
+    self.assertEqual([track['nFrames'] for track in summary], [2, 2])
+
+
+class TestRescoring(unittest.TestCase):
+  """ Mapping of the pockets rescored by P2Rank (stub, see tests/stub/prank) to the exported ones """
+  def setUp(self):
+    self.tmpDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpDir)
+
+  def testMapRescoredPockets(self):
+    exportDir, outDir = os.path.join(self.tmpDir, 'export'), os.path.join(self.tmpDir, 'rescore')
+    os.makedirs(exportDir)
+    proteinFile = os.path.join(exportDir, 'set1_protein.pdb')
+    with open(proteinFile, 'w') as f:
+      for i, (chain, resNum, x, y, z) in enumerate(makeAtoms(), 1):
+        f.write('ATOM  {:5d}  CA  ALA {}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C\n'.
+                format(i, chain, resNum, x, y, z))
+    pocketsCoords = [np.random.RandomState(i).normal(center, 1.0, (10, 3))
+                     for i, center in enumerate([(0, 0, 0), (15, 0, 0), (0, 15, 0), (15, 15, 0)])]
+    predFile = writeFPocketPrediction(exportDir, 'set1', proteinFile, pocketsCoords)
+    dsFile = os.path.join(exportDir, 'rescore.ds')
+    with open(dsFile, 'w') as f:
+      f.write('PARAM.PREDICTION_METHOD=fpocket\nHEADER: prediction protein\n{}  {}\n'.
+              format(os.path.relpath(predFile, exportDir), os.path.relpath(proteinFile, exportDir)))
+    subprocess.run([sys.executable, STUB_PRANK, 'rescore', dsFile, '-o', outDir], check=True)
+
+    centers = [coords.mean(axis=0) for coords in pocketsCoords]
+    predictions = P2RankPredictions(os.path.join(outDir, 'set1_protein.pdb_rescored.csv'))
+    mapped = mapRescoredPockets(predictions, centers)
+    self.assertEqual(sorted(mapped), [1, 2, 3, 4])
+    for pocketId, props in mapped.items():
+      self.assertEqual(int(props['old_rank']), pocketId)
+      np.testing.assert_allclose([props['center_x'], props['center_y'], props['center_z']], centers[pocketId - 1],
+                                 atol=1e-3)
+
+    # Without the original ranks, the pockets are mapped by their centers
+    noRanksFile = writeP2RankPredictions(os.path.join(outDir, 'noRanks.csv'), 'set1_protein.pdb',
+                                         [predictions.pockets[rank] for rank in predictions])
+    mappedByCenter = mapRescoredPockets(P2RankPredictions(noRanksFile), centers)
+    self.assertEqual({pocketId: props['rank'] for pocketId, props in mappedByCenter.items()},
+                     {pocketId: props['rank'] for pocketId, props in mapped.items()})
+
+    # The pockets without points are not mapped, neither by their rank nor by their center
+    noPoints = [None] + centers[1:]
+    self.assertEqual(sorted(mapRescoredPockets(predictions, noPoints)), [2, 3, 4])
+    mappedByCenter = mapRescoredPockets(P2RankPredictions(noRanksFile), noPoints)
+    self.assertEqual({pocketId: props['rank'] for pocketId, props in mappedByCenter.items()},
+                     {pocketId: props['rank'] for pocketId, props in mapped.items() if pocketId != 1})
@@ -0,0 +1,1097 @@
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, re, csv, gzip, json, shlex, shutil, hashlib, itertools
+from functools import lru_cache
+from collections import namedtuple
+
+import numpy as np
+
+from pwchem.utils import writePDBLine
+
+# Points of a P2Rank points file: coordinates (n, 3), occupancies, scores (b-factors) and pocket ids (0 for
+# the points not included in any pocket)
+P2RankPoints = namedtuple('P2RankPoints', ['coords', 'occupancies', 'scores', 'pocketIds'])
+
+# Columns of the numeric fields of the P2Rank points, counted from the end of the line
+POINTS_COLUMNS = {'x': (-36, -28), 'y': (-28, -20), 'z': (-20, -12), 'occupancy': (-12, -6), 'score': (-6, 0)}
+POCKET_ID_START = 22
+# Decimal points of the coordinates, used to detect the lines with overflowed coordinates (very large assemblies)
+COORDS_DECIMALS = (-32, -24, -16)
+POINT_FIELDS_REGEX = re.compile(rb'(-?\d+\.\d{3})\s*(-?\d+\.\d{3})\s*(-?\d+\.\d{3})\s*(-?\d+\.\d+)\s*(-?\d+\.\d+)$')
+
+
+def _getColumn(chars, start, end):
+  '''Returns the fixed width column [start, end) of an array of lines as an array of byte strings'''
+  return np.ascontiguousarray(chars[:, start:end]).view('S{}'.format(end - start)).ravel()
+
+
+def _parsePocketIds(lines, chars, length):
+  '''Parses the pocket ids, placed between the residue number column and the coordinates'''
+  try:
+    return _getColumn(chars, POCKET_ID_START, length + POINTS_COLUMNS['x'][0]).astype(np.int64)
+  except ValueError:
+    # Chain or atom numbers displaced into the column: take the last number before the coordinates
+    return np.array([int(re.findall(rb'\d+', line[:length + POINTS_COLUMNS['x'][0]])[-1]) for line in lines])
+
+
+def _parseOverflowedPoint(line):
+  '''Parses a point line whose fields do not fit in the fixed columns (coordinates over 9999.999 or
+  under -999.999), returning (x, y, z, occupancy, score, pocketId)'''
+  match = POINT_FIELDS_REGEX.search(line)
+  pocketId = int(re.findall(rb'\d+', line[POCKET_ID_START - 4:match.start()])[-1])
+  return tuple(float(value) for value in match.groups()) + (pocketId,)
+
+
+def parseP2RankPoints(pointsFile):
+  '''Parses a P2Rank points file (optionally gzipped) in a single pass into a P2RankPoints of arrays.
+  The fields are read at fixed columns counted from the end of the lines, so the lines displaced right
+  (more than 99 pockets) or with the atom number merged with the record name (more than 9999 points) are
+  parsed the same way as the rest. Lines with overflowed coordinates (very large assemblies) are parsed apart'''
+  opener = gzip.open if pointsFile.endswith('.gz') else open
+  with opener(pointsFile, 'rb') as f:
+    lines = [line.rstrip() for line in f.read().splitlines() if line.startswith(b'HETATM')]
+
+  nPoints = len(lines)
+  coords, occupancies = np.empty((nPoints, 3)), np.empty(nPoints)
+  scores, pocketIds = np.empty(nPoints), np.empty(nPoints, dtype=np.int64)
+
+  lengths = np.fromiter(map(len, lines), dtype=np.int64, count=nPoints)
+  for length in np.unique(lengths):
+    idxs = np.flatnonzero(lengths == length)
+    groupLines = [lines[i] for i in idxs]
+    chars = np.array(groupLines, dtype='S{}'.format(length)).view('S1').reshape(len(idxs), length)
+    if length >= -POINTS_COLUMNS['x'][0] + POCKET_ID_START:
+      overflowed = ~np.all(chars[:, [length + col for col in COORDS_DECIMALS]] == b'.', axis=1)
+    else:
+      overflowed = np.ones(len(idxs), dtype=bool)
+    for i in np.flatnonzero(overflowed):
+      x, y, z, occupancies[idxs[i]], scores[idxs[i]], pocketIds[idxs[i]] = _parseOverflowedPoint(groupLines[i])
+      coords[idxs[i]] = x, y, z
+    if overflowed.any():
+      idxs, chars = idxs[~overflowed], chars[~overflowed]
+      groupLines = [line for line, over in zip(groupLines, overflowed) if not over]
+      if not len(idxs):
+        continue
+
+    cols = {key: _getColumn(chars, length + start, length + end) for key, (start, end) in POINTS_COLUMNS.items()}
+    coords[idxs] = np.column_stack([cols['x'], cols['y'], cols['z']]).astype(np.float64)
+    occupancies[idxs] = cols['occupancy'].astype(np.float64)
+    scores[idxs] = cols['score'].astype(np.float64)
+    pocketIds[idxs] = _parsePocketIds(groupLines, chars, length)
+
+  return P2RankPoints(coords, occupancies, scores, pocketIds)
+
+
+def selectPoints(points, idxs):
+  '''Returns a P2RankPoints with the points in the idxs positions'''
+  return P2RankPoints(*(values[idxs] for values in points))
+
+
+def groupPointsByPocket(points, skipIds=(0,)):
+  '''Returns a dictionary {pocketId: indexes of its points}, keeping the file order of the points.
+  The points with pocket ids in skipIds (by default, those not in any pocket) are excluded'''
+  order = np.argsort(points.pocketIds, kind='stable')
+  pocketIds, starts = np.unique(points.pocketIds[order], return_index=True)
+  ends = np.append(starts[1:], len(order))
+  return {int(pId): order[start:end] for pId, start, end in zip(pocketIds, starts, ends) if pId not in skipIds}
+
+
+def formatPocketPoints(pocketPoints, pocketK):
+  '''Returns the pdb string of the points of a pocket (P2RankPoints), as HETATM STP residues numbered pocketK'''
+  pdbLines = []
+  for i, ((x, y, z), occ, score) in enumerate(zip(pocketPoints.coords, pocketPoints.occupancies,
+                                                  pocketPoints.scores)):
+    replacements = ['HETATM', str(i + 1), 'APOL', 'STP', 'C', str(pocketK),
+                    '%.3f' % x, '%.3f' % y, '%.3f' % z, '%.2f' % occ, '%.3f' % score, '', 'Ve']
+    pdbLines.append(writePDBLine(replacements))
+  return ''.join(pdbLines)
+
+
+def getPocketFile(pocketsDir, pocketK):
+  return os.path.join(pocketsDir, 'pocketFile_{}.pdb'.format(pocketK))
+
+
+def writePocketFiles(pocketsDir, pocketsPoints, pointsFile=None):
+  '''Writes the pdb file of each pocket from {pocketId: P2RankPoints} in pocketsDir.
+  Returns a dictionary {pocketId: pocketFile}.
+  The pocket files written after the points file they come from are kept, so it can be re-executed'''
+  pointsTime = os.path.getmtime(pointsFile) if pointsFile else None
+  os.makedirs(pocketsDir, exist_ok=True)
+  pFiles = {}
+  for pocketK in sorted(pocketsPoints):
+    pFile = getPocketFile(pocketsDir, pocketK)
+    if pointsTime is None or not os.path.exists(pFile) or os.path.getmtime(pFile) < pointsTime:
+      # Written aside and moved, so an interrupted write never leaves a partial pocket file
+      tmpFile = pFile + '.tmp'
+      with open(tmpFile, 'w') as f:
+        f.write(formatPocketPoints(pocketsPoints[pocketK], pocketK))
+      os.replace(tmpFile, pFile)
+    pFiles[pocketK] = pFile
+  return pFiles
+
+
+def writeHetatmFile(outFile, proteinFile, pocketsPoints):
+  '''Writes the protein atoms (pdb, optionally gzipped) followed by the points of the pockets as HETATM in a
+  single pass. If proteinFile is None, only the pockets are written.
+  pocketsPoints: iterable of (pocketId, P2RankPoints)'''
+  tmpFile = '{}.{}.tmp'.format(outFile, os.getpid())
+  with open(tmpFile, 'w') as fOut:
+    if proteinFile:
+      opener = gzip.open if proteinFile.endswith('.gz') else open
+      with opener(proteinFile, 'rt') as fProt:
+        for line in fProt:
+          if not line.startswith(('END', 'CONECT', 'MASTER')):
+            fOut.write(line)
+    for pocketId, pocketPoints in pocketsPoints:
+      fOut.write(formatPocketPoints(pocketPoints, pocketId))
+    fOut.write('\nEND\n')
+  os.replace(tmpFile, outFile)
+  return outFile
+
+
+################# Pocket store ###################
+
+def writePocketStore(storeFile, pocketsPoints):
+  '''Writes the points of the pockets in a single npz container, sorted by pocket, with the index
+  (offsets) of the points of each of them.
+  pocketsPoints: {pocketId: P2RankPoints}'''
+  pocketIds = sorted(pocketsPoints)
+  offsets = np.cumsum([0] + [len(pocketsPoints[pId].coords) for pId in pocketIds])
+
+  def joinValues(field, dtype=np.float32):
+    if not pocketIds:
+      return np.empty((0, 3) if field == 'coords' else 0, dtype=dtype)
+    return np.concatenate([getattr(pocketsPoints[pId], field) for pId in pocketIds]).astype(dtype)
+
+  # Written aside and moved, so an interrupted write never leaves a partial store
+  tmpFile = '{}.{}.tmp'.format(storeFile, os.getpid())
+  with open(tmpFile, 'wb') as f:
+    np.savez(f, pocketIds=np.array(pocketIds, dtype=np.int64), offsets=offsets, coords=joinValues('coords'),
+             occupancies=joinValues('occupancies'), scores=joinValues('scores'))
+  os.replace(tmpFile, storeFile)
+  return storeFile
+
+
+class PocketStore:
+  """ Points of the pockets of a structure saved in a single npz file (writePocketStore) """
+  def __init__(self, storeFile):
+    with np.load(storeFile) as data:
+      self.pocketIds, self.offsets = data['pocketIds'], data['offsets']
+      self.points = P2RankPoints(data['coords'], data['occupancies'], data['scores'],
+                                 np.repeat(self.pocketIds, np.diff(self.offsets)))
+    self._index = {int(pId): i for i, pId in enumerate(self.pocketIds)}
+
+  def getPocketIds(self):
+    return list(self._index)
+
+  def getPocketPoints(self, pocketId):
+    i = self._index[pocketId]
+    return selectPoints(self.points, slice(self.offsets[i], self.offsets[i + 1]))
+
+  def __iter__(self):
+    for pocketId in self._index:
+      yield pocketId, self.getPocketPoints(pocketId)
+
+
+@lru_cache(maxsize=8)
+def _loadPocketStore(storeFile, mTime):
+  return PocketStore(storeFile)
+
+
+def loadPocketStore(storeFile):
+  '''Returns the PocketStore of a file, reusing the last ones loaded while they are not modified'''
+  storeFile = os.path.abspath(storeFile)
+  return _loadPocketStore(storeFile, os.path.getmtime(storeFile))
+
+
+################# Predictions ###################
+
+def parseP2RankPredictions(predictionsFile):
+  '''Parses the P2Rank predictions csv into a dictionary {rank: properties of the pocket}'''
+  floatKeys = ['score', 'probability', 'center_x', 'center_y', 'center_z']
+  intKeys = ['rank', 'sas_points', 'surf_atoms']
+  predictions = {}
+  with open(predictionsFile) as f:
+    reader = csv.reader(f, skipinitialspace=True)
+    keys = [key.strip() for key in next(reader)]
+    for row in reader:
+      props = dict(zip(keys, (value.strip() for value in row)))
+      for key in floatKeys:
+        if key in props:
+          props[key] = float(props[key])
+      for key in intKeys:
+        if key in props:
+          props[key] = int(props[key])
+      props['residue_ids'] = props.get('residue_ids', '').split()
+      props['surf_atom_ids'] = props.get('surf_atom_ids', '').split()
+      predictions[props['rank']] = props
+  return predictions
+
+
+def parseP2RankResidues(residuesFile):
+  '''Parses the P2Rank per-residue predictions csv into a dictionary {pocket rank: [residue predictions]}.
+  The residues not included in any pocket are under the rank 0'''
+  floatKeys = ['score', 'zscore', 'probability']
+  residues = {}
+  with open(residuesFile) as f:
+    reader = csv.reader(f, skipinitialspace=True)
+    keys = [key.strip() for key in next(reader)]
+    for row in reader:
+      props = dict(zip(keys, (value.strip() for value in row)))
+      for key in floatKeys:
+        if key in props:
+          props[key] = float(props[key])
+      residues.setdefault(int(props.pop('pocket', 0)), []).append(props)
+  return residues
+
+
+class P2RankPredictions:
+  """ Predictions of a P2Rank run parsed once and indexed by pocket rank: the properties of each pocket
+  (_predictions.csv) together with the predictions of its residues (_residues.csv) """
+  def __init__(self, predictionsFile, residuesFile=None):
+    self.pockets = parseP2RankPredictions(predictionsFile)
+    self.residues = {}
+    if residuesFile and os.path.exists(residuesFile):
+      self.residues = parseP2RankResidues(residuesFile)
+
+  def __contains__(self, rank):
+    return rank in self.pockets
+
+  def __iter__(self):
+    return iter(sorted(self.pockets))
+
+  def filterPockets(self, maxPockets=0, minScore=0.0, minProbability=0.0):
+    '''Returns the ranks of the best maxPockets pockets (all if 0) with at least minScore and minProbability'''
+    ranks = [rank for rank in self if self.pockets[rank]['score'] >= minScore and
+             self.pockets[rank].get('probability', 1.0) >= minProbability]
+    return ranks[:maxPockets] if maxPockets > 0 else ranks
+
+  def getPocket(self, rank):
+    '''Returns the properties of the pocket with the given rank, including its residues predictions'''
+    props = dict(self.pockets[rank])
+    props['residues'] = self.residues.get(rank, [])
+    return props
+
+
+
+################# Structures ###################
+
+CIF_EXTENSIONS = ('.cif', '.mmcif')
+
+
+def getStructureExtension(structFile):
+  '''Returns the extension of a structure file, including the .gz one if gzipped (e.g. .cif.gz)'''
+  name, ext = os.path.splitext(structFile)
+  if ext == '.gz':
+    ext = os.path.splitext(name)[1] + ext
+  return ext
+
+
+def linkFile(srcFile, dstFile):
+  '''Makes srcFile available in dstFile without copying it: symbolic link, hard link if not possible and
+  copy as last resort'''
+  if os.path.lexists(dstFile):
+    os.remove(dstFile)
+  try:
+    os.symlink(os.path.abspath(srcFile), dstFile)
+  except OSError:
+    try:
+      os.link(srcFile, dstFile)
+    except OSError:
+      shutil.copy(srcFile, dstFile)
+  return dstFile
+
+
+def gunzipFile(gzFile, outFile):
+  '''Decompresses a gzipped file into outFile'''
+  with gzip.open(gzFile, 'rb') as fIn, open(outFile, 'wb') as fOut:
+    shutil.copyfileobj(fIn, fOut)
+  return outFile
+
+
+def getStructureKey(structFile):
+  '''Returns a key identifying a version of a structure file by its path, size and modification time'''
+  structFile = os.path.abspath(structFile)
+  stat = os.stat(structFile)
+  return hashlib.md5('{}:{}:{}'.format(structFile, stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+
+
+def isCIFFile(structFile):
+  '''Whether the structure file (optionally gzipped) is in mmCIF format'''
+  name = structFile[:-3] if structFile.endswith('.gz') else structFile
+  return os.path.splitext(name)[1].lower() in CIF_EXTENSIONS
+
+
+def _scanPDBLines(lines):
+  '''Counts models, chains, residues and atoms (ATOM and HETATM records) of PDB / PDBQT lines'''
+  models, atoms, chains, residues = 0, 0, set(), set()
+  for line in lines:
+    record = line[:6]
+    if record == b'ATOM  ' or record == b'HETATM':
+      atoms += 1
+      chains.add(line[21:22])
+      residues.add(line[21:27])
+    elif record == b'MODEL ':
+      models += 1
+  return max(models, 1), atoms, chains, residues
+
+
+def _splitCIFRow(line):
+  if b"'" in line or b'"' in line:
+    return [value.encode() for value in shlex.split(line.decode())]
+  return line.split()
+
+
+def _getCIFFieldIdx(fields, names):
+  return next((fields.index(name) for name in names if name in fields), None)
+
+
+def _readCIFAtomSite(f):
+  '''Reads a binary mmCIF stream up to its _atom_site loop. Returns (header lines, field names, iterator of the
+  loop rows). The header only keeps the data_ line of the block and the loop_ line and tags of _atom_site'''
+  header, fields, loopLine, first = [], [], None, None
+  for line in f:
+    if line.startswith(b'_atom_site.'):
+      if not fields and loopLine:
+        header.append(loopLine)
+      fields.append(line.split()[0][len(b'_atom_site.'):].decode())
+      header.append(line)
+    elif fields:
+      if line.strip():
+        first = line
+        break
+    elif line.startswith(b'data_'):
+      if not header:
+        header.append(line)
+    elif line.strip():
+      loopLine = line if line.startswith(b'loop_') else None
+
+  def rows():
+    if first is None:
+      return
+    for line in itertools.chain([first], f):
+      if not line.strip():
+        continue
+      if line[:1] in (b'#', b'_') or line.startswith((b'loop_', b'data_')):
+        return
+      yield line
+  return header, fields, rows()
+
+
+def _scanCIFLines(lines):
+  '''Counts models, chains, residues and atoms of the _atom_site loop of mmCIF lines'''
+  models, atoms, chains, residues = set(), 0, set(), set()
+  _, fields, rows = _readCIFAtomSite(lines)
+  idxs = [_getCIFFieldIdx(fields, ['auth_asym_id', 'label_asym_id']),
+          _getCIFFieldIdx(fields, ['auth_seq_id', 'label_seq_id']),
+          _getCIFFieldIdx(fields, ['pdbx_PDB_ins_code']), _getCIFFieldIdx(fields, ['pdbx_PDB_model_num'])]
+  for line in rows:
+    row = _splitCIFRow(line)
+    chain, resNum, insCode, model = (row[i] if i is not None else b'' for i in idxs)
+    atoms += 1
+    models.add(model)
+    chains.add(chain)
+    residues.add((chain, resNum, insCode))
+  return max(len(models), 1), atoms, chains, residues
+
+
+@lru_cache(maxsize=32)
+def _scanStructureFile(structFile, key):
+  opener = gzip.open if structFile.endswith('.gz') else open
+  scanFunc = _scanCIFLines if isCIFFile(structFile) else _scanPDBLines
+  with opener(structFile, 'rb') as f:
+    models, atoms, chains, residues = scanFunc(f)
+  return {'format': 'mmcif' if isCIFFile(structFile) else 'pdb', 'models': models, 'atoms': atoms,
+          'chains': len(chains), 'residues': len(residues),
+          'chainIds': sorted(chain.decode().strip() for chain in chains)}
+
+
+def scanStructureFile(structFile, cacheDir=None):
+  '''Counts the models, chains, residues and atoms (ATOM and HETATM records) of a PDB, PDBQT or mmCIF file
+  (optionally gzipped) in a single streaming pass, without building the structure.
+  The results are reused while the file is not modified and, if cacheDir is given, also saved there as json so
+  other processes can reuse them'''
+  structFile = os.path.abspath(structFile)
+  key = getStructureKey(structFile)
+  cacheFile = os.path.join(cacheDir, key + '.json') if cacheDir else None
+  if cacheFile and os.path.exists(cacheFile):
+    with open(cacheFile) as f:
+      return json.load(f)
+
+  scan = dict(_scanStructureFile(structFile, key))
+  if cacheFile:
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpFile = '{}.{}.tmp'.format(cacheFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+      json.dump(scan, f)
+    os.replace(tmpFile, cacheFile)
+  return scan
+
+
+################# Shards ###################
+
+def readStructureAtoms(structFile):
+  '''Reads the atom records of the first model of a PDB or mmCIF file (optionally gzipped) in a single pass.
+  Returns (header lines, atom lines, chain ids, residue ids, coordinates (n, 3)), the lines as bytes'''
+  opener = gzip.open if structFile.endswith('.gz') else open
+  header, lines, chains, residues, coords = [], [], [], [], []
+  with opener(structFile, 'rb') as f:
+    if isCIFFile(structFile):
+      header, fields, rows = _readCIFAtomSite(f)
+      idxs = [_getCIFFieldIdx(fields, names) for names in
+              (['auth_asym_id', 'label_asym_id'], ['auth_seq_id', 'label_seq_id'], ['pdbx_PDB_ins_code'],
+               ['pdbx_PDB_model_num'], ['Cartn_x'], ['Cartn_y'], ['Cartn_z'])]
+      firstModel = None
+      for line in rows:
+        row = _splitCIFRow(line)
+        chain, resNum, insCode, model = (row[i] if i is not None else b'' for i in idxs[:4])
+        if lines and model != firstModel:
+          continue
+        firstModel = model
+        lines.append(line)
+        chains.append(chain.decode())
+        residues.append(b'_'.join([chain, resNum, insCode]))
+        coords.append([float(row[i]) for i in idxs[4:]])
+    else:
+      for line in f:
+        record = line[:6]
+        if record == b'ATOM  ' or record == b'HETATM':
+          lines.append(line)
+          chains.append(line[21:22].decode().strip())
+          residues.append(line[21:27])
+          coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+        elif record == b'ENDMDL':
+          break
+  return header, lines, np.array(chains), np.array(residues), np.array(coords).reshape(-1, 3)
+
+
+def getShardMask(chains, residues, coords, coreChains, margin):
+  '''Returns the mask of the atoms of a shard: those of the core chains plus the whole residues of the rest of
+  chains with any atom closer than margin (A) to them, so the pockets at the interfaces are preserved'''
+  from scipy.spatial import cKDTree
+  core = np.isin(chains, list(coreChains))
+  if margin <= 0 or core.all() or not core.any():
+    return core
+  dists, _ = cKDTree(coords[core]).query(coords[~core], distance_upper_bound=margin)
+  shellResidues = np.unique(residues[~core][dists <= margin])
+  return core | np.isin(residues, shellResidues)
+
+
+def writeStructureShard(outFile, header, lines, mask):
+  '''Writes the atom lines selected by mask, in the format of the original file (see readStructureAtoms)'''
+  with open(outFile, 'wb') as f:
+    f.writelines(header)
+    f.writelines(line for line, selected in zip(lines, mask) if selected)
+    f.write(b'#\n' if isCIFFile(outFile) else b'END\n')
+  return outFile
+
+
+def _isCorePocket(props, coreChains):
+  return any(resId.rsplit('_', 1)[0] in coreChains for resId in props['residue_ids'])
+
+
+def _residuesOverlap(resA, resB):
+  if not resA or not resB:
+    return 0.0
+  return len(resA & resB) / len(resA | resB)
+
+
+def mergeShardPredictions(shards, maxDistance=4.0, minOverlap=0.5):
+  '''Merges the predictions of the shards of a structure into a single ranking.
+  shards: list of (core chains, P2RankPredictions, P2RankPoints) of each shard.
+  The pockets with no residue in the core chains of their shard are discarded (they belong to other shard) and
+  those predicted in several shards (centers closer than maxDistance or residues overlap over minOverlap) are
+  kept once, with their best score.
+  Returns (pockets properties, residues predictions, points) with the pockets re-ranked by score'''
+  from scipy.spatial import cKDTree
+  candidates = []
+  for shardIdx, (coreChains, predictions, _) in enumerate(shards):
+    for rank in predictions:
+      props = predictions.pockets[rank]
+      if _isCorePocket(props, coreChains):
+        candidates.append((shardIdx, rank, props))
+  candidates.sort(key=lambda cand: -cand[2]['score'])
+
+  neighbours = {}
+  if candidates:
+    centers = np.array([[props['center_x'], props['center_y'], props['center_z']] for _, _, props in candidates])
+    for i, j in cKDTree(centers).query_pairs(max(maxDistance, 15.0)):
+      neighbours.setdefault(i, []).append(j)
+      neighbours.setdefault(j, []).append(i)
+
+  # Greedy deduplication in score order: each pocket maps to the rank of the first pocket it duplicates
+  newRanks, kept = {}, []
+  for i, (shardIdx, rank, props) in enumerate(candidates):
+    resIds = set(props['residue_ids'])
+    for j in neighbours.get(i, []):
+      if j >= i or candidates[j][0] == shardIdx:
+        continue
+      if np.linalg.norm(centers[i] - centers[j]) < maxDistance or \
+              _residuesOverlap(resIds, set(candidates[j][2]['residue_ids'])) >= minOverlap:
+        newRanks[(shardIdx, rank)] = newRanks[(candidates[j][0], candidates[j][1])]
+        break
+    else:
+      kept.append(i)
+      newRanks[(shardIdx, rank)] = len(kept)
+
+  pockets, pointsList = [], []
+  for newRank, i in enumerate(kept, 1):
+    shardIdx, rank, props = candidates[i]
+    pockets.append(dict(props, rank=newRank))
+    shardPoints = shards[shardIdx][2]
+    pocketPoints = selectPoints(shardPoints, np.flatnonzero(shardPoints.pocketIds == rank))
+    pointsList.append(pocketPoints._replace(pocketIds=np.full(len(pocketPoints.coords), newRank)))
+
+  residues = []
+  for shardIdx, (coreChains, predictions, _) in enumerate(shards):
+    for rank, shardResidues in sorted(predictions.residues.items()):
+      for resProps in shardResidues:
+        if resProps.get('chain') in coreChains:
+          residues.append(dict(resProps, pocket=newRanks.get((shardIdx, rank), 0)))
+
+  points = P2RankPoints(*(np.concatenate(values) for values in zip(*pointsList))) if pointsList else \
+    P2RankPoints(np.empty((0, 3)), np.empty(0), np.empty(0), np.empty(0, dtype=np.int64))
+  return pockets, residues, points
+
+
+def writeP2RankPredictions(predictionsFile, structName, pockets):
+  '''Writes the pockets properties as a P2Rank predictions csv'''
+  keys = ['name', 'rank', 'score', 'probability', 'sas_points', 'surf_atoms', 'center_x', 'center_y', 'center_z',
+          'residue_ids', 'surf_atom_ids']
+  with open(predictionsFile, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(keys)
+    for props in pockets:
+      props = dict(props, name=structName, residue_ids=' '.join(props['residue_ids']),
+                   surf_atom_ids=' '.join(props['surf_atom_ids']))
+      writer.writerow([props.get(key, '') for key in keys])
+  return predictionsFile
+
+
+def writeP2RankResidues(residuesFile, residues):
+  '''Writes the residues predictions as a P2Rank residues csv'''
+  keys = ['chain', 'residue_label', 'residue_name', 'score', 'zscore', 'probability', 'pocket']
+  with open(residuesFile, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(keys)
+    for resProps in residues:
+      writer.writerow([resProps.get(key, '') for key in keys])
+  return residuesFile
+
+
+def writeP2RankPoints(pointsFile, points):
+  '''Writes the points as a (gzipped) P2Rank points file'''
+  opener = gzip.open if pointsFile.endswith('.gz') else open
+  with opener(pointsFile, 'wt') as f:
+    for i, ((x, y, z), occ, score, pocketId) in enumerate(zip(*points)):
+      f.write('HETATM{:5d} H    STP A{:4d}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.3f}\n'.
+              format((i + 1) % 100000, pocketId, x, y, z, occ, score))
+  return pointsFile
+
+
+################# Visualization ###################
+
+POCKET_COLORS = ['red', 'green', 'blue', 'yellow', 'magenta', 'cyan', 'orange', 'purple', 'lime', 'teal',
+                 'salmon', 'slate', 'olive', 'violet', 'deepteal', 'wheat', 'hotpink', 'marine', 'sand', 'raspberry']
+
+
+def getResiduesSelection(residueIds):
+  '''Returns the PyMOL selection of P2Rank residue ids (<chain>_<residue number>)'''
+  chainResidues = {}
+  for resId in residueIds:
+    chain, resNum = resId.rsplit('_', 1) if '_' in resId else ('', resId)
+    chainResidues.setdefault(chain, []).append(resNum)
+  return ' or '.join('(chain {} and resi {})'.format(chain, '+'.join(resNums)) if chain else
+                     '(resi {})'.format('+'.join(resNums)) for chain, resNums in chainResidues.items())
+
+
+def _getPocketSceneLines(pocketIds, predictions, pointsObj, colorIdx=0):
+  lines = []
+  for i, pocketId in enumerate(pocketIds, colorIdx):
+    color = POCKET_COLORS[i % len(POCKET_COLORS)]
+    lines += ['show spheres, {} and resi {}'.format(pointsObj, pocketId),
+              'color {}, {} and resi {}'.format(color, pointsObj, pocketId)]
+    resSelection = getResiduesSelection(predictions.pockets[pocketId]['residue_ids'])
+    if resSelection:
+      lines += ['select pocket{}, protein and ({})'.format(pocketId, resSelection),
+                'show surface, pocket{}'.format(pocketId), 'color {}, pocket{}'.format(color, pocketId)]
+  return lines
+
+
+def _getSceneHeaderLines(proteinFile, pmlDir):
+  return ['load {}, protein'.format(os.path.relpath(proteinFile, pmlDir)), 'hide everything', 'bg_color white',
+          'show cartoon, protein', 'color grey80, protein', 'set sphere_scale, 0.3', 'set transparency, 0.3']
+
+
+def writeP2RankPml(pmlFile, proteinFile, pointsFile, predictions, pocketIds=None):
+  '''Writes a PyMOL scene of the P2Rank predictions, similar to the one generated by P2Rank: the protein with the
+  residues of each pocket and its points colored.
+  predictions: P2RankPredictions. pocketIds: pockets to show (all by default)'''
+  pocketIds = list(predictions) if pocketIds is None else pocketIds
+  pmlDir = os.path.dirname(os.path.abspath(pmlFile))
+  lines = _getSceneHeaderLines(proteinFile, pmlDir)
+  lines += ['load {}, pockets'.format(os.path.relpath(pointsFile, pmlDir)), 'hide everything, pockets and resi 0']
+  lines += _getPocketSceneLines(pocketIds, predictions, 'pockets')
+  lines += ['deselect', 'orient protein']
+  with open(pmlFile, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return pmlFile
+
+
+def decimatePocketPoints(pocketPoints, method, voxelSize=2.0):
+  '''Reduces the points of a pocket for its display.
+  Voxel grid: keeps one point per voxel of voxelSize (A). Centroid and hull: keeps the vertices of the convex
+  hull of the points and their centroid (the pockets with too few or coplanar points are kept as they are)'''
+  from .constants import DECIMATION_VOXEL, DECIMATION_HULL
+  coords = pocketPoints.coords
+  if method == DECIMATION_VOXEL and len(coords) > 1:
+    _, idxs = np.unique(np.floor(coords / voxelSize).astype(np.int64), axis=0, return_index=True)
+    return selectPoints(pocketPoints, np.sort(idxs))
+
+  elif method == DECIMATION_HULL and len(coords) > 4:
+    from scipy.spatial import ConvexHull, QhullError
+    try:
+      hullPoints = selectPoints(pocketPoints, ConvexHull(coords).vertices)
+    except QhullError:
+      return pocketPoints
+    return P2RankPoints(np.vstack([hullPoints.coords, coords.mean(axis=0)]),
+                        np.append(hullPoints.occupancies, pocketPoints.occupancies.mean()),
+                        np.append(hullPoints.scores, pocketPoints.scores.mean()),
+                        np.append(hullPoints.pocketIds, pocketPoints.pocketIds[0]))
+  return pocketPoints
+
+
+def writeP2RankLODPml(pmlFile, proteinFile, points, predictions, pocketIds, decimation=0, voxelSize=2.0,
+                      chunkSize=0):
+  '''Writes a light PyMOL scene of the pockets with pocketIds (in order), with their points decimated (see
+  decimatePocketPoints). If chunkSize > 0, the pockets are split in files of chunkSize pockets: only the first
+  one is loaded with the scene and the next ones are loaded with the PyMOL command "more_pockets".
+  points: P2RankPoints of the structure. predictions: P2RankPredictions'''
+  pmlDir = os.path.dirname(os.path.abspath(pmlFile))
+  pmlName = os.path.splitext(os.path.basename(pmlFile))[0]
+  pocketIdxs = groupPointsByPocket(points)
+  pocketIds = [pocketId for pocketId in pocketIds if pocketId in pocketIdxs]
+  chunkSize = chunkSize if chunkSize > 0 else max(len(pocketIds), 1)
+
+  chunks = []
+  for start in range(0, len(pocketIds), chunkSize):
+    chunkIds = pocketIds[start:start + chunkSize]
+    chunkPoints = [decimatePocketPoints(selectPoints(points, pocketIdxs[pocketId]), decimation, voxelSize)
+                   for pocketId in chunkIds]
+    chunkFile = os.path.join(pmlDir, '{}_pockets_{}.pdb'.format(pmlName, len(chunks) + 1))
+    writeP2RankPoints(chunkFile, P2RankPoints(*(np.concatenate(values) for values in zip(*chunkPoints))))
+    chunks.append((chunkFile, chunkIds))
+
+  lines = _getSceneHeaderLines(proteinFile, pmlDir)
+  chunkScenes = [(os.path.basename(chunkFile), 'pockets_{}'.format(i + 1),
+                  _getPocketSceneLines(chunkIds, predictions, 'pockets_{}'.format(i + 1), colorIdx=i * chunkSize))
+                 for i, (chunkFile, chunkIds) in enumerate(chunks)]
+  if chunkScenes:
+    chunkFile, objName, commands = chunkScenes[0]
+    lines += ['load {}, {}'.format(chunkFile, objName)] + commands
+
+  if len(chunkScenes) > 1:
+    # Next chunks loaded on demand, with the same commands as the first one
+    lines += ['python', 'import os', 'from pymol import cmd',
+              '_p2rankDir = {}'.format(repr(pmlDir)),
+              '_p2rankChunks = {}'.format(repr(chunkScenes[1:])),
+              'def more_pockets():',
+              '  if not _p2rankChunks:',
+              '    print("All the pockets are loaded")',
+              '    return',
+              '  chunkFile, objName, commands = _p2rankChunks.pop(0)',
+              '  cmd.load(os.path.join(_p2rankDir, chunkFile), objName)',
+              '  for command in commands:',
+              '    cmd.do(command)',
+              '  print("{} pocket chunks left".format(len(_p2rankChunks)))',
+              'cmd.extend("more_pockets", more_pockets)',
+              'print("Type more_pockets to load the next {} pockets")'.format(chunkSize),
+              'python end']
+  lines += ['deselect', 'orient protein']
+  with open(pmlFile, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return pmlFile
+
+
+################# Ensembles ###################
+
+def splitModels(structFile, outPrefix):
+  '''Splits the models of a PDB or mmCIF file (optionally gzipped) into one file per model, named
+  <outPrefix>_<model number><extension>, streaming them so only a line is held in memory.
+  Returns the list of model files. A file without models is written as a single model'''
+  isCIF = isCIFFile(structFile)
+  ext = '.cif' if isCIF else '.pdb'
+  opener = gzip.open if structFile.endswith('.gz') else open
+  modelFiles, fOut = [], None
+
+  def openModel():
+    modelFiles.append('{}_{}{}'.format(outPrefix, len(modelFiles) + 1, ext))
+    return open(modelFiles[-1], 'wb')
+
+  with opener(structFile, 'rb') as f:
+    if isCIF:
+      header, fields, rows = _readCIFAtomSite(f)
+      modelIdx, model = _getCIFFieldIdx(fields, ['pdbx_PDB_model_num']), None
+      for line in rows:
+        lineModel = _splitCIFRow(line)[modelIdx] if modelIdx is not None else b''
+        if fOut is None or lineModel != model:
+          if fOut:
+            fOut.write(b'#\n')
+            fOut.close()
+          fOut, model = openModel(), lineModel
+          fOut.writelines(header)
+        fOut.write(line)
+      if fOut:
+        fOut.write(b'#\n')
+
+    else:
+      for line in f:
+        record = line[:6]
+        if record == b'MODEL ':
+          if fOut:
+            fOut.write(b'END\n')
+            fOut.close()
+          fOut = openModel()
+        elif record == b'ENDMDL':
+          fOut.write(b'END\n')
+          fOut.close()
+          fOut = None
+        elif record in (b'ATOM  ', b'HETATM', b'TER   ', b'TER\n', b'TER\r\n'):
+          if fOut is None:
+            if modelFiles:
+              # Atoms after the last model
+              continue
+            fOut = openModel()
+          fOut.write(line)
+      if fOut:
+        fOut.write(b'END\n')
+
+  if fOut:
+    fOut.close()
+  return modelFiles
+
+
+class PocketTracker:
+  """ Links the pockets of consecutive frames by the overlap (Jaccard index) of their residues.
+  Each pocket joins the live track whose last pocket overlaps it the most (over minOverlap), or starts a new one.
+  A track stays live while it misses at most maxGap consecutive frames; then it is retired and its residues
+  dropped. Only the last residues of the live tracks and the running statistics of all of them are kept, so the
+  memory and the matching time do not grow with the number of frames """
+  def __init__(self, minOverlap=0.3, maxGap=0):
+    self.minOverlap = minOverlap
+    self.maxGap = maxGap
+    self.nFrames = 0
+    self.tracks = []
+    self.liveTracks = []
+
+  def addFrame(self, pockets):
+    '''Adds the pockets of the next frame: {rank: properties (score, probability, residue_ids)}.
+    Returns [(rank, trackId, overlap)] of the pockets'''
+    candidates = []
+    for rank, props in pockets.items():
+      resIds = set(props['residue_ids'])
+      for trackId in self.liveTracks:
+        overlap = _residuesOverlap(resIds, self.tracks[trackId]['residues'])
+        if overlap >= self.minOverlap:
+          candidates.append((overlap, rank, trackId))
+
+    # Greedy assignment by overlap: each track takes at most a pocket per frame
+    assigned, usedTracks = {}, set()
+    for overlap, rank, trackId in sorted(candidates, key=lambda cand: -cand[0]):
+      if rank not in assigned and trackId not in usedTracks:
+        assigned[rank] = (trackId, overlap)
+        usedTracks.add(trackId)
+
+    links = []
+    for rank in sorted(pockets):
+      props = pockets[rank]
+      if rank in assigned:
+        trackId, overlap = assigned[rank]
+      else:
+        trackId, overlap = len(self.tracks), 0.0
+        self.tracks.append({'firstFrame': self.nFrames, 'nFrames': 0, 'sumScore': 0.0, 'maxScore': 0.0,
+                            'sumProbability': 0.0, 'maxProbability': 0.0, 'bestResidues': []})
+        self.liveTracks.append(trackId)
+      self._updateTrack(self.tracks[trackId], props)
+      links.append((rank, trackId + 1, overlap))
+
+    liveTracks = []
+    for trackId in self.liveTracks:
+      if self.nFrames - self.tracks[trackId]['lastFrame'] <= self.maxGap:
+        liveTracks.append(trackId)
+      else:
+        # Retired: it is not matched anymore
+        del self.tracks[trackId]['residues']
+    self.liveTracks = liveTracks
+    self.nFrames += 1
+    return links
+
+  def _updateTrack(self, track, props):
+    score, probability = props['score'], props.get('probability', 0.0)
+    if track['nFrames'] == 0 or score > track['maxScore']:
+      track['bestResidues'] = props['residue_ids']
+    track.update({'residues': set(props['residue_ids']), 'lastFrame': self.nFrames, 'nFrames': track['nFrames'] + 1,
+                  'sumScore': track['sumScore'] + score, 'maxScore': max(track['maxScore'], score),
+                  'sumProbability': track['sumProbability'] + probability,
+                  'maxProbability': max(track['maxProbability'], probability)})
+
+  def getTracksSummary(self):
+    '''Returns the statistics of each track: frames where it is present, persistence (fraction of the frames)
+    and mean / max P2Rank score and probability'''
+    summary = []
+    for trackId, track in enumerate(self.tracks, 1):
+      nFrames = track['nFrames']
+      summary.append({'track': trackId, 'nFrames': nFrames, 'persistence': round(nFrames / self.nFrames, 4),
+                      'firstFrame': track['firstFrame'] + 1, 'lastFrame': track['lastFrame'] + 1,
+                      'meanScore': round(track['sumScore'] / nFrames, 4), 'maxScore': track['maxScore'],
+                      'meanProbability': round(track['sumProbability'] / nFrames, 4),
+                      'maxProbability': track['maxProbability'], 'residues': ' '.join(track['bestResidues'])})
+    return summary
+
+
+################# Rescoring ###################
+
+def writeFPocketPrediction(outDir, name, proteinFile, pocketsCoords, contactDistance=4.0):
+  '''Writes pockets found by any method in the layout of a fpocket prediction, readable by P2Rank rescore:
+  <outDir>/<name>_out/<name>_out.pdb (protein and pocket points as STP HETATM) and, in its pockets folder,
+  pocket<N>_atm.pdb (protein atoms closer than contactDistance to the points) and pocket<N>_vert.pqr (points).
+  pocketsCoords: list of (n, 3) arrays with the points of each pocket, numbered from 1 in that order.
+  Returns the path of the _out.pdb prediction file'''
+  from scipy.spatial import cKDTree
+  predDir = os.path.join(outDir, '{}_out'.format(name))
+  pocketsDir = os.path.join(predDir, 'pockets')
+  os.makedirs(pocketsDir, exist_ok=True)
+  _, atomLines, _, _, atomCoords = readStructureAtoms(proteinFile)
+  atomsTree = cKDTree(atomCoords) if len(atomCoords) else None
+
+  predFile = os.path.join(predDir, '{}_out.pdb'.format(name))
+  with open(predFile, 'wb') as fPred:
+    fPred.writelines(atomLines)
+    for pocketId, coords in enumerate(pocketsCoords, 1):
+      coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+      pointLines = ['{:5d}    C STP  {:4d}    {:8.3f}{:8.3f}{:8.3f}'.format(i % 100000, pocketId, *coord)
+                    for i, coord in enumerate(coords, 1)]
+      fPred.write(''.join('HETATM{}  0.00  0.00          Ve\n'.format(line) for line in pointLines).encode())
+      with open(os.path.join(pocketsDir, 'pocket{}_vert.pqr'.format(pocketId)), 'w') as f:
+        f.write(''.join('ATOM  {}    0.00    3.00\n'.format(line) for line in pointLines))
+        f.write('TER\nEND\n')
+
+      atomIdxs = set()
+      if atomsTree is not None and len(coords):
+        for idxs in atomsTree.query_ball_point(coords, contactDistance):
+          atomIdxs.update(idxs)
+      with open(os.path.join(pocketsDir, 'pocket{}_atm.pdb'.format(pocketId)), 'wb') as f:
+        f.writelines(atomLines[i] for i in sorted(atomIdxs))
+        f.write(b'TER\nEND\n')
+    fPred.write(b'END\n')
+  return predFile
+
+
+def mapRescoredPockets(predictions, pocketsCenters, maxDistance=5.0):
+  '''Maps the pockets rescored by P2Rank to the exported ones: by their original rank (old_rank column) if
+  available or by the closest center otherwise.
+  predictions: P2RankPredictions of the rescoring. pocketsCenters: centers (x, y, z) of the exported pockets
+  (numbered from 1), None for the pockets without points, which are never mapped.
+  Returns {exported pocket number: rescored properties}'''
+  from scipy.spatial import cKDTree
+  mapped = {}
+  pocketIds = [pocketId for pocketId, center in enumerate(pocketsCenters, 1) if center is not None]
+  centers = np.asarray([pocketsCenters[pocketId - 1] for pocketId in pocketIds], dtype=np.float64).reshape(-1, 3)
+  tree = cKDTree(centers) if len(centers) else None
+  for rank in predictions:
+    props = predictions.pockets[rank]
+    if str(props.get('old_rank', '')).strip().isdigit():
+      pocketId = int(props['old_rank'])
+      if not 0 < pocketId <= len(pocketsCenters) or pocketsCenters[pocketId - 1] is None:
+        continue
+    elif tree is not None:
+      dist, idx = tree.query([props['center_x'], props['center_y'], props['center_z']])
+      if dist > maxDistance:
+        continue
+      pocketId = pocketIds[int(idx)]
+    else:
+      continue
+    if pocketId not in mapped:
+      mapped[pocketId] = props
+  return mapped
+
+
+################# Resources ###################
+
+def getHostResources():
+  '''Returns the cores available to this process and the available memory (MB, None if unknown)'''
+  try:
+    nCores = len(os.sched_getaffinity(0))
+  except AttributeError:
+    nCores = os.cpu_count() or 1
+
+  availableMB = None
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          availableMB = int(line.split()[1]) // 1024
+          break
+  except (OSError, ValueError):
+    pass
+  return nCores, availableMB
+
+
+def planP2RankResources(structsAtoms, maxThreads, heapMB=0, gc=0, autoThreads=True, host=None):
+  '''Plans the JVM heap, garbage collector and P2Rank threads of a prediction.
+  P2Rank processes the structures of a dataset in parallel, one per thread, so the heap must hold the largest
+  structures being processed at once. The threads are limited by the requested ones (maxThreads), the structures,
+  the cores and the memory available; the heap is capped to a fraction of the available memory.
+  structsAtoms: number of atoms of each structure. heapMB, gc: explicit values (0 for automatic).
+  Returns a dictionary with the heap (MB), gc, threads and the java options'''
+  from .constants import JVM_BASE_HEAP, JVM_HEAP_PER_ATOM, JVM_MIN_HEAP, JVM_MAX_MEMORY_FRACTION, \
+    JVM_GC_AUTO, JVM_GC_G1, JVM_GC_SERIAL, JVM_GC_OPTIONS
+  nCores, availableMB = host or getHostResources()
+  maxMB = int(availableMB * JVM_MAX_MEMORY_FRACTION) if availableMB else None
+  atoms = sorted(structsAtoms, reverse=True) or [0]
+
+  threads = max(1, maxThreads)
+  if autoThreads:
+    threads = max(1, min(threads, len(structsAtoms) or 1, nCores))
+    if maxMB and not heapMB:
+      # Not more structures at once than those fitting in memory
+      while threads > 1 and JVM_BASE_HEAP + JVM_HEAP_PER_ATOM * sum(atoms[:threads]) > maxMB:
+        threads -= 1
+
+  if not heapMB:
+    heapMB = max(JVM_MIN_HEAP, int(JVM_BASE_HEAP + JVM_HEAP_PER_ATOM * sum(atoms[:threads])))
+    if maxMB:
+      heapMB = max(JVM_MIN_HEAP, min(heapMB, maxMB))
+
+  if gc == JVM_GC_AUTO:
+    # Serial collector for small single threaded runs (less start-up and footprint), G1 otherwise
+    gc = JVM_GC_SERIAL if heapMB <= 2048 and threads == 1 else JVM_GC_G1
+
+  return {'heapMB': heapMB, 'gc': gc, 'threads': threads, 'cores': nCores, 'availableMB': availableMB,
+          'javaOptions': ['-Xmx{}m'.format(heapMB), JVM_GC_OPTIONS[gc]]}
+
+
+################# Pocket descriptors ###################
+
+def _getSphereStencil(radius, spacing):
+  '''Returns the offsets (n, 3) of the voxels whose centers are within radius of the center of a voxel'''
+  n = int(np.ceil(radius / spacing))
+  offsets = np.stack(np.meshgrid(*[np.arange(-n, n + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+  return offsets[(offsets ** 2).sum(axis=1) * spacing ** 2 <= radius ** 2]
+
+
+def _getGridDescriptors(coords, labels, nPockets, radius, spacing, maxVoxels=1 << 20):
+  '''Volume and surface area of the union of the spheres centered on the points of each pocket (labels: pocket
+  index of each point), from the voxels of a grid covering them. The area counts the voxel faces exposed,
+  scaled by 2/3 to correct the overestimation of the staircase of a voxelized surface.
+  The points are processed by chunks of pockets of at most maxVoxels voxels'''
+  stencil = _getSphereStencil(radius, spacing)
+  voxels = np.floor(coords / spacing).astype(np.int64)
+  # Grid with a margin for the stencil and the neighbours of the border voxels, so the keys never wrap around
+  margin = np.abs(stencil).max() + 1
+  origin = voxels.min(axis=0) - margin
+  shape = voxels.max(axis=0) - origin + margin + 1
+  voxels -= origin
+  strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+  pocketStride = int(np.prod(shape))
+
+  volumes, faces = np.zeros(nPockets), np.zeros(nPockets)
+  order = np.argsort(labels, kind='stable')
+  bounds = np.searchsorted(labels[order], np.arange(nPockets + 1))
+  start = 0
+  while start < nPockets:
+    # Chunk of pockets with a bounded number of voxels
+    end = start + 1
+    while end < nPockets and (bounds[end + 1] - bounds[start]) * len(stencil) <= maxVoxels:
+      end += 1
+    idxs = order[bounds[start]:bounds[end]]
+    # Unique voxels of each pocket, as keys including the pocket index
+    keys = (voxels[idxs] @ strides)[:, None] + (stencil @ strides)[None, :] + \
+           (labels[idxs] * pocketStride)[:, None]
+    keys = np.unique(keys)
+    keyLabels = keys // pocketStride
+    volumes[start:end] = np.bincount(keyLabels - start, minlength=end - start)
+    for stride in strides:
+      for neighbours in (keys + stride, keys - stride):
+        pos = np.clip(np.searchsorted(keys, neighbours), 0, len(keys) - 1)
+        exposed = keys[pos] != neighbours
+        faces[start:end] += np.bincount(keyLabels[exposed] - start, minlength=end - start)
+    start = end
+  return volumes * spacing ** 3, faces * spacing ** 2 * 2 / 3
+
+
+def computePocketsDescriptors(pocketsPoints, proteinCoords=None, method=0, spacing=0.5,
+                              pointRadius=None, buriedRadius=None):
+  '''Computes the volume, surface area and buriedness of all the pockets of a structure at once.
+  Convex hull (method 0): volume and area of the hull of the points. The pockets too small or flat for a hull
+  get the values of the union of spheres.
+  Union of spheres grid (method 1): volume and area of the union of the spheres of pointRadius centered on the
+  points, on a grid of that spacing.
+  Buriedness: mean number of protein atoms (proteinCoords) closer than buriedRadius to the points of the pocket.
+  pocketsPoints: {pocketId: P2RankPoints}
+  Returns {pocketId: {'volume': , 'surfaceArea': , 'buriedness': }}'''
+  from .constants import VOLUME_HULL, POCKET_POINT_RADIUS, BURIEDNESS_RADIUS
+  pointRadius = POCKET_POINT_RADIUS if pointRadius is None else pointRadius
+  buriedRadius = BURIEDNESS_RADIUS if buriedRadius is None else buriedRadius
+  pocketIds = list(pocketsPoints)
+  if not pocketIds:
+    return {}
+  coords = np.concatenate([pocketsPoints[pId].coords for pId in pocketIds]).astype(np.float64).reshape(-1, 3)
+  labels = np.repeat(np.arange(len(pocketIds)), [len(pocketsPoints[pId].coords) for pId in pocketIds])
+
+  volumes, areas = np.zeros(len(pocketIds)), np.zeros(len(pocketIds))
+  gridIdxs = np.arange(len(pocketIds))
+  if method == VOLUME_HULL:
+    from scipy.spatial import ConvexHull, QhullError
+    gridIdxs = []
+    for i, pId in enumerate(pocketIds):
+      try:
+        hull = ConvexHull(pocketsPoints[pId].coords) if len(pocketsPoints[pId].coords) > 3 else None
+      except QhullError:
+        hull = None
+      if hull is None:
+        gridIdxs.append(i)
+      else:
+        volumes[i], areas[i] = hull.volume, hull.area
+    gridIdxs = np.array(gridIdxs, dtype=np.int64)
+
+  if len(gridIdxs):
+    inGrid = np.isin(labels, gridIdxs)
+    gridLabels = np.zeros(len(pocketIds), dtype=np.int64)
+    gridLabels[gridIdxs] = np.arange(len(gridIdxs))
+    volumes[gridIdxs], areas[gridIdxs] = _getGridDescriptors(coords[inGrid], gridLabels[labels[inGrid]],
+                                                             len(gridIdxs), pointRadius, spacing)
+
+  buriedness = np.zeros(len(pocketIds))
+  if proteinCoords is not None and len(proteinCoords):
+    from scipy.spatial import cKDTree
+    counts = cKDTree(proteinCoords).query_ball_point(coords, buriedRadius, return_length=True)
+    buriedness = np.bincount(labels, weights=counts, minlength=len(pocketIds)) / \
+                 np.maximum(np.bincount(labels, minlength=len(pocketIds)), 1)
+
+  return {pId: {'volume': float(volumes[i]), 'surfaceArea': float(areas[i]), 'buriedness': float(buriedness[i])}
+          for i, pId in enumerate(pocketIds)}
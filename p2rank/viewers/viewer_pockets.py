@@ -29,6 +29,8 @@ from ..protocols import P2RankFindPockets
 from pwchem.viewers import ViewerGeneralStructROIs
 import pyworkflow.protocol.params as params
 
+from ..constants import DECIMATION_NONE, DECIMATION_VOXEL, DECIMATION_METHODS
+
 class viewerP2Rank(ViewerGeneralStructROIs):
   _label = 'Viewer P2Rank pockets'
   _targets = [P2RankFindPockets]
@@ -40,6 +42,23 @@ class viewerP2Rank(ViewerGeneralStructROIs):
     super()._defineParams(form)
     section = form.getSection('Visualization of structural ROIs')
     group = section.addGroup('P2Rank Pymol visualization')
+    group.addParam('p2rankStructName', params.StringParam, default='',
+                   label='Structure name: ',
+                   help='Name of the input structure to display, for predictions on a set of structures. '
+                        'The first one is displayed if empty.')
+    group.addParam('p2rankTopPockets', params.IntParam, default=0, label='Number of pockets to display: ',
+                   help='Display only the best ranked pockets (0 displays all of them)')
+    group.addParam('p2rankDecimation', params.EnumParam, default=DECIMATION_NONE, choices=DECIMATION_METHODS,
+                   label='Pocket points decimation: ',
+                   help='Reduce the points displayed for each pocket, so large predictions are displayed fluently.\n'
+                        'Voxel grid: one point for each voxel of the grid.\n'
+                        'Centroid and hull: the vertices of the convex hull of the pocket points and their centroid.')
+    group.addParam('p2rankVoxelSize', params.FloatParam, default=2.0,
+                   condition='p2rankDecimation=={}'.format(DECIMATION_VOXEL),
+                   label='Voxel size (A): ', help='Size of the voxels of the decimation grid')
+    group.addParam('p2rankChunkSize', params.IntParam, default=0, label='Pockets loaded at once: ',
+                   help='Load the pockets in groups of this size (0 loads all of them). The first group is loaded '
+                        'with the scene and the next ones with the PyMOL command "more_pockets"')
     group.addParam('displayP2Rank', params.LabelParam,
                    label='Display with P2Rank viewer',
                    help='Display pocket with own P2Rank visualization in pymol')
@@ -50,7 +69,17 @@ class viewerP2Rank(ViewerGeneralStructROIs):
     return dispDic
 
   def _showP2Rank(self, paramName=None):
-      pdbFileName = self.protocol.getPdbInputStructName()
-      outDir = os.path.abspath(self.protocol._getExtraPath('visualizations'))
-      pmlFile = outDir + '/' + pdbFileName + '.pml'
-      return self._showAtomStructPyMol(pmlFile, outDir)
+      name = None
+      if self.protocol._isMultiStructure():
+          names = self.protocol._getInputNames()
+          name = self.p2rankStructName.get() if self.p2rankStructName.get() in names else names[0]
+      if self._useLOD():
+          pmlFile = self.protocol.getPymolLODSceneFile(name, self.p2rankTopPockets.get(), self.p2rankDecimation.get(),
+                                                       self.p2rankVoxelSize.get(), self.p2rankChunkSize.get())
+      else:
+          pmlFile = self.protocol.getPymolSceneFile(name)
+      return self._showAtomStructPyMol(pmlFile, os.path.dirname(pmlFile))
+
+  def _useLOD(self):
+      return self.p2rankTopPockets.get() > 0 or self.p2rankDecimation.get() != DECIMATION_NONE or \
+             self.p2rankChunkSize.get() > 0
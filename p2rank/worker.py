@@ -0,0 +1,193 @@
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Client of the persistent P2Rank worker (java/P2RankWorker.java), a long-lived JVM that keeps P2Rank loaded
+and runs the prank commands it receives through a local socket. The worker is spawned on demand and shuts
+itself down after an idle period.
+The worker only accepts the commands that carry the random token it writes, next to its port, in a file only
+readable by its user inside a private directory. The command is only sent once the worker takes the connection,
+so a worker that is busy with other commands is never stopped. A worker that stops answering while it runs our
+command is killed, so the command can be run in one-shot mode.
+"""
+import os, sys, time, signal, socket, fcntl, hashlib, subprocess
+
+from .constants import P2RANK_CLASSPATH, WORKER_IDLE_TIMEOUT, WORKER_START_TIMEOUT, WORKER_STATUS_PREFIX, \
+    WORKER_READY_PREFIX, WORKER_CONNECT_TIMEOUT, WORKER_QUEUE_TIMEOUT, WORKER_READ_TIMEOUT
+
+WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'java', 'P2RankWorker.java')
+
+
+class P2RankWorkerError(Exception):
+    """ The P2Rank worker could not be started or lost the connection before finishing a command """
+    pass
+
+
+class P2RankWorkerClient:
+    """ Submits prank commands to the persistent worker of a P2Rank installation, spawning it if needed """
+    def __init__(self, p2rankHome, workerDir, idleTimeout=WORKER_IDLE_TIMEOUT, javaOptions=None, environ=None):
+        self.p2rankHome = os.path.abspath(p2rankHome)
+        self.workerDir = workerDir
+        self.idleTimeout = int(idleTimeout)
+        self.javaOptions = javaOptions or []
+        self.environ = environ
+
+        homeKey = hashlib.md5(self.p2rankHome.encode()).hexdigest()[:12]
+        self.portFile = os.path.join(workerDir, 'worker_{}.port'.format(homeKey))
+        self.lockFile = os.path.join(workerDir, 'worker_{}.lock'.format(homeKey))
+        self.logFile = os.path.join(workerDir, 'worker_{}.log'.format(homeKey))
+
+    def submit(self, program, args, out=sys.stdout):
+        """ Runs "prank <program> <args>" in the worker, writing its output to out.
+        Returns the exit code of the command """
+        command = [program] + [str(arg) for arg in args]
+        for attempt in range(2):
+            port, token, pid = self._ensureWorker()
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=WORKER_CONNECT_TIMEOUT)
+            except OSError:
+                # Stale port file: the worker shut down after it was read
+                self._removePortFile(port)
+                continue
+            with sock, sock.makefile('r', encoding='utf-8', errors='replace') as f:
+                self._waitReady(sock, f)
+                sock.settimeout(WORKER_READ_TIMEOUT)
+                try:
+                    return self._sendCommand(sock, f, token, command, out)
+                except OSError as e:
+                    # The worker took our command and may still be running it: stopped so it does not write the
+                    # outputs while they are generated in one-shot mode
+                    self._killWorker(port, pid)
+                    raise P2RankWorkerError('lost the connection to the P2Rank worker ({}), it was stopped'.
+                                            format(e))
+        raise P2RankWorkerError('could not connect to the P2Rank worker')
+
+    def _waitReady(self, sock, f):
+        """ Waits until the worker takes the connection, once it finished the commands it received before.
+        Nothing is sent before, so giving up does not leave a command in the worker and it is not stopped, as it
+        may be running the command of other process """
+        sock.settimeout(WORKER_QUEUE_TIMEOUT)
+        try:
+            line = f.readline()
+        except OSError as e:
+            raise P2RankWorkerError('the P2Rank worker did not take the command ({}), it is busy'.format(e))
+        if not line.startswith(WORKER_READY_PREFIX):
+            raise P2RankWorkerError('the P2Rank worker closed the connection before taking the command. '
+                                    'Check {}'.format(self.logFile))
+
+    def _sendCommand(self, sock, f, token, command, out):
+        sock.sendall(('\n'.join([token] + command) + '\n\n').encode('utf-8'))
+        for line in f:
+            if line.startswith(WORKER_STATUS_PREFIX):
+                out.flush()
+                return int(line.split()[1])
+            out.write(line)
+        raise P2RankWorkerError('connection to the P2Rank worker closed before the command finished. '
+                                'Check {}'.format(self.logFile))
+
+    # ---------------------------- Worker management -------------------------
+    def _readAddress(self):
+        """ Returns the (port, token, pid) written by the running worker, or (None, None, None) """
+        try:
+            with open(self.portFile) as f:
+                port, token, pid = f.read().split()
+            return int(port), token, int(pid)
+        except (OSError, ValueError):
+            return None, None, None
+
+    def _removePortFile(self, port):
+        with open(self.lockFile, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._readAddress()[0] == port:
+                os.remove(self.portFile)
+
+    def _killWorker(self, port, pid):
+        with open(self.lockFile, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._readAddress()[0] == port:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                os.remove(self.portFile)
+
+    def _checkWorkerDir(self):
+        """ Creates the worker directory only accessible by the user, refusing to use it if other user owns it
+        or can access it """
+        from .cache import makePrivateDir
+        try:
+            makePrivateDir(self.workerDir)
+        except PermissionError as e:
+            raise P2RankWorkerError(str(e))
+
+    def _ensureWorker(self):
+        """ Returns the (port, token, pid) of a running worker, spawning one if there is none """
+        self._checkWorkerDir()
+        with open(self.lockFile, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            address = self._readAddress()
+            if address[0] is None:
+                address = self._spawnWorker()
+        return address
+
+    def _getJavaVersion(self):
+        try:
+            res = subprocess.run(['java', '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 env=self.environ, universal_newlines=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise P2RankWorkerError('java not available: {}'.format(e))
+        version = res.stdout.split('"')[1] if '"' in res.stdout else '0'
+        major = version.split('.')[1] if version.startswith('1.') else version.split('.')[0]
+        return int(''.join(c for c in major if c.isdigit()) or 0)
+
+    def _getWorkerCommand(self):
+        javaVersion = self._getJavaVersion()
+        if javaVersion < 11:
+            raise P2RankWorkerError('the worker needs java >= 11, found {}'.format(javaVersion))
+
+        classpath = os.pathsep.join(os.path.join(self.p2rankHome, cp) for cp in P2RANK_CLASSPATH)
+        command = ['java'] + self.javaOptions
+        if javaVersion >= 18:
+            # Needed to trap the System.exit calls of P2Rank inside the worker
+            command += ['-Djava.security.manager=allow']
+        command += ['-cp', classpath, WORKER_SOURCE, self.portFile, str(self.idleTimeout)]
+        return command
+
+    def _spawnWorker(self):
+        with open(self.logFile, 'a') as log:
+            proc = subprocess.Popen(self._getWorkerCommand(), cwd=self.p2rankHome, env=self.environ,
+                                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        startTime = time.time()
+        while time.time() - startTime < WORKER_START_TIMEOUT:
+            address = self._readAddress()
+            if address[0] is not None:
+                return address
+            if proc.poll() is not None:
+                raise P2RankWorkerError('the worker exited on start-up. Check {}'.format(self.logFile))
+            time.sleep(0.1)
+        proc.kill()
+        raise P2RankWorkerError('the worker did not start in {} s'.format(WORKER_START_TIMEOUT))
@@ -35,6 +35,6 @@ setup(
     install_requires=[requirements],
     entry_points={'pyworkflow.plugin': 'p2rank = p2rank'},
     package_data={  # Optional
-       'p2rank': ['p2rank_logo.png', 'protocols.conf'],
+       'p2rank': ['p2rank_logo.png', 'protocols.conf', 'java/*.java', 'tests/stub/prank', 'tests/*.json'],
     }
 )